@@ -0,0 +1,337 @@
+import os
+import time
+import socket
+import logging
+import argparse
+
+# Rule file format, one rule per line, '#' starts a comment. The first rule that matches wins:
+#
+#     ACTION  DESTINATION  [PORTS]  [USERS]
+#
+# ACTION       allow | deny | route=NAME (allow, through upstream NAME; route=direct connects itself)
+# DESTINATION  * | 10.0.0.0/8 | 192.0.2.1 | 2001:db8::/32 | example.com (that name only)
+#              | .example.com (the name and every name under it)
+# PORTS        * (default) | 443 | 80,443 | 1-1023,8080
+# USERS        * (default) | alice,bob
+#
+# A destination asked for by name is checked again as each address it resolves to: a deny rule
+# for one of those networks that comes before the rule the name matched still applies. A request
+# no rule matches is allowed, so end the file with `deny *` for a whitelist.
+
+# How often check() looks at the file's mtime to pick up edits
+RELOAD_CHECK_INTERVAL = 2
+# Decisions remembered per (host, port, user); the cache is emptied when it fills up
+CACHE_SIZE = 65536
+DIRECT = "direct"
+
+class Rule:
+    __slots__ = ("index", "action", "upstream", "ports", "users", "text")
+
+    def __init__(self, index, action, upstream, ports, users, text):
+        self.index = index # position in the file; lower wins
+        self.action = action # "allow" or "deny"
+        self.upstream = upstream # None for allow/deny, else the route=NAME
+        self.ports = ports # None for any, else ((low, high), ...)
+        self.users = users # None for any, else a frozenset
+        self.text = text
+
+    def applies(self, port, user):
+        if self.users is not None and user not in self.users:
+            return False
+        if self.ports is None:
+            return True
+        for low, high in self.ports:
+            if low <= port <= high:
+                return True
+        return False
+
+# What a request no rule matches gets
+DEFAULT_RULE = Rule(float("inf"), "allow", None, None, None, "default")
+
+class DomainNode:
+    __slots__ = ("children", "exact", "subtree")
+
+    def __init__(self):
+        self.children = {} # next label towards the left -> DomainNode
+        self.exact = [] # rules for exactly this name
+        self.subtree = [] # rules for this name and everything under it
+
+def parse_ports(text):
+    if text == "*":
+        return None
+    ranges = []
+    for part in text.split(","):
+        low, _, high = part.partition("-")
+        low, high = int(low), int(high or low)
+        if not 0 <= low <= high <= 65535:
+            raise ValueError(f"bad port range {part}")
+        ranges.append((low, high))
+    return tuple(ranges)
+
+def parse_network(text):
+    # Returns (family, prefix length, network as an int) for an IP or CIDR, None for anything else
+    address, _, length = text.partition("/")
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except OSError:
+            continue
+        length = int(length) if length else bits
+        if not 0 <= length <= bits:
+            raise ValueError(f"bad prefix length in {text}")
+        return family, length, int.from_bytes(packed, "big") >> (bits - length)
+    if length:
+        raise ValueError(f"bad network {text}")
+    return None
+
+def pack_address(host):
+    # (family, address bits, address as an int) for an IP literal, None for a name
+    if ":" in host:
+        family, bits = socket.AF_INET6, 128
+    elif host[-1:].isdigit():
+        family, bits = socket.AF_INET, 32
+    else:
+        return None # a name can't end in a digit, so no failed inet_pton per name
+    try:
+        return family, bits, int.from_bytes(socket.inet_pton(family, host), "big")
+    except OSError:
+        return None
+
+def first_applying(candidates, port, user, before=float("inf")):
+    # The lowest-index rule among the candidate lists (each sorted by index) that applies
+    best = None
+    for rules in candidates:
+        for rule in rules:
+            if rule.index >= before:
+                break
+            if rule.applies(port, user):
+                best = rule
+                before = rule.index
+                break
+    return best
+
+def compile_networks(tables):
+    """
+    Binary search on prefix lengths (Waldvogel et al., "Scalable High Speed
+    IP Routing Lookups"). `tables` maps length -> {network: [rules]}; the
+    result is the sorted lengths and, per length, a hash table from the
+    top bits of an address to the rules of every network containing them,
+    in file order. Besides the networks themselves the tables hold markers
+    on the way to longer networks, so a hit means "look longer" and a miss
+    "look shorter", and an address costs log2(distinct lengths) lookups.
+    """
+    lengths = sorted(tables)
+
+    def covering(length, key):
+        rules = []
+        for shorter in lengths:
+            if shorter > length:
+                break
+            rules.extend(tables[shorter].get(key >> (length - shorter), ()))
+        return sorted(rules, key=lambda rule: rule.index)
+
+    probes = [{} for _ in lengths]
+    for target, length in enumerate(lengths):
+        for key in tables[length]:
+            probes[target][key] = covering(length, key)
+            # Walk the search towards this network; wherever it has to go longer, leave a marker
+            low, high = 0, len(lengths) - 1
+            while low <= high:
+                middle = (low + high) // 2
+                if middle == target:
+                    break
+                if middle < target:
+                    marker = key >> (length - lengths[middle])
+                    if marker not in probes[middle]:
+                        probes[middle][marker] = covering(lengths[middle], marker)
+                    low = middle + 1
+                else:
+                    high = middle - 1
+    return lengths, probes
+
+class Ruleset:
+    """
+    A rule file compiled for lookup. IP rules go through
+    compile_networks(), so an address costs a handful of dict lookups
+    however many networks are listed; names sit in a trie keyed by labels
+    right to left (com -> example -> www), so a name costs one step per
+    label. Either way only the rules on that path are looked at, in file
+    order. Decisions are also cached, as most requests go to destinations
+    asked for before.
+    """
+
+    def __init__(self, lines, upstreams=()):
+        self.any = [] # rules for every destination
+        self.networks = {socket.AF_INET: {}, socket.AF_INET6: {}} # family -> {length: {network: [rules]}}
+        self.domains = DomainNode()
+        self.size = 0
+        self.cache = {} # (host, port, user) -> Rule
+        for index, (where, text) in enumerate(lines):
+            try:
+                self.add(index, text, upstreams)
+            except ValueError as e:
+                logging.error(f"{where}: {e}, rule skipped")
+        self.compiled = {family: compile_networks(tables) for family, tables in self.networks.items()}
+
+    def add(self, index, text, upstreams):
+        fields = text.split()
+        if not 2 <= len(fields) <= 4:
+            raise ValueError("expected ACTION DESTINATION [PORTS] [USERS]")
+        action, destination = fields[0], fields[1].lower()
+        ports = parse_ports(fields[2] if len(fields) > 2 else "*")
+        users = None if len(fields) < 4 or fields[3] == "*" else frozenset(fields[3].split(","))
+
+        upstream = None
+        if action.startswith("route="):
+            upstream = action[len("route="):]
+            if upstreams is not None and upstream != DIRECT and upstream not in upstreams:
+                raise ValueError(f"unknown upstream {upstream}")
+            action = "allow"
+        elif action not in ("allow", "deny"):
+            raise ValueError(f"unknown action {action}")
+        rule = Rule(index, action, upstream, ports, users, text)
+
+        if destination == "*":
+            self.any.append(rule)
+        elif (network := parse_network(destination)) is not None:
+            family, length, bits = network
+            self.networks[family].setdefault(length, {}).setdefault(bits, []).append(rule)
+        else:
+            node = self.domains
+            for label in reversed(destination.strip(".").split(".")):
+                node = node.children.setdefault(label, DomainNode())
+            (node.subtree if destination.startswith(".") else node.exact).append(rule)
+        self.size += 1
+
+    def network_candidates(self, family, bits, value):
+        lengths, probes = self.compiled[family]
+        found = None
+        low, high = 0, len(lengths) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            rules = probes[middle].get(value >> (bits - lengths[middle]))
+            if rules is None:
+                high = middle - 1
+            else:
+                found = rules
+                low = middle + 1
+        return [found] if found else []
+
+    def check(self, host, port, user=None):
+        """The rule deciding a request for host:port, DEFAULT_RULE if none matches."""
+        key = (host, port, user)
+        rule = self.cache.get(key)
+        if rule is None:
+            rule = self.lookup(host, port, user)
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = rule
+        return rule
+
+    def lookup(self, host, port, user=None):
+        address = pack_address(host)
+        if address is not None:
+            candidates = self.network_candidates(*address)
+        else:
+            candidates = []
+            node = self.domains
+            for label in reversed(host.lower().rstrip(".").split(".")):
+                node = node.children.get(label)
+                if node is None:
+                    break
+                if node.subtree:
+                    candidates.append(node.subtree)
+            else:
+                if node.exact:
+                    candidates.append(node.exact)
+        candidates.append(self.any)
+        return first_applying(candidates, port, user) or DEFAULT_RULE
+
+    def address_denied(self, ip, port, user, rule):
+        """The network rule ahead of `rule` (what the name matched) that denies this resolved address, if any."""
+        address = pack_address(ip)
+        if address is None:
+            return None
+        earlier = first_applying(self.network_candidates(*address), port, user, rule.index)
+        return earlier if earlier is not None and earlier.action == "deny" else None
+
+def load_file(path):
+    lines = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if line:
+                lines.append((f"{path}:{line_number}", line))
+    return lines
+
+class RuleFile:
+    """A rule file and its compiled Ruleset, recompiled when the file changes."""
+
+    def __init__(self, path, upstreams=()):
+        self.path = path
+        self.upstreams = upstreams
+        self.ruleset = Ruleset([])
+        self.mtime = None
+        self.next_reload_check = 0
+        self.reload()
+
+    def reload(self):
+        """Recompile the rule file; the old rules stay in effect if it can't be read."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            ruleset = Ruleset(load_file(self.path), self.upstreams)
+        except OSError as e:
+            logging.error(f"Could not load rules from {self.path}: {e}")
+            return
+        self.ruleset = ruleset # one reference swap, a check never sees half a file
+        self.mtime = mtime
+        logging.info(f"Loaded {ruleset.size} rules from {self.path}")
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now < self.next_reload_check:
+            return
+        self.next_reload_check = now + RELOAD_CHECK_INTERVAL
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                self.reload()
+        except OSError:
+            pass
+
+rule_file = None
+
+def configure(path, upstreams=()):
+    global rule_file
+    rule_file = RuleFile(path, upstreams) if path else None
+
+def reload():
+    if rule_file is not None:
+        rule_file.reload()
+
+def check(host, port, user=None):
+    """The rule deciding a request for host:port; DEFAULT_RULE (allow) without a rule file."""
+    if rule_file is None:
+        return DEFAULT_RULE
+    rule_file.maybe_reload()
+    return rule_file.ruleset.check(host, port, user)
+
+def address_denied(ip, port, user, rule):
+    if rule_file is None:
+        return None
+    return rule_file.ruleset.address_denied(ip, port, user, rule)
+
+def stats():
+    return {"rules": rule_file.ruleset.size if rule_file else 0}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show which rule of a rule file decides a request")
+    parser.add_argument("rules", help="Rule file")
+    parser.add_argument("host", help="Destination name or address")
+    parser.add_argument("port", type=int, help="Destination port")
+    parser.add_argument("--user", help="Authenticated username")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    ruleset = Ruleset(load_file(args.rules), upstreams=None) # any route=NAME
+    rule = ruleset.check(args.host, args.port, args.user)
+    print(f"{rule.action}{f' via {rule.upstream}' if rule.upstream else ''}: {rule.text}")
@@ -0,0 +1,113 @@
+import queue
+import logging
+import threading
+
+# Defaults for the limits below; socks_proxy.py overrides them from its arguments
+BACKLOG = 1024
+MAX_WORKERS = 4096
+MAX_PENDING = 512
+MAX_TUNNELS = 4096
+MAX_TUNNELS_PER_IP = 1024
+
+class Admission:
+    """
+    Counts open client connections, in total and per client IP, and
+    refuses new ones over either limit (0 means no limit) before any work
+    is done for them.
+    """
+
+    def __init__(self, max_total=None, max_per_ip=None):
+        self.max_total = MAX_TUNNELS if max_total is None else max_total
+        self.max_per_ip = MAX_TUNNELS_PER_IP if max_per_ip is None else max_per_ip
+        self.total = 0
+        self.per_ip = {}
+        self.lock = threading.Lock()
+        self.rejected = {"limit_total": 0, "limit_per_ip": 0, "pending_full": 0}
+
+    def admit(self, ip):
+        """Takes a slot for `ip`; returns None, or why the connection is refused."""
+        with self.lock:
+            if self.max_total and self.total >= self.max_total:
+                self.rejected["limit_total"] += 1
+                return "limit_total"
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                self.rejected["limit_per_ip"] += 1
+                return "limit_per_ip"
+            self.total += 1
+            self.per_ip[ip] = count + 1
+            return None
+
+    def release(self, ip):
+        with self.lock:
+            self.total -= 1
+            count = self.per_ip.get(ip, 0) - 1
+            if count > 0:
+                self.per_ip[ip] = count
+            else:
+                self.per_ip.pop(ip, None)
+
+    def stats(self):
+        with self.lock:
+            return {"connections": self.total, "client_ips": len(self.per_ip), **self.rejected}
+
+class WorkerPool:
+    """
+    Handler threads for thread mode: at most max_workers of them, started
+    as the load needs them and then kept, fed from a queue of at most
+    max_pending accepted connections. submit() never blocks the accept
+    loop; when the queue is full it returns False and the caller sheds the
+    connection.
+    """
+
+    def __init__(self, handler, max_workers=None, max_pending=None):
+        self.handler = handler
+        self.max_workers = MAX_WORKERS if max_workers is None else max_workers
+        self.queue = queue.Queue(MAX_PENDING if max_pending is None else max_pending)
+        self.lock = threading.Lock()
+        self.workers = 0
+        self.idle = 0
+
+    def submit(self, *item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        with self.lock:
+            # Approximate: a worker about to go idle may be missed and one thread too many started
+            if self.idle < self.queue.qsize() and self.workers < self.max_workers:
+                self.workers += 1
+                threading.Thread(target=self.work, name=f"worker-{self.workers}", daemon=True).start()
+        return True
+
+    def work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            item = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            try:
+                self.handler(*item)
+            except Exception as e:
+                logging.error(f"Worker failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"workers": self.workers, "idle_workers": self.idle, "pending": self.queue.qsize()}
+
+connections = Admission()
+
+def configure(backlog=None, max_workers=None, max_pending=None, max_tunnels=None, max_per_ip=None):
+    global BACKLOG, MAX_WORKERS, MAX_PENDING, MAX_TUNNELS, MAX_TUNNELS_PER_IP, connections
+    if backlog is not None:
+        BACKLOG = backlog
+    if max_workers is not None:
+        MAX_WORKERS = max_workers
+    if max_pending is not None:
+        MAX_PENDING = max_pending
+    if max_tunnels is not None:
+        MAX_TUNNELS = max_tunnels
+    if max_per_ip is not None:
+        MAX_TUNNELS_PER_IP = max_per_ip
+    connections = Admission()
@@ -0,0 +1,473 @@
+import os
+import sys
+import time
+import socket
+import struct
+import argparse
+import resource
+import selectors
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import acl
+import socks_parser
+
+
+SOCKS_VERSION = 5
+COMMAND_CONNECT = 1
+USERNAME_PASSWORD = 2
+ADDRESS_TYPE_IPV4 = 1
+ADDRESS_TYPE_DOMAIN = 3
+
+COMMAND_UDP_ASSOCIATE = 3
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "socks_proxy.py")
+UDP_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "udp_server.py")
+UDP_SERVER_ADDRESS = ("127.0.0.1", 12345)
+
+########################################################################################
+# Helpers: a local proxy process, local targets and a minimal SOCKS5 client, so that
+# the benchmarks run on loopback without any outside network.
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on {host}:{port} after {timeout}s")
+
+def start_proxy(port, *extra_args):
+    # Run from a scratch directory so benchmark traffic stays out of the checked-in socks_proxy.log;
+    # stop_proxy() removes it
+    log_dir = tempfile.mkdtemp(prefix="socks_bench_")
+    process = subprocess.Popen(
+        [sys.executable, PROXY_SCRIPT, "--host", "127.0.0.1", "--port", str(port), *extra_args],
+        cwd=log_dir, stdout=subprocess.DEVNULL,
+    )
+    process.log_dir = log_dir
+    try:
+        wait_for_port("127.0.0.1", port)
+    except BaseException:
+        stop_proxy(process)
+        raise
+    return process
+
+def stop_proxy(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    shutil.rmtree(process.log_dir, ignore_errors=True)
+
+def read_process_status(pid):
+    # VmRSS is reported in kB
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                status[key] = int(value.split()[0])
+    return status
+
+def start_echo_server(host="127.0.0.1"):
+    # A single-threaded selector loop, so the target itself adds no per-connection threads
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, 0))
+    listener.listen(1024)
+    listener.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+
+    def serve():
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is listener:
+                    conn, _ = listener.accept()
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:
+                    selector.unregister(conn)
+                    conn.close()
+                    continue
+                conn.setblocking(True)
+                conn.sendall(data)
+                conn.setblocking(False)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def start_udp_echo_server(host="127.0.0.1"):
+    # Sends every datagram straight back; an in-process target on an ephemeral port
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind((host, 0))
+
+    def serve():
+        while True:
+            data, addr = server.recvfrom(65535)
+            server.sendto(data, addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+def start_bulk_server(total_bytes, host="127.0.0.1"):
+    # Streams total_bytes to every client that connects, then closes
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, 0))
+    listener.listen(128)
+    block = memoryview(bytes(1024 * 1024))
+
+    def send_bulk(conn):
+        with conn:
+            remaining = total_bytes
+            while remaining > 0:
+                chunk = block[:min(remaining, len(block))]
+                conn.sendall(chunk)
+                remaining -= len(chunk)
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=send_bulk, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def start_udp_server():
+    process = subprocess.Popen([sys.executable, UDP_SERVER_SCRIPT, "--quiet"], stdout=subprocess.DEVNULL)
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.1)
+    try:
+        for _ in range(100):
+            probe.sendto(b"probe", UDP_SERVER_ADDRESS)
+            try:
+                probe.recvfrom(4096)
+                return process
+            except OSError:
+                pass
+    finally:
+        probe.close()
+    process.kill()
+    raise RuntimeError(f"udp_server.py did not answer on {UDP_SERVER_ADDRESS}")
+
+def drain(sock):
+    buffer = bytearray(1024 * 1024)
+    total = 0
+    while True:
+        received = sock.recv_into(buffer)
+        if not received:
+            return total
+        total += received
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by proxy")
+        data += chunk
+    return data
+
+def address_field(host, port):
+    # ATYP, DST.ADDR, DST.PORT: an IPv4 literal, anything else is sent as a domain name
+    try:
+        return struct.pack("!B", ADDRESS_TYPE_IPV4) + socket.inet_aton(host) + struct.pack("!H", port)
+    except OSError:
+        return struct.pack("!BB", ADDRESS_TYPE_DOMAIN, len(host)) + host.encode() + struct.pack("!H", port)
+
+def recv_reply(sock):
+    # VER, REP, RSV, ATYP, then BND.ADDR/BND.PORT, whose length depends on ATYP
+    reply = recv_exact(sock, 4)
+    if reply[3] == ADDRESS_TYPE_IPV4:
+        return reply + recv_exact(sock, 4 + 2)
+    if reply[3] == ADDRESS_TYPE_DOMAIN:
+        length = recv_exact(sock, 1)
+        return reply + length + recv_exact(sock, length[0] + 2)
+    return reply + recv_exact(sock, 16 + 2)
+
+def socks5_handshake_messages(target_host, target_port, username="user", password="password"):
+    greeting = struct.pack("!BBB", SOCKS_VERSION, 1, USERNAME_PASSWORD)
+    auth = struct.pack("!BB", 1, len(username)) + username.encode() + struct.pack("!B", len(password)) + password.encode()
+    request = struct.pack("!BBB", SOCKS_VERSION, COMMAND_CONNECT, 0) + address_field(target_host, target_port)
+    return greeting, auth, request
+
+def socks5_connect_pipelined(proxy_address, target_host, target_port, username="user", password="password"):
+    # Sends the whole handshake in one segment without waiting for the replies in between
+    sock = socket.create_connection(proxy_address)
+    sock.sendall(b"".join(socks5_handshake_messages(target_host, target_port, username, password)))
+    replies = recv_exact(sock, 2 + 2) + recv_reply(sock)
+    if replies[3] != 0 or replies[5] != 0:
+        sock.close()
+        raise ConnectionError(f"Handshake failed: {replies}")
+    return sock
+
+def socks5_connect(proxy_address, target_host, target_port, username="user", password="password"):
+    sock = socket.create_connection(proxy_address)
+    sock.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, USERNAME_PASSWORD))
+    recv_exact(sock, 2)
+
+    sock.sendall(struct.pack("!BB", 1, len(username)) + username.encode() + struct.pack("!B", len(password)) + password.encode())
+    if recv_exact(sock, 2)[1] != 0:
+        sock.close()
+        raise ConnectionError("Authentication failed")
+
+    sock.sendall(struct.pack("!BBB", SOCKS_VERSION, COMMAND_CONNECT, 0) + address_field(target_host, target_port))
+    reply = recv_reply(sock)
+    if reply[1] != 0:
+        sock.close()
+        raise ConnectionError(f"CONNECT failed with REP {reply[1]}")
+    return sock
+
+def socks5_udp_associate(proxy_address, username="user", password="password"):
+    # Returns the control connection (the association lives as long as it does) and the relay address
+    sock = socket.create_connection(proxy_address)
+    sock.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, USERNAME_PASSWORD))
+    recv_exact(sock, 2)
+
+    sock.sendall(struct.pack("!BB", 1, len(username)) + username.encode() + struct.pack("!B", len(password)) + password.encode())
+    if recv_exact(sock, 2)[1] != 0:
+        sock.close()
+        raise ConnectionError("Authentication failed")
+
+    sock.sendall(struct.pack("!BBBBIH", SOCKS_VERSION, COMMAND_UDP_ASSOCIATE, 0, ADDRESS_TYPE_IPV4, 0, 0))
+    reply = recv_reply(sock)
+    if reply[1] != 0:
+        sock.close()
+        raise ConnectionError(f"UDP ASSOCIATE failed with REP {reply[1]}")
+    return sock, (proxy_address[0], struct.unpack("!H", reply[-2:])[0])
+
+def udp_request_header(host, port):
+    # RSV, FRAG, ATYP, DST.ADDR, DST.PORT
+    return struct.pack("!HBB", 0, 0, ADDRESS_TYPE_IPV4) + socket.inet_aton(host) + struct.pack("!H", port)
+
+########################################################################################
+# Benchmark 1: Concurrent idle tunnels
+# Opens as many CONNECT tunnels as requested (each checked with one echo round trip),
+# holds them open and reports the proxy's RSS and thread count.
+def concurrent_tunnels(args):
+    raise_fd_limit()
+    echo_port = start_echo_server()
+    results = []
+
+    for mode in args.modes:
+        process = start_proxy(args.port, "--mode", mode)
+        idle_status = read_process_status(process.pid)
+        tunnels = []
+        error = None
+        start = time.time()
+        try:
+            for _ in range(args.tunnels):
+                sock = socks5_connect(("127.0.0.1", args.port), "127.0.0.1", echo_port)
+                sock.sendall(b"ping")
+                recv_exact(sock, 4)
+                tunnels.append(sock)
+        except OSError as e:
+            error = str(e)
+        elapsed = time.time() - start
+        time.sleep(0.5) # let the proxy settle before sampling
+        status = read_process_status(process.pid)
+
+        for sock in tunnels:
+            sock.close()
+        stop_proxy(process)
+
+        results.append((mode, len(tunnels), elapsed, idle_status["VmRSS"], status["VmRSS"], status["Threads"], error))
+
+    print(f"{'mode':<8} {'tunnels':>8} {'setup s':>8} {'idle RSS kB':>12} {'RSS kB':>10} {'kB/tunnel':>10} {'threads':>8}", flush=True)
+    for mode, count, elapsed, idle_rss, rss, threads, error in results:
+        per_tunnel = (rss - idle_rss) / count if count else 0
+        print(f"{mode:<8} {count:>8} {elapsed:>8.2f} {idle_rss:>12} {rss:>10} {per_tunnel:>10.1f} {threads:>8}", flush=True)
+        if error:
+            print(f"  {mode}: stopped early: {error}", flush=True)
+
+########################################################################################
+# Benchmark 2: Large transfer throughput
+# Downloads --size-mb from a local bulk server directly and through each relay setup.
+def relay_throughput(args):
+    total_bytes = args.size_mb * 1024 * 1024
+    bulk_port = start_bulk_server(total_bytes)
+    setups = [
+        ("direct", None),
+        ("thread/splice", ["--mode", "thread", "--relay", "auto"]),
+        ("thread/copy", ["--mode", "thread", "--relay", "copy"]),
+        ("asyncio", ["--mode", "asyncio"]),
+    ]
+
+    print(f"{'setup':<14} {'MB':>6} {'seconds':>8} {'MB/s':>8}", flush=True)
+    for name, proxy_args in setups:
+        process = start_proxy(args.port, *proxy_args) if proxy_args else None
+        try:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.time()
+                if process:
+                    sock = socks5_connect(("127.0.0.1", args.port), "127.0.0.1", bulk_port)
+                else:
+                    sock = socket.create_connection(("127.0.0.1", bulk_port))
+                received = drain(sock)
+                timings.append(time.time() - start)
+                sock.close()
+                if received != total_bytes:
+                    print(f"  {name}: short transfer, {received} of {total_bytes} bytes", flush=True)
+        finally:
+            if process:
+                stop_proxy(process)
+        best = min(timings)
+        print(f"{name:<14} {args.size_mb:>6} {best:>8.3f} {args.size_mb / best:>8.1f}", flush=True)
+
+########################################################################################
+# Benchmark 3: UDP ASSOCIATE packets per second
+# Sends --datagrams through the relay to udp_server.py, --window at a time, and counts replies,
+# once per mode and relay batch size.
+def udp_packets_per_second(args):
+    server = start_udp_server()
+    datagram = udp_request_header(*UDP_SERVER_ADDRESS) + b"x" * args.payload
+    setups = [(mode, batch_size) for mode in args.modes for batch_size in args.batch_sizes]
+
+    print(f"{'mode':<8} {'batch':>5} {'sent':>8} {'received':>9} {'loss %':>7} {'seconds':>8} {'pps':>9}", flush=True)
+    try:
+        for mode, batch_size in setups:
+            process = start_proxy(args.port, "--mode", mode, "--udp-batch-size", str(batch_size))
+            control, relay_address = socks5_udp_associate(("127.0.0.1", args.port))
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.settimeout(1)
+            sent = received = 0
+            start = time.time()
+            try:
+                while sent < args.datagrams:
+                    burst = min(args.window, args.datagrams - sent)
+                    for _ in range(burst):
+                        udp_socket.sendto(datagram, relay_address)
+                    sent += burst
+                    for _ in range(burst):
+                        try:
+                            udp_socket.recvfrom(65535)
+                            received += 1
+                        except socket.timeout:
+                            break
+                elapsed = time.time() - start
+            finally:
+                udp_socket.close()
+                control.close()
+                stop_proxy(process)
+            loss = 100 * (sent - received) / sent
+            print(f"{mode:<8} {batch_size:>5} {sent:>8} {received:>9} {loss:>7.2f} {elapsed:>8.2f} {received / elapsed:>9.0f}", flush=True)
+    finally:
+        server.kill()
+        server.wait()
+
+########################################################################################
+# Benchmark 4: Handshakes per second
+# First the parser alone (whole handshake in one piece, then one byte at a time), then full
+# handshake + CONNECT + close round trips through each mode, step by step and pipelined.
+def handshakes_per_second(args):
+    messages = socks5_handshake_messages("127.0.0.1", 80)
+    handshake = b"".join(messages)
+
+    def parse(pieces):
+        parser = socks_parser.Socks5Parser()
+        events = []
+        for piece in pieces:
+            parser.feed(piece)
+            event = parser.next_event()
+            while event is not None:
+                events.append(event)
+                if isinstance(event, socks_parser.Greeting):
+                    parser.select_method(USERNAME_PASSWORD)
+                event = parser.next_event()
+        assert len(events) == 3, events
+
+    print(f"{'parser input':<16} {'handshakes/s':>13}", flush=True)
+    for name, pieces in [("one segment", [handshake]), ("per message", list(messages)),
+                         ("per byte", [handshake[i:i + 1] for i in range(len(handshake))])]:
+        start = time.perf_counter()
+        for _ in range(args.handshakes * 10):
+            parse(pieces)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16} {args.handshakes * 10 / elapsed:>13.0f}", flush=True)
+
+    echo_port = start_echo_server()
+    print(f"\n{'mode':<8} {'client':<10} {'handshakes/s':>13}", flush=True)
+    for mode in args.modes:
+        process = start_proxy(args.port, "--mode", mode)
+        try:
+            for client_name, connect in [("stepwise", socks5_connect), ("pipelined", socks5_connect_pipelined)]:
+                start = time.perf_counter()
+                for _ in range(args.handshakes):
+                    connect(("127.0.0.1", args.port), "127.0.0.1", echo_port).close()
+                elapsed = time.perf_counter() - start
+                print(f"{mode:<8} {client_name:<10} {args.handshakes / elapsed:>13.0f}", flush=True)
+        finally:
+            stop_proxy(process)
+
+def acl_lookups_per_second(args):
+    # Synthetic rule file: args.rules rules, half networks of assorted prefix lengths, half names
+    lines = []
+    for i in range(args.rules):
+        if i % 2:
+            lines.append(("bench", f"deny 10.{i % 256}.{i // 256 % 256}.0/{16 + i % 17} 1-1023"))
+        else:
+            lines.append(("bench", f"{'deny' if i % 4 else 'allow'} .host{i}.example{i % 50}.com 443,8000-8999"))
+    lines.append(("bench", "allow *"))
+    ruleset = acl.Ruleset(lines)
+
+    print(f"{'rules':>6} {'lookup':<22} {'':<8} {'lookups/s':>11} {'ns/lookup':>10}", flush=True)
+    for name, host, port in [("IPv4, deny hit", "10.1.0.7", 80), ("IPv4, no match", "192.0.2.1", 443),
+                             ("name, deep hit", "a.b.host2.example2.com", 443), ("name, no match", "www.example.org", 443)]:
+        for cached, check in [("compiled", ruleset.lookup), ("cached", ruleset.check)]:
+            count = args.handshakes * 100
+            start = time.perf_counter()
+            for _ in range(count):
+                check(host, port, "user")
+            elapsed = time.perf_counter() - start
+            print(f"{ruleset.size:>6} {name:<22} {cached:<8} {count / elapsed:>11.0f} {elapsed / count * 1e9:>10.0f}", flush=True)
+
+########################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Run proxy benchmarks against local loopback targets")
+    parser.add_argument("benchmark", choices=["tunnels", "throughput", "udp", "handshake", "acl"], help="Benchmark to run")
+    parser.add_argument("--port", type=int, default=11080, help="Port for the proxy under test")
+    parser.add_argument("--modes", nargs="+", default=["thread", "asyncio"], help="Proxy serving modes to compare")
+    parser.add_argument("--tunnels", type=int, default=1000, help="Number of concurrent tunnels to open")
+    parser.add_argument("--size-mb", type=int, default=100, help="Transfer size for the throughput benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Transfers per setup, the best one is reported")
+    parser.add_argument("--datagrams", type=int, default=20000, help="Datagrams to send in the UDP benchmark")
+    parser.add_argument("--window", type=int, default=32, help="Datagrams in flight in the UDP benchmark")
+    parser.add_argument("--payload", type=int, default=64, help="UDP payload size in bytes")
+    parser.add_argument("--handshakes", type=int, default=2000, help="Proxy round trips in the handshake benchmark")
+    parser.add_argument("--rules", type=int, default=5000, help="Rules in the synthetic rule file of the acl benchmark")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32], help="Proxy --udp-batch-size values to compare")
+    args = parser.parse_args()
+
+    benchmarks = {
+        "tunnels": concurrent_tunnels,
+        "throughput": relay_throughput,
+        "udp": udp_packets_per_second,
+        "handshake": handshakes_per_second,
+        "acl": acl_lookups_per_second,
+    }
+    benchmarks[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
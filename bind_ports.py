@@ -0,0 +1,150 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc1928#section-6
+import socket
+import logging
+import threading
+from collections import deque
+
+# Ports BIND requests listen on, e.g. range(40000, 40100); None lets the OS pick a fresh port per request
+PORT_RANGE = None
+# Seconds a BIND waits for the incoming connection before the client gets REP 6 (TTL expired)
+ACCEPT_TIMEOUT = 60
+# Connections each BIND listener queues; one is taken and the rest are surplus
+LISTEN_BACKLOG = 4
+
+def parse_range(text):
+    """LOW-HIGH (or one port) from --bind-ports, as a range."""
+    low, _, high = text.partition("-")
+    low, high = int(low), int(high or low)
+    if not 1 <= low <= high <= 65535:
+        raise ValueError(f"bad port range {text}")
+    return range(low, high + 1)
+
+def open_listener(port=0):
+    # Dual-stack where there is IPv6, so the peer a client names can connect over either family
+    family = socket.AF_INET6 if socket.has_ipv6 else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_INET6:
+            listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("::" if family == socket.AF_INET6 else "0.0.0.0", port))
+        listener.listen(LISTEN_BACKLOG)
+        listener.setblocking(False)
+    except BaseException:
+        listener.close()
+        raise
+    return listener
+
+def discard_pending(listener):
+    # Connections that queued on a listener while it was not lent out were meant for nobody; returns how many
+    discarded = 0
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return discarded
+        except OSError:
+            return discarded # e.g. ECONNABORTED: the peer is already gone
+        conn.close()
+        discarded += 1
+
+class PortPool:
+    """
+    Listening sockets for BIND, bound and listening on every port of a
+    range once at startup and lent to one request at a time, so a BIND
+    costs no bind() or listen() and the ports it can hand out are the
+    ones the firewall was opened for. The socket goes back to the pool as
+    soon as its connection is accepted (the accepted socket is separate),
+    or when the request fails or times out. Free sockets are reused
+    oldest-first, so a port rests as long as possible before it is lent
+    again; a late connection meant for its previous request is dropped
+    when it is next lent. Ports that could not be bound (taken by another
+    process, e.g. the one still draining after a handoff) are tried again
+    whenever the pool runs dry.
+    """
+
+    def __init__(self, ports):
+        self.free = deque()
+        self.owned = set()
+        self.missing = []
+        self.lock = threading.Lock()
+        self.leased = 0
+        self.acquired = 0
+        self.exhausted = 0
+        self.stale = 0
+        for port in ports:
+            self.add(port)
+        if self.missing:
+            logging.warning(f"Could not bind {len(self.missing)} BIND ports (e.g. {self.missing[0]}), will retry")
+
+    def add(self, port):
+        # Called with the lock held, or before the pool is shared
+        try:
+            listener = open_listener(port)
+        except OSError:
+            self.missing.append(port)
+            return False
+        self.free.append(listener)
+        self.owned.add(listener)
+        return True
+
+    def acquire(self):
+        """A listening socket, or None if every port is lent out."""
+        with self.lock:
+            if not self.free and self.missing:
+                missing, self.missing = self.missing, []
+                for port in missing:
+                    self.add(port)
+            if not self.free:
+                self.exhausted += 1
+                return None
+            listener = self.free.popleft()
+            self.leased += 1
+            self.acquired += 1
+        stale = discard_pending(listener)
+        if stale:
+            with self.lock:
+                self.stale += stale
+        return listener
+
+    def release(self, listener):
+        with self.lock:
+            self.leased -= 1
+            self.free.append(listener)
+
+    def stats(self):
+        with self.lock:
+            return {"ports": len(self.owned), "leased": self.leased, "acquired": self.acquired,
+                    "exhausted": self.exhausted, "stale": self.stale}
+
+pool = None
+
+def configure(port_range=None, accept_timeout=None):
+    global PORT_RANGE, ACCEPT_TIMEOUT
+    PORT_RANGE = port_range
+    if accept_timeout is not None:
+        ACCEPT_TIMEOUT = accept_timeout
+
+def start(worker_index=0, workers=1):
+    # After fork: each prefork worker binds its own share of the range, so no port is lent twice
+    global pool
+    if PORT_RANGE is not None:
+        pool = PortPool(PORT_RANGE[worker_index::workers])
+        logging.info(f"Listening on {len(pool.owned)} BIND ports")
+
+def acquire():
+    """A non-blocking listening socket for one BIND, None if the pool is exhausted. Hand it back with release()."""
+    if pool is None:
+        return open_listener()
+    return pool.acquire()
+
+def release(listener):
+    if pool is not None and listener in pool.owned:
+        pool.release(listener)
+    else:
+        listener.close()
+
+def stats():
+    if pool is None:
+        return {"ports": 0, "leased": 0, "acquired": 0, "exhausted": 0, "stale": 0}
+    return pool.stats()
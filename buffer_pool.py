@@ -0,0 +1,89 @@
+import threading
+
+# Buffer sizes handed out; a request is rounded up to the next one
+SIZE_CLASSES = (4096, 16384, 65536, 262144)
+# Each class grows by carving a slab of this size (or one buffer, if bigger) into buffers
+SLAB_SIZE = 1024 * 1024
+# Bytes of slabs all classes together may hold; past it acquire() falls back to buffers that are not kept
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+class BufferPool:
+    """
+    Receive buffers for the relays, cut from preallocated bytearray slabs
+    and handed out as memoryviews, so a connection gets its buffer without
+    an allocation and gives it back for the next one instead of leaving it
+    to the garbage collector. Free buffers are reused last-in first-out,
+    which keeps the ones still in the CPU cache busy. Slabs are never
+    freed: the pool only grows to the peak it has seen, at most `limit`
+    bytes; beyond that acquire() still works but allocates a one-off
+    buffer (counted as overflow).
+    """
+
+    def __init__(self, limit=None, slab_size=None):
+        self.limit = MEMORY_LIMIT if limit is None else limit
+        self.slab_size = SLAB_SIZE if slab_size is None else slab_size
+        self.free = {size: [] for size in SIZE_CLASSES}
+        self.slabs = set() # id() of every slab, to tell pooled buffers from one-off ones
+        self.allocated = 0
+        self.in_use = {size: 0 for size in SIZE_CLASSES}
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.overflow = 0
+
+    def size_class(self, size):
+        for size_class in SIZE_CLASSES:
+            if size <= size_class:
+                return size_class
+        return None
+
+    def grow(self, size):
+        # Called with the lock held; False once the memory limit is reached
+        slab_size = max(size, self.slab_size // size * size)
+        if self.allocated + slab_size > self.limit:
+            return False
+        slab = bytearray(slab_size)
+        self.slabs.add(id(slab))
+        self.allocated += slab_size
+        view = memoryview(slab)
+        self.free[size].extend(view[offset:offset + size] for offset in range(0, slab_size, size))
+        return True
+
+    def acquire(self, size):
+        """A writable memoryview of at least `size` bytes; hand it back with release()."""
+        size_class = self.size_class(size)
+        with self.lock:
+            self.acquired += 1
+            if size_class is not None and (self.free[size_class] or self.grow(size_class)):
+                self.in_use[size_class] += 1
+                return self.free[size_class].pop()
+            self.overflow += 1
+        return memoryview(bytearray(size))
+
+    def release(self, buffer):
+        if id(buffer.obj) not in self.slabs:
+            return # a one-off buffer, left to the garbage collector
+        with self.lock:
+            self.in_use[len(buffer)] -= 1
+            self.free[len(buffer)].append(buffer)
+
+    def stats(self):
+        with self.lock:
+            return {"allocated": self.allocated, "limit": self.limit, "acquired": self.acquired, "overflow": self.overflow,
+                    "in_use": {size: count * size for size, count in self.in_use.items()}}
+
+pool = BufferPool()
+
+def configure(limit=None, slab_size=None):
+    global MEMORY_LIMIT, pool
+    if limit is not None:
+        MEMORY_LIMIT = limit
+    pool = BufferPool(slab_size=slab_size)
+
+def acquire(size):
+    return pool.acquire(size)
+
+def release(buffer):
+    pool.release(buffer)
+
+def stats():
+    return pool.stats()
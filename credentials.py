@@ -0,0 +1,279 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc1929
+import os
+import hmac
+import time
+import base64
+import getpass
+import hashlib
+import logging
+import argparse
+import threading
+from collections import Counter, OrderedDict
+
+# Credential file format, one user per line, '#' starts a comment:
+#
+#     username:scrypt$<n>$<r>$<p>$<salt>$<hash>
+#     username:pbkdf2_sha256$<iterations>$<salt>$<hash>
+#
+# salt and hash are base64. Lines are written by `python3 credentials.py FILE USERNAME`.
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_SIZE = 16
+
+# Successful verifications are remembered for CACHE_TTL seconds so a client that reconnects
+# doesn't pay for the KDF again; at most CACHE_SIZE of them
+CACHE_SIZE = 4096
+CACHE_TTL = 300
+# How often verify() looks at the file's mtime to pick up edits
+RELOAD_CHECK_INTERVAL = 2
+
+def b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+def hash_password(password, scheme="scrypt"):
+    salt = os.urandom(SALT_SIZE)
+    if scheme == "scrypt":
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${b64(salt)}${b64(digest)}"
+    if scheme == "pbkdf2_sha256":
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${b64(salt)}${b64(digest)}"
+    raise ValueError(f"Unknown password scheme {scheme}")
+
+def check_password(password, encoded):
+    scheme, *fields = encoded.split("$")
+    if scheme == "scrypt":
+        n, r, p, salt, expected = fields
+        expected = base64.b64decode(expected)
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                                maxmem=256 * int(n) * int(r) * int(p), dklen=len(expected))
+    elif scheme == "pbkdf2_sha256":
+        iterations, salt, expected = fields
+        expected = base64.b64decode(expected)
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(salt), int(iterations), len(expected))
+    else:
+        raise ValueError(f"Unknown password scheme {scheme}")
+    return hmac.compare_digest(digest, expected)
+
+def hash_like(password, encoded):
+    # `password` hashed with the scheme, parameters and digest length of the stored hash `encoded`
+    scheme, *fields = encoded.split("$")
+    salt = os.urandom(SALT_SIZE)
+    if scheme == "scrypt":
+        n, r, p, _, expected = fields
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=int(n), r=int(r), p=int(p),
+                                maxmem=256 * int(n) * int(r) * int(p), dklen=len(base64.b64decode(expected)))
+        return f"scrypt${n}${r}${p}${b64(salt)}${b64(digest)}"
+    if scheme == "pbkdf2_sha256":
+        iterations, _, expected = fields
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, int(iterations), len(base64.b64decode(expected)))
+        return f"pbkdf2_sha256${iterations}${b64(salt)}${b64(digest)}"
+    raise ValueError(f"Unknown password scheme {scheme}")
+
+def hash_shape(encoded):
+    # Scheme and parameters without the salt, plus the digest length: hashes of one shape cost the same to check
+    *head, _, digest = encoded.split("$")
+    return (*head, len(digest))
+
+def load_file(path):
+    users = {}
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            username, sep, encoded = line.partition(":")
+            if not sep or encoded.split("$", 1)[0] not in ("scrypt", "pbkdf2_sha256"):
+                logging.error(f"{path}:{line_number}: not a username:hash line, skipped")
+                continue
+            users[username] = encoded
+    return users
+
+class CredentialStore:
+    """
+    Username -> password hash index loaded from a credential file, with a
+    small cache of recent successful verifications. The cache is keyed by
+    an HMAC of the password under a per-process random key (never the
+    password itself) and by the stored hash, so changing a user's password
+    in the file invalidates it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.users = {}
+        self.mtime = None
+        self.next_reload_check = 0
+        self.cache = OrderedDict() # (username, stored hash, password hmac) -> expires
+        self.dummy = None # see dummy_hash()
+        self.cache_key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.verifications = 0
+        self.failures = 0
+        self.reload()
+
+    def reload(self):
+        """Re-read the credential file; the old users stay in effect if that fails."""
+        if self.path is None:
+            # No file configured: the single account the proxy always had
+            if not self.users:
+                self.users = {"user": hash_password("password")}
+                self.dummy = None
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+            users = load_file(self.path)
+        except OSError as e:
+            logging.error(f"Could not load credentials from {self.path}: {e}")
+            return
+        with self.lock:
+            self.users = users # one reference swap, verify() never sees half a file
+            self.mtime = mtime
+            self.cache.clear()
+            self.dummy = None
+        logging.info(f"Loaded {len(users)} users from {self.path}")
+
+    def dummy_hash(self):
+        """
+        What an unknown username's password is checked against, so failing
+        takes as long as a wrong password for a real user: a hash of the
+        shape most users in the file have. Made on the first unknown user
+        after each reload, in verify(), so never on an event loop.
+        """
+        dummy = self.dummy
+        if dummy is None:
+            users = self.users
+            shapes = Counter(hash_shape(encoded) for encoded in users.values())
+            shape = shapes.most_common(1)[0][0] if shapes else None
+            sample = next((encoded for encoded in users.values() if hash_shape(encoded) == shape), None)
+            try:
+                dummy = hash_like(b64(os.urandom(SALT_SIZE)), sample)
+            except (ValueError, TypeError, AttributeError): # no users, or a malformed line; verify() logs those
+                dummy = hash_password(b64(os.urandom(SALT_SIZE)))
+            with self.lock:
+                if self.users is users:
+                    self.dummy = dummy
+        return dummy
+
+    def reload_due(self):
+        return self.path is not None and time.monotonic() >= self.next_reload_check
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self.path is None or now < self.next_reload_check:
+            return
+        self.next_reload_check = now + RELOAD_CHECK_INTERVAL
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                self.reload()
+        except OSError:
+            pass
+
+    def cache_entry(self, username, password):
+        encoded = self.users.get(username)
+        if encoded is None:
+            return None
+        return (username, encoded, hmac.new(self.cache_key, password.encode("utf-8"), hashlib.sha256).digest())
+
+    def is_cached(self, username, password):
+        """
+        True if this username/password verified recently; cheap enough to
+        call on an event loop, as it never touches the file. While a check
+        of the file is due it says False, so the caller goes on to verify(),
+        which does the check off the loop.
+        """
+        if self.reload_due():
+            return False
+        return self.cached(username, password)
+
+    def cached(self, username, password):
+        key = self.cache_entry(username, password)
+        if key is None:
+            return False
+        with self.lock:
+            expires = self.cache.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.cache[key]
+                return False
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return True
+
+    def verify(self, username, password):
+        self.maybe_reload()
+        if self.cached(username, password):
+            return True
+        key = self.cache_entry(username, password)
+        if key is None:
+            check_password(password, self.dummy_hash()) # same KDF time as a known user, no username enumeration
+            with self.lock:
+                self.failures += 1
+            return False
+
+        try:
+            valid = check_password(password, key[1])
+        except (ValueError, TypeError) as e:
+            logging.error(f"Bad password hash for user {username}: {e}")
+            valid = False
+
+        with self.lock:
+            self.verifications += 1
+            if not valid:
+                self.failures += 1
+                return False
+            self.cache[key] = time.monotonic() + CACHE_TTL
+            self.cache.move_to_end(key)
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "users": len(self.users),
+                "cached": len(self.cache),
+                "cache_hits": self.cache_hits,
+                "verifications": self.verifications,
+                "failures": self.failures,
+            }
+
+store = None
+
+def configure(path):
+    global store
+    store = CredentialStore(path)
+
+def get_store():
+    if store is None:
+        configure(None)
+    return store
+
+def set_password(path, username, password, scheme):
+    # Rewrites the file with the user's line replaced (or appended), via a rename so readers never see it half written
+    lines = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            lines = [line for line in f if line.split(":", 1)[0].strip() != username]
+    lines.append(f"{username}:{hash_password(password, scheme)}\n")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    os.replace(temp_path, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add a user to (or change a password in) a credential file")
+    parser.add_argument("file", help="Credential file, created if missing")
+    parser.add_argument("username")
+    parser.add_argument("--scheme", choices=["scrypt", "pbkdf2_sha256"], default="scrypt")
+    args = parser.parse_args()
+
+    password = getpass.getpass(f"Password for {args.username}: ")
+    if password != getpass.getpass("Again: "):
+        raise SystemExit("Passwords don't match")
+    set_password(args.file, args.username, password, args.scheme)
+    print(f"Saved {args.username} to {args.file}")
@@ -0,0 +1,148 @@
+import time
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# getaddrinfo/gethostbyname errors that mean "this name does not exist" rather than
+# "the resolver is having trouble"; only these are cached as negative answers
+NEGATIVE_ERRNOS = {socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)}
+
+class DNSCache:
+    """
+    Bounded LRU cache of resolver answers.
+
+    The system resolver doesn't tell us the record TTL, so positive answers
+    live for a fixed `ttl` and NXDOMAIN-style failures for `negative_ttl`.
+    Lookups of a name that is already being resolved wait for that
+    resolution instead of starting their own.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict() # name -> (expires, answer, error)
+        self.in_flight = {} # name -> Future
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def lookup(self, name, resolver):
+        """
+        Return resolver(name), from the cache when possible. Cached negative
+        answers are raised again as the original socket.gaierror.
+        """
+        key, future, owner = self.begin(name)
+        if owner:
+            self.resolve(key, name, resolver, future)
+        return future.result()
+
+    def lookup_async(self, name, resolver, executor):
+        """
+        Like lookup(), but returns a concurrent.futures.Future right away and
+        runs a cache miss on `executor`.
+        """
+        key, future, owner = self.begin(name)
+        if owner:
+            executor.submit(self.resolve, key, name, resolver, future)
+        return future
+
+    def begin(self, name):
+        # Returns (key, future, owner); the owner is the one caller that has to run the resolver
+        key = name.lower().rstrip(".")
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, answer, error = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    future = Future()
+                    if error is not None:
+                        self.negative_hits += 1
+                        future.set_exception(socket.gaierror(error.errno, error.strerror))
+                    else:
+                        self.hits += 1
+                        future.set_result(answer)
+                    return key, future, False
+                del self.entries[key]
+
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return key, future, False
+            future = self.in_flight[key] = Future()
+            self.misses += 1
+            return key, future, True
+
+    def resolve(self, key, name, resolver, future):
+        try:
+            answer = resolver(name)
+        except socket.gaierror as e:
+            self.store(key, None, e, self.negative_ttl if e.errno in NEGATIVE_ERRNOS else 0)
+            future.set_exception(e)
+            return
+        except BaseException as e:
+            self.store(key, None, e, 0)
+            future.set_exception(e)
+            return
+        self.store(key, answer, None, self.ttl)
+        future.set_result(answer)
+
+    def store(self, key, answer, error, ttl):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if ttl <= 0 or self.max_size <= 0:
+                return
+            self.entries[key] = (time.monotonic() + ttl, answer, error)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "evictions": self.evictions,
+            }
+
+# Seconds a handler waits for an answer before failing the request. A slow lookup keeps
+# its pool thread, but not the handler.
+RESOLVE_TIMEOUT = 5
+
+# Shared by every handler thread (and by every coroutine in asyncio mode)
+cache = DNSCache()
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="resolver")
+
+def configure(max_size, ttl, negative_ttl, threads, timeout):
+    global executor, RESOLVE_TIMEOUT
+    cache.max_size = max_size
+    cache.ttl = ttl
+    cache.negative_ttl = negative_ttl
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="resolver")
+    RESOLVE_TIMEOUT = timeout
+
+def getaddrinfo(domain):
+    """All A and AAAA records of domain as (family, address) pairs, in resolver order."""
+    addresses = []
+    for family, _, _, _, sockaddr in socket.getaddrinfo(domain, None, type=socket.SOCK_STREAM):
+        if family in (socket.AF_INET, socket.AF_INET6) and (family, sockaddr[0]) not in addresses:
+            addresses.append((family, sockaddr[0]))
+    return addresses
+
+def resolve(domain):
+    """Future of getaddrinfo(domain), answered from the cache or the resolver pool."""
+    return cache.lookup_async(domain, getaddrinfo, executor)
@@ -0,0 +1,81 @@
+# ref : https://docs.python.org/3/library/socket.html#socket.send_fds
+import os
+import socket
+import logging
+import threading
+
+# Seconds a process handing over its listener waits for the new one to say it is accepting; it keeps serving if not
+READY_TIMEOUT = 10
+
+def take_over(path):
+    """
+    The listening socket of the process serving at the Unix socket `path`,
+    and the control connection to it, or None if no process is there.
+    The old process keeps accepting until ready() is called on the control
+    connection, so connections keep being taken while this one starts.
+    """
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        control.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        control.close() # nothing there, or a stale socket file from a process that has exited
+        return None
+    control.settimeout(READY_TIMEOUT)
+    try:
+        _, fds, _, _ = socket.recv_fds(control, 64, 1)
+        if not fds:
+            raise ConnectionError(f"{path} sent no listener")
+    except BaseException:
+        control.close()
+        raise
+    return socket.socket(fileno=fds[0]), control
+
+def ready(control):
+    # Past this the old process stops accepting and drains
+    try:
+        control.sendall(b"ready")
+    finally:
+        control.close()
+
+class HandoffServer:
+    """
+    Waits on a Unix socket for the next process to start, hands it
+    `listener` (SCM_RIGHTS, so both processes share one socket and its
+    accept queue: no port is ever unbound and no queued SYN is lost), and
+    once the new process confirms it is accepting calls on_handoff(),
+    which makes this process stop accepting and drain. A new process that
+    fails before confirming leaves this one serving.
+    """
+
+    def __init__(self, path, listener, on_handoff):
+        self.path = path
+        self.listener = listener
+        self.on_handoff = on_handoff
+        self.sock = None
+
+    def start(self):
+        try:
+            os.unlink(self.path) # the previous process's socket file; that process already has its connection
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        threading.Thread(target=self.run, name="handoff", daemon=True).start()
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with conn:
+                conn.settimeout(READY_TIMEOUT)
+                try:
+                    socket.send_fds(conn, [b"listener"], [self.listener.fileno()])
+                    if conn.recv(16) != b"ready":
+                        raise ConnectionError("new process exited before it was accepting")
+                except OSError as e:
+                    logging.error(f"Listener handoff failed, still serving: {e}")
+                    continue
+            logging.info("Listener handed over to the new process")
+            self.sock.close() # the path now belongs to the new process
+            self.on_handoff()
+            return
@@ -0,0 +1,125 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc8305
+import time
+import errno
+import socket
+import select
+import asyncio
+
+# RFC 8305 section 5: recommended Connection Attempt Delay
+ATTEMPT_DELAY = 0.25
+CONNECT_TIMEOUT = 10
+
+def interleave(addresses):
+    """
+    Order (family, address) pairs the RFC 8305 way: alternate address
+    families, starting with the family of the first answer.
+    """
+    by_family = {}
+    for family, address in addresses:
+        by_family.setdefault(family, []).append((family, address))
+    queues = list(by_family.values())
+    ordered = []
+    while queues:
+        for queue in list(queues):
+            ordered.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return ordered
+
+def connect(addresses, port, attempt_delay=ATTEMPT_DELAY, timeout=None):
+    """
+    Connect to the first of `addresses` that answers. A new attempt starts
+    every `attempt_delay` seconds (or as soon as the previous one fails)
+    while earlier attempts keep running, so a dead first address doesn't
+    stall the tunnel. Returns a connected blocking socket.
+    """
+    timeout = CONNECT_TIMEOUT if timeout is None else timeout
+    remaining = interleave(addresses)
+    poller = select.poll()
+    pending = {} # fd -> socket
+    last_error = None
+    deadline = time.monotonic() + timeout
+    next_attempt = 0
+
+    try:
+        while remaining or pending:
+            now = time.monotonic()
+            if now >= deadline:
+                raise TimeoutError(f"Connecting to port {port} timed out")
+
+            if remaining and (now >= next_attempt or not pending):
+                family, address = remaining.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                error = sock.connect_ex((address, port))
+                if error not in (0, errno.EINPROGRESS):
+                    sock.close()
+                    last_error = OSError(error, f"{address}: {errno.errorcode.get(error, error)}")
+                    continue
+                pending[sock.fileno()] = sock
+                poller.register(sock, select.POLLOUT)
+                next_attempt = now + attempt_delay
+                continue
+
+            wait_until = min(deadline, next_attempt) if remaining else deadline
+            for fd, _ in poller.poll(max(0, wait_until - now) * 1000):
+                sock = pending.pop(fd)
+                poller.unregister(fd)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    sock.setblocking(True)
+                    return sock
+                sock.close()
+                last_error = OSError(error, f"{sock.family.name}: {errno.errorcode.get(error, error)}")
+                next_attempt = 0 # a failure starts the next attempt right away
+    finally:
+        for sock in pending.values():
+            sock.close()
+
+    raise last_error or OSError(errno.EHOSTUNREACH, "No addresses to connect to")
+
+async def connect_async(addresses, port, attempt_delay=ATTEMPT_DELAY, timeout=None):
+    """connect() for the asyncio engine, returns a connected non-blocking socket."""
+    timeout = CONNECT_TIMEOUT if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+
+    async def attempt(family, address):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (address, port))
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+
+    remaining = interleave(addresses)
+    pending = set()
+    last_error = None
+    try:
+        async with asyncio.timeout(timeout):
+            while remaining or pending:
+                if remaining:
+                    pending.add(asyncio.create_task(attempt(*remaining.pop(0))))
+                done, pending = await asyncio.wait(pending, timeout=attempt_delay if remaining else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result().close()
+                if winner is not None:
+                    return winner
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for result in results:
+                if isinstance(result, socket.socket):
+                    result.close()
+
+    raise last_error or OSError(errno.EHOSTUNREACH, "No addresses to connect to")
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import mmap
+import time
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+# Bytes of log each worker process scans at a time
+CHUNK_SIZE = 64 * 1024 * 1024
+# Width of the connection rate buckets, in seconds
+BUCKET = 60
+
+# The phases log_pipeline.ConnectionSummary times, in handshake order, as <phase>_ms fields
+PHASES = ("greeting", "auth", "request", "resolve", "connect", "bind", "udp", "relay")
+# Phases from accept to the reply of a CONNECT
+HANDSHAKE_PHASES = ("greeting", "auth", "request", "resolve", "connect")
+# Statuses the report lists first, in this order; any others follow, most common first
+OUTCOMES = ("ok", "auth_failed", "dns_failed", "connect_failed", "denied", "handshake_timeout")
+
+def new_stats():
+    return {
+        "bytes": 0, "lines": 0, "skipped": 0, "first": None, "last": None, "bytes_up": 0, "bytes_down": 0,
+        "destinations": Counter(), "dns_errors": Counter(), "rate": Counter(), "commands": Counter(),
+        "outcomes": Counter(), "close_reasons": Counter(), "clients": Counter(), "failing_clients": Counter(),
+        "failed_users": Counter(), "handshake_ms": Counter(), "phase_ms": Counter(), # (phase, ms) -> count
+    }
+
+def merge_stats(total, part):
+    for key in ("bytes", "lines", "skipped", "bytes_up", "bytes_down"):
+        total[key] += part[key]
+    if part["first"] is not None:
+        total["first"] = part["first"] if total["first"] is None else min(total["first"], part["first"])
+        total["last"] = part["last"] if total["last"] is None else max(total["last"], part["last"])
+    for key, value in part.items():
+        if isinstance(value, Counter):
+            total[key].update(value)
+
+def line_bounds(mm, start, end):
+    # A chunk owns the lines that start inside [start, end)
+    if start:
+        start = mm.find(b"\n", start - 1) + 1 or len(mm)
+    if end < len(mm):
+        end = mm.find(b"\n", end - 1) + 1 or len(mm)
+    return start, end
+
+def host(target):
+    # "example.com:443" or "[::1]:80" -> the host part
+    return target.rpartition(":")[0].strip("[]") or target
+
+def add_record(stats, record, bucket):
+    started = record["time"]
+    if stats["first"] is None or started < stats["first"]:
+        stats["first"] = started
+    if stats["last"] is None or started > stats["last"]:
+        stats["last"] = started
+    stats["rate"][int(started) // bucket * bucket] += 1
+
+    status = record.get("status", "closed")
+    command = record.get("command")
+    target = record.get("target")
+    client = (record.get("client") or "?").rpartition(":")[0] or "?"
+    stats["outcomes"][status] += 1
+    stats["clients"][client] += 1
+    if command is not None:
+        stats["commands"][command] += 1
+    if target and command != "udp_associate":
+        stats["destinations"][host(target)] += 1
+    if "close_reason" in record:
+        stats["close_reasons"][record["close_reason"]] += 1
+    stats["bytes_up"] += record.get("bytes_up", 0)
+    stats["bytes_down"] += record.get("bytes_down", 0)
+
+    if status != "ok":
+        stats["failing_clients"][client] += 1
+    if status == "auth_failed":
+        stats["failed_users"][record.get("user") or "?"] += 1
+    elif status == "dns_failed" and target:
+        stats["dns_errors"][host(target)] += 1
+
+    phase_ms = stats["phase_ms"]
+    for phase in PHASES:
+        ms = record.get(f"{phase}_ms")
+        if ms is not None:
+            phase_ms[phase, int(ms)] += 1
+    if status == "ok" and command == "connect":
+        stats["handshake_ms"][int(sum(record.get(f"{phase}_ms", 0) for phase in HANDSHAKE_PHASES))] += 1
+
+def analyze_chunk(task):
+    """
+    Scan one chunk of one file; runs in a worker process. Every line is a
+    whole connection (log_pipeline.ConnectionSummary), so a chunk's stats
+    don't depend on any other chunk's.
+    """
+    path, start, end, bucket = task
+    stats = new_stats()
+    loads = json.loads
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        start, end = line_bounds(mm, start, end)
+        stats["bytes"] = end - start
+        mm.seek(start)
+        readline = mm.readline # one line at a time out of the mapping, the chunk is never copied whole
+        while mm.tell() < end:
+            line = readline()
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+                add_record(stats, record, bucket)
+            except (ValueError, KeyError, TypeError):
+                stats["skipped"] += 1 # e.g. the last line of a file still being written
+                continue
+            stats["lines"] += 1
+    return stats
+
+def chunk_tasks(paths, chunk_size, bucket):
+    tasks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        tasks.extend((path, start, min(start + chunk_size, size), bucket) for start in range(0, size, chunk_size))
+    return tasks
+
+def analyze(paths, workers=None, chunk_size=CHUNK_SIZE, bucket=BUCKET):
+    """
+    Scan the connection logs in parallel chunks, one chunk per task, each
+    worker mmap()ing the file so only the page cache holds it, and add up
+    what the chunks found.
+    """
+    tasks = chunk_tasks(paths, chunk_size, bucket)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        with Pool(workers) as pool:
+            return combine(pool.imap_unordered(analyze_chunk, tasks))
+    return combine(map(analyze_chunk, tasks))
+
+def combine(results):
+    total = new_stats()
+    for stats in results:
+        merge_stats(total, stats)
+    return total
+
+def percentile(histogram, p):
+    count = sum(histogram.values())
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if seen * 100 >= count * p:
+            return value
+    return None
+
+def phase_histograms(stats):
+    histograms = {}
+    for (phase, ms), count in stats["phase_ms"].items():
+        histograms.setdefault(phase, Counter())[ms] = count
+    return {phase: histograms[phase] for phase in PHASES if phase in histograms}
+
+def ordered_outcomes(stats):
+    outcomes = stats["outcomes"]
+    rest = [status for status, _ in outcomes.most_common() if status not in OUTCOMES]
+    return [(status, outcomes[status]) for status in (*OUTCOMES, *rest) if outcomes[status]]
+
+def report(stats, top, bucket, elapsed):
+    def when(epoch):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+    def ranking(title, counter):
+        print(f"{title}:")
+        for name, count in counter.most_common(top):
+            print(f"  {count:>9}  {name}")
+
+    def latencies(histogram):
+        return ", ".join(f"p{p} {percentile(histogram, p)} ms" for p in (50, 90, 99))
+
+    megabytes = stats["bytes"] / 1024 / 1024
+    print(f"Scanned {megabytes:.1f} MB, {stats['lines']} connections in {elapsed:.2f} s ({megabytes / elapsed if elapsed else 0:.0f} MB/s)"
+          + (f", {stats['skipped']} unreadable lines skipped" if stats["skipped"] else ""))
+    if stats["first"] is None:
+        return
+    print(f"Period: {when(stats['first'])} - {when(stats['last'])}")
+    print(f"Connections: {stats['lines']} ({', '.join(f'{status} {count}' for status, count in ordered_outcomes(stats))})")
+    print(f"Commands: {', '.join(f'{command} {count}' for command, count in stats['commands'].most_common())}")
+    print(f"Closed by: {', '.join(f'{reason} {count}' for reason, count in stats['close_reasons'].most_common())}")
+    print(f"Relayed: {stats['bytes_up']} bytes up, {stats['bytes_down']} bytes down")
+    if stats["handshake_ms"]:
+        print(f"Accept to connect: {latencies(stats['handshake_ms'])}")
+    for phase, histogram in phase_histograms(stats).items():
+        print(f"  {phase:<9} {latencies(histogram)}")
+    ranking("Top destinations", stats["destinations"])
+    ranking("Top clients", stats["clients"])
+    ranking("Clients with failed connections", stats["failing_clients"])
+    print(f"Auth failures: {stats['outcomes']['auth_failed']}")
+    ranking("  by username", stats["failed_users"])
+    print(f"DNS errors: {sum(stats['dns_errors'].values())}")
+    ranking("  by name", stats["dns_errors"])
+    print(f"Connections per {bucket} s:")
+    peak = max(stats["rate"].values(), default=0)
+    for start in sorted(stats["rate"]):
+        count = stats["rate"][start]
+        print(f"  {when(start)}  {count:>7}  {'#' * max(1, count * 50 // peak)}")
+
+def as_json(stats, top):
+    result = {key: value for key, value in stats.items() if not isinstance(value, Counter)}
+    for key in ("destinations", "dns_errors", "clients", "failing_clients", "failed_users"):
+        result[key] = stats[key].most_common(top)
+    for key in ("outcomes", "commands", "close_reasons"):
+        result[key] = dict(stats[key])
+    result["handshake_ms"] = {f"p{p}": percentile(stats["handshake_ms"], p) for p in (50, 90, 99)}
+    result["phase_ms"] = {phase: {f"p{p}": percentile(histogram, p) for p in (50, 90, 99)}
+                          for phase, histogram in phase_histograms(stats).items()}
+    result["rate"] = sorted(stats["rate"].items())
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize socks_proxy.jsonl connection logs: outcomes, destinations, "
+                                                 "failures, phase latencies and connection rate")
+    parser.add_argument("logs", nargs="+", help="Connection logs (--connection-log), rotated and per-worker ones included")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes scanning chunks in parallel")
+    parser.add_argument("--chunk-mb", type=int, default=CHUNK_SIZE // 1024 // 1024, help="Megabytes per chunk")
+    parser.add_argument("--bucket", type=int, default=BUCKET, help="Seconds per connection rate bucket")
+    parser.add_argument("--top", type=int, default=10, help="Entries in each top list")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verify", action="store_true",
+                        help="Also scan each file as one chunk in this process and fail if the results differ")
+    args = parser.parse_args()
+
+    paths = [path for path in args.logs if os.path.getsize(path)]
+    started = time.perf_counter()
+    stats = analyze(paths, args.workers, args.chunk_mb * 1024 * 1024, args.bucket)
+    elapsed = time.perf_counter() - started
+    if args.verify and stats != analyze(paths, 1, max(map(os.path.getsize, paths), default=0) + 1, args.bucket):
+        sys.exit("Chunked and single-pass results differ")
+    if args.json:
+        json.dump(as_json(stats, args.top), sys.stdout, indent=2)
+        print()
+    else:
+        report(stats, args.top, args.bucket, elapsed)
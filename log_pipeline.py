@@ -0,0 +1,186 @@
+# ref : https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+import metrics
+import tracing
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# Records waiting for the writer thread; when it falls this far behind new records are dropped, not waited for
+QUEUE_SIZE = 10000
+# Size-based rotation: socks_proxy.log -> socks_proxy.log.1 ... .BACKUP_COUNT
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# One JSON object per connection goes to this logger, see ConnectionSummary
+CONNECTION_LOGGER = "socks_proxy.connections"
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller: a record that finds the queue full is counted and dropped."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+queue_handlers = []
+file_handlers = []
+listener = None
+
+def rotating_handler(filename, max_bytes, backup_count, formatter):
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(formatter)
+    return handler
+
+def configure(filename="socks_proxy.log", level=logging.INFO, connection_log="socks_proxy.jsonl",
+              max_bytes=None, backup_count=None, queue_size=None):
+    """
+    Route the root logger, and the per-connection JSON lines, through a queue
+    to file handlers on a background thread, so a slow disk stalls that
+    thread instead of the relays. queue_size=0 writes synchronously on the
+    calling thread instead. connection_log=None turns the JSON lines off.
+    """
+    global listener
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    backup_count = BACKUP_COUNT if backup_count is None else backup_count
+    queue_size = QUEUE_SIZE if queue_size is None else queue_size
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    connections = logging.getLogger(CONNECTION_LOGGER)
+    connections.setLevel(logging.INFO) # independent of --log-level
+    connections.propagate = False
+
+    root_handlers = [rotating_handler(filename, max_bytes, backup_count, logging.Formatter(LOG_FORMAT))]
+    connection_handlers = []
+    if connection_log:
+        connection_handlers.append(rotating_handler(connection_log, max_bytes, backup_count, logging.Formatter("%(message)s")))
+    else:
+        connections.disabled = True
+    file_handlers[:] = root_handlers + connection_handlers
+
+    if queue_size == 0:
+        root.handlers = root_handlers
+        connections.handlers = connection_handlers
+        return
+
+    # One queue and one writer thread for both files; the records say which file they belong to
+    log_queue = queue.Queue(queue_size)
+    for handler in root_handlers:
+        handler.addFilter(lambda record: record.name != CONNECTION_LOGGER)
+    for handler in connection_handlers:
+        handler.addFilter(lambda record: record.name == CONNECTION_LOGGER)
+
+    queue_handlers[:] = [DroppingQueueHandler(log_queue), DroppingQueueHandler(log_queue)]
+    root.handlers = [queue_handlers[0]]
+    connections.handlers = [queue_handlers[1]]
+    listener = logging.handlers.QueueListener(log_queue, *root_handlers, *connection_handlers, respect_handler_level=True)
+    listener.start()
+
+def restart_after_fork():
+    # The writer thread doesn't survive fork(): a forked worker gets a fresh queue and thread
+    # writing to the same (O_APPEND) files, until use_worker_files() moves it to its own
+    global listener
+    if listener is None:
+        return
+    log_queue = queue.Queue(listener.queue.maxsize)
+    for handler in queue_handlers:
+        handler.queue = log_queue
+        handler.dropped = 0
+    listener = logging.handlers.QueueListener(log_queue, *listener.handlers, respect_handler_level=True)
+    listener.start()
+
+os.register_at_fork(after_in_child=restart_after_fork)
+
+def worker_filename(filename, worker_index):
+    # socks_proxy.log -> socks_proxy.2.log, so its backups (socks_proxy.2.log.1 ...) don't mix with the supervisor's
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{worker_index}{ext}"
+
+def use_worker_files(worker_index):
+    """
+    --prefork: worker N writes socks_proxy.N.log and socks_proxy.N.jsonl.
+    A RotatingFileHandler only knows about its own process, so workers
+    sharing one file would each rotate it, overwriting each other's
+    backups; with a file each, every file is rotated by one process.
+    """
+    for handler in file_handlers:
+        handler.acquire() # the writer thread may be in emit()
+        try:
+            if handler.stream is not None:
+                handler.stream.close()
+                handler.stream = None # reopened under the new name by the next emit()
+            handler.baseFilename = worker_filename(handler.baseFilename, worker_index)
+        finally:
+            handler.release()
+
+def dropped():
+    return sum(handler.dropped for handler in queue_handlers)
+
+def stop():
+    """Write out everything still queued and stop the writer thread."""
+    global listener
+    if listener is None:
+        return
+    if dropped():
+        logging.warning(f"Log queue was full, {dropped()} records dropped")
+    while True:
+        try:
+            listener.stop()
+            break
+        except queue.Full:
+            time.sleep(0.01) # the sentinel needs a free slot
+    listener = None
+
+atexit.register(stop)
+
+class ConnectionSummary:
+    """
+    The one log record of a connection. The handler fills fields in as the
+    handshake goes (user, command, target, ...), mark() ends a phase and
+    records how long it took, both as <phase>_ms here and in the metrics
+    phase histogram (and as a span, when tracing is on), and close()
+    writes everything as one JSON line, replacing a debug line per step.
+    """
+
+    def __init__(self, client_address):
+        self.started = self.phase_started = time.monotonic()
+        metrics.ACTIVE_CONNECTIONS.inc()
+        self.fields = {
+            "time": round(time.time(), 3),
+            "client": f"{client_address[0]}:{client_address[1]}" if client_address else None,
+            "status": "closed", # overwritten once the connection gets further
+        }
+        self.trace = tracing.start(self.fields) # spans for --trace-buffer, None when tracing is off
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def mark(self, phase):
+        now = time.monotonic()
+        elapsed = now - self.phase_started
+        self.phase_started = now
+        self.fields[f"{phase}_ms"] = round(elapsed * 1000, 1)
+        metrics.PHASE_SECONDS[phase].observe(elapsed)
+        if self.trace is not None:
+            self.trace.span(phase, now - elapsed, now)
+
+    def close(self):
+        self.fields["duration_ms"] = round((time.monotonic() - self.started) * 1000, 1)
+        metrics.ACTIVE_CONNECTIONS.dec()
+        metrics.connections_counter(self.fields["status"]).inc()
+        if self.trace is not None:
+            tracing.finish(self.trace)
+        logger = logging.getLogger(CONNECTION_LOGGER)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(self.fields, default=str))
@@ -0,0 +1,208 @@
+# ref : https://prometheus.io/docs/instrumenting/exposition_formats/
+import math
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds, from a fast loopback handshake up to a long tunnel
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, math.inf)
+
+class Shard:
+    """One thread's share of every metric; only that thread writes it."""
+
+    def __init__(self):
+        self.values = {} # counter/gauge key -> value
+        self.histograms = {} # histogram key -> [count per bucket..., sum]
+
+    def merge(self, other):
+        for key, value in list(other.values.items()):
+            self.values[key] = self.values.get(key, 0) + value
+        for key, counts in list(other.histograms.items()):
+            mine = self.histograms.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(list(counts)):
+                mine[i] += count
+
+class Registry:
+    """
+    Counters, gauges and histograms kept per thread: a thread bumps numbers
+    in its own Shard, with no lock and no shared cache line, and a scrape
+    adds the shards up. Shards of threads that have exited (one per client
+    in thread mode) are folded into `retired` at scrape time so they don't
+    pile up.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = {} # thread -> Shard
+        self.retired = Shard()
+        self.metrics = {} # name -> (type, help)
+        self.collectors = []
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock: # once per thread
+                self.shards[threading.current_thread()] = shard
+            return shard
+
+    def declare(self, name, kind, help_text):
+        known = self.metrics.setdefault(name, (kind, help_text))
+        if known[0] != kind:
+            raise ValueError(f"Metric {name} already declared as a {known[0]}")
+
+    def counter(self, name, help_text, **labels):
+        self.declare(name, "counter", help_text)
+        return Counter(self, name, labels)
+
+    def gauge(self, name, help_text, **labels):
+        self.declare(name, "gauge", help_text)
+        return Counter(self, name, labels)
+
+    def histogram(self, name, help_text, **labels):
+        self.declare(name, "histogram", help_text)
+        return Histogram(self, name, labels)
+
+    def add_collector(self, collector):
+        """
+        collector() is called on every scrape and returns
+        [(name, type, help, [(labels, value), ...]), ...], for numbers that
+        already live somewhere else, e.g. the DNS cache's stats().
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        total = Shard()
+        with self.lock:
+            for thread, shard in list(self.shards.items()):
+                if thread.is_alive():
+                    total.merge(shard)
+                else:
+                    self.retired.merge(shard)
+                    del self.shards[thread]
+            total.merge(self.retired)
+        return total
+
+    def render(self):
+        """The whole registry in the Prometheus text exposition format."""
+        total = self.collect()
+        samples = {name: [] for name in self.metrics}
+        for (name, labels), value in total.values.items():
+            samples[name].append((labels, value))
+        for (name, labels), counts in total.histograms.items():
+            samples[name].append((labels, counts))
+
+        lines = []
+        for name, (kind, help_text) in self.metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples[name]):
+                if kind == "histogram":
+                    lines.extend(histogram_lines(name, labels, value))
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        for collector in self.collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                logging.error(f"Metrics collector {collector.__name__} failed: {e}")
+                continue
+            for name, kind, help_text, values in collected:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+class Counter:
+    """A counter or gauge with fixed label values; gauges also go down through inc(-1)."""
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.key = (name, tuple(sorted(labels.items())))
+
+    def inc(self, amount=1):
+        values = self.registry.shard().values
+        values[self.key] = values.get(self.key, 0) + amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class Histogram:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.key = (name, tuple(sorted(labels.items())))
+
+    def observe(self, value):
+        histograms = self.registry.shard().histograms
+        counts = histograms.get(self.key)
+        if counts is None:
+            counts = histograms[self.key] = [0] * (len(BUCKETS) + 1)
+        counts[bisect.bisect_left(BUCKETS, value)] += 1
+        counts[-1] += value
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def histogram_lines(name, labels, counts):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, counts):
+        cumulative += count
+        bucket_labels = labels + (("le", format_value(bound)),)
+        yield f"{name}_bucket{format_labels(bucket_labels)} {cumulative}"
+    yield f"{name}_sum{format_labels(labels)} {format_value(counts[-1])}"
+    yield f"{name}_count{format_labels(labels)} {cumulative}"
+
+registry = Registry()
+
+# What the proxy records. Label values are fixed here so the hot path is a dict update.
+PHASES = ("greeting", "auth", "request", "resolve", "connect", "bind", "relay", "udp")
+PHASE_SECONDS = {phase: registry.histogram("socks_phase_seconds", "Time spent in each phase of a connection", phase=phase)
+                 for phase in PHASES}
+ACTIVE_CONNECTIONS = registry.gauge("socks_active_connections", "Client connections being handled")
+ACTIVE_TUNNELS = registry.gauge("socks_active_tunnels", "CONNECT and BIND tunnels relaying data")
+ACTIVE_UDP_ASSOCIATIONS = registry.gauge("socks_active_udp_associations", "UDP associations relaying datagrams")
+BYTES_UP = registry.counter("socks_relay_bytes_total", "Bytes relayed through CONNECT and BIND tunnels", direction="up")
+BYTES_DOWN = registry.counter("socks_relay_bytes_total", "Bytes relayed through CONNECT and BIND tunnels", direction="down")
+UDP_OUT = registry.counter("socks_udp_datagrams_total", "Datagrams relayed by UDP associations", direction="out")
+UDP_IN = registry.counter("socks_udp_datagrams_total", "Datagrams relayed by UDP associations", direction="in")
+UDP_DROPPED = registry.counter("socks_udp_datagrams_total", "Datagrams relayed by UDP associations", direction="dropped")
+SHAPING_DELAY = registry.counter("socks_shaping_delay_seconds_total", "Time relays were held back by bandwidth limits")
+
+def connections_counter(status):
+    return registry.counter("socks_connections_total", "Finished client connections by outcome", status=status)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes would otherwise go to stderr every few seconds
+
+def serve(host, port):
+    """Serve /metrics on a daemon thread; returns the server so callers can read the bound port."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
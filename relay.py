@@ -0,0 +1,162 @@
+# ref : https://man7.org/linux/man-pages/man2/splice.2.html
+import os
+import time
+import errno
+import fcntl
+import select
+
+import metrics
+import buffer_pool
+
+# Size of one relay step. The old loop moved 4 KiB per recv/sendall pair, which costs
+# a syscall pair and a fresh bytes object for every 4 KiB of a bulk download.
+CHUNK_SIZE = 65536
+# The copy loop sizes each direction's chunk to its traffic instead: it starts at MIN_CHUNK_SIZE
+# and grows 4x whenever a read fills it, so a bulk transfer reaches MAX_CHUNK_SIZE within a few
+# reads while an interactive session keeps a small buffer
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 262144
+# Reads in a row that would have fit a quarter of the chunk before it shrinks back
+SHRINK_AFTER = 16
+
+# "auto" uses splice on Linux and falls back to the copy loop elsewhere, "copy" forces the copy loop
+RELAY_MODE = "auto"
+
+SPLICE_AVAILABLE = hasattr(os, "splice")
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+def relay_tcp(client_socket, remote_socket, watchdog=None, shaper=None):
+    """
+    Relay traffic between client and remote server until either side closes
+    (or errors). Uses the kernel-side splice path when possible. Returns
+    (bytes client -> remote, bytes remote -> client, side that closed), the
+    side being "client" or "remote". Every chunk touches `watchdog`, a
+    timer_wheel.Watchdog keeping the idle timeout, if one is given, and
+    waits out `shaper` (a shaping.Shaper, None when unlimited) before it is
+    sent on.
+    """
+    if RELAY_MODE == "auto" and SPLICE_AVAILABLE:
+        moved = splice_relay(client_socket, remote_socket, watchdog, shaper)
+        if moved is not None:
+            return moved
+    return copy_relay(client_socket, remote_socket, watchdog, shaper)
+
+def poll_sockets(sockets):
+    # poll rather than select: select can't watch descriptors above 1024, and admission control lets far more in
+    poller = select.poll()
+    for sock in sockets:
+        poller.register(sock, select.POLLIN)
+    return poller, {sock.fileno(): sock for sock in sockets}
+
+class AdaptiveBuffer:
+    """One direction's receive buffer in the copy loop, borrowed from buffer_pool and resized to the traffic."""
+
+    __slots__ = ("buffer", "size", "small_reads")
+
+    def __init__(self):
+        self.size = min(MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+        self.buffer = buffer_pool.acquire(self.size)
+        self.small_reads = 0
+
+    def adapt(self, received):
+        if received == self.size and self.size < MAX_CHUNK_SIZE:
+            self.resize(min(self.size * 4, MAX_CHUNK_SIZE))
+        elif self.size > MIN_CHUNK_SIZE and received <= self.size // 4:
+            self.small_reads += 1
+            if self.small_reads >= SHRINK_AFTER:
+                self.resize(max(self.size // 4, MIN_CHUNK_SIZE))
+        else:
+            self.small_reads = 0
+
+    def resize(self, size):
+        buffer_pool.release(self.buffer)
+        self.buffer = buffer_pool.acquire(size)
+        self.size = size
+        self.small_reads = 0
+
+    def release(self):
+        buffer_pool.release(self.buffer)
+
+def copy_relay(client_socket, remote_socket, watchdog=None, shaper=None):
+    # Pooled buffers, one per direction, so no bytes object is created per chunk
+    sockets = [client_socket, remote_socket]
+    peers = {client_socket: remote_socket, remote_socket: client_socket}
+    buffers = {client_socket: AdaptiveBuffer(), remote_socket: AdaptiveBuffer()}
+    moved = {client_socket: 0, remote_socket: 0} # bytes read from each side
+    counters = {client_socket: metrics.BYTES_UP, remote_socket: metrics.BYTES_DOWN}
+    poller, by_fd = poll_sockets(sockets)
+
+    try:
+        while True:
+            for fd, _ in poller.poll():
+                sock = by_fd[fd]
+                buffer = buffers[sock]
+                received = sock.recv_into(buffer.buffer, buffer.size)
+                if not received:
+                    return moved[client_socket], moved[remote_socket], "client" if sock is client_socket else "remote"
+                delay = shaper.delay(received) if shaper else 0
+                if delay:
+                    time.sleep(delay)
+                peers[sock].sendall(buffer.buffer[:received])
+                moved[sock] += received
+                counters[sock].inc(received)
+                buffer.adapt(received)
+                if watchdog:
+                    watchdog.touch()
+    finally:
+        for buffer in buffers.values():
+            buffer.release()
+
+def splice_relay(client_socket, remote_socket, watchdog=None, shaper=None):
+    """
+    Moves data socket -> pipe -> socket with os.splice, so the payload never
+    enters Python. Returns None without consuming anything if the kernel
+    refuses to splice these sockets, so the caller can fall back to copying.
+    """
+    sockets = [client_socket, remote_socket]
+    peers = {client_socket: remote_socket, remote_socket: client_socket}
+    moved = {client_socket: 0, remote_socket: 0}
+    counters = {client_socket: metrics.BYTES_UP, remote_socket: metrics.BYTES_DOWN}
+    pipes = {}
+    try:
+        for sock in sockets:
+            read_fd, write_fd = os.pipe()
+            pipes[sock] = (read_fd, write_fd)
+            try:
+                fcntl.fcntl(write_fd, F_SETPIPE_SZ, CHUNK_SIZE)
+            except OSError:
+                pass # keep the default pipe size
+
+        moved_any = False
+        poller, by_fd = poll_sockets(sockets)
+        while True:
+            for fd, _ in poller.poll():
+                sock = by_fd[fd]
+                read_fd, write_fd = pipes[sock]
+                try:
+                    pending = os.splice(sock.fileno(), write_fd, CHUNK_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    if not moved_any and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        return None
+                    raise
+                if not pending:
+                    return moved[client_socket], moved[remote_socket], "client" if sock is client_socket else "remote"
+                moved_any = True
+                moved[sock] += pending
+                counters[sock].inc(pending)
+                if watchdog:
+                    watchdog.touch()
+                delay = shaper.delay(pending) if shaper else 0
+                if delay:
+                    time.sleep(delay) # the bytes wait in the pipe
+
+                # Drain the pipe into the peer; this blocks like sendall does
+                peer_fd = peers[sock].fileno()
+                while pending:
+                    pending -= os.splice(read_fd, peer_fd, pending, flags=os.SPLICE_F_MOVE)
+    finally:
+        for read_fd, write_fd in pipes.values():
+            os.close(read_fd)
+            os.close(write_fd)
@@ -0,0 +1,142 @@
+# ref : https://en.wikipedia.org/wiki/Token_bucket
+import time
+import threading
+
+import metrics
+
+# Limits in bytes per second, counting both directions; 0 means no limit at that level
+GLOBAL_RATE = 0
+USER_RATE = 0
+DESTINATION_RATE = 0
+CONNECTION_RATE = 0
+# Seconds of traffic a bucket can save up while its owner is quiet
+BURST = 1.0
+# Per-user/per-destination buckets kept before idle (full) ones are pruned
+MAX_KEYS = 10000
+
+RATE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_rate(text):
+    """'512K', '10M', '1G' or plain bytes per second (argparse type)."""
+    text = text.strip().upper().removesuffix("B")
+    suffix = text[-1:] if text[-1:] in RATE_SUFFIXES else ""
+    return int(float(text[:len(text) - len(suffix)]) * RATE_SUFFIXES[suffix])
+
+class TokenBucket:
+    """
+    `rate` bytes per second with room for rate * burst. take() never waits
+    itself: it takes the bytes, going into debt if need be, and returns how
+    long the caller has to sleep before sending them. Debt is handed out in
+    the order callers ask, so tunnels sharing a bucket take turns one chunk
+    at a time instead of whoever polls fastest winning.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = rate * (BURST if burst is None else burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        with self.lock:
+            self.refill(now)
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_take(self, amount, now):
+        # For datagrams, which are dropped rather than delayed: all or nothing
+        with self.lock:
+            self.refill(now)
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def give_back(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_idle(self, now):
+        with self.lock:
+            self.refill(now)
+            return self.tokens >= self.capacity
+
+class Shaper:
+    """
+    The buckets one connection's bytes pass through, outermost first:
+    global, its user's, its destination's, its own. A chunk waits for the
+    slowest of them, so every level's limit holds.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.delayed = 0.0 # seconds this connection was held back
+
+    def delay(self, amount):
+        """Seconds to wait before sending `amount` bytes."""
+        now = time.monotonic()
+        wait = max(bucket.take(amount, now) for bucket in self.buckets)
+        if wait:
+            self.delayed += wait
+            metrics.SHAPING_DELAY.inc(wait)
+        return wait
+
+    def allow(self, amount):
+        """Whether a datagram of `amount` bytes fits every bucket right now; it is charged if so."""
+        now = time.monotonic()
+        for i, bucket in enumerate(self.buckets):
+            if not bucket.try_take(amount, now):
+                for taken in self.buckets[:i]:
+                    taken.give_back(amount)
+                return False
+        return True
+
+global_bucket = None
+shared_buckets = {} # ("user", name) or ("destination", host) -> TokenBucket
+shared_lock = threading.Lock()
+
+def shared_bucket(key, rate):
+    # Once per connection, not per chunk
+    with shared_lock:
+        bucket = shared_buckets.get(key)
+        if bucket is None:
+            if len(shared_buckets) >= MAX_KEYS:
+                now = time.monotonic()
+                for idle in [k for k, b in shared_buckets.items() if b.is_idle(now)]:
+                    del shared_buckets[idle]
+            bucket = shared_buckets[key] = TokenBucket(rate)
+        return bucket
+
+def shaper_for(user, destination=None):
+    """
+    The Shaper for a new connection, or None when no limit applies to it;
+    relays test for None, so unshaped traffic never touches a bucket lock.
+    """
+    buckets = []
+    if global_bucket is not None:
+        buckets.append(global_bucket)
+    if USER_RATE and user is not None:
+        buckets.append(shared_bucket(("user", user), USER_RATE))
+    if DESTINATION_RATE and destination is not None:
+        buckets.append(shared_bucket(("destination", destination), DESTINATION_RATE))
+    if CONNECTION_RATE:
+        buckets.append(TokenBucket(CONNECTION_RATE))
+    return Shaper(buckets) if buckets else None
+
+def configure(global_rate=0, user_rate=0, destination_rate=0, connection_rate=0, burst=None):
+    global GLOBAL_RATE, USER_RATE, DESTINATION_RATE, CONNECTION_RATE, BURST, global_bucket
+    GLOBAL_RATE, USER_RATE, DESTINATION_RATE, CONNECTION_RATE = global_rate, user_rate, destination_rate, connection_rate
+    if burst is not None:
+        BURST = burst
+    global_bucket = TokenBucket(GLOBAL_RATE) if GLOBAL_RATE else None
+    with shared_lock:
+        shared_buckets.clear()
+
+def stats():
+    with shared_lock:
+        return {"shared_buckets": len(shared_buckets)}
@@ -0,0 +1,209 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc1928
+# ref : https://datatracker.ietf.org/doc/html/rfc1929
+import socket
+import struct
+from collections import namedtuple
+
+SOCKS_VERSION = 5
+NO_AUTHENTICATION_REQUIRED = 0
+USERNAME_PASSWORD = 2
+ADDRESS_TYPE_IPV4 = 1
+ADDRESS_TYPE_DOMAIN = 3
+ADDRESS_TYPE_IPV6 = 4
+
+# Bytes asked for per read: enough for a whole pipelined handshake in one recv
+READ_SIZE = 4096
+
+Greeting = namedtuple("Greeting", "methods")
+Auth = namedtuple("Auth", "username password")
+Request = namedtuple("Request", "command address_type address port")
+
+class ParseError(Exception):
+    """A malformed handshake. `reply` is the REP code to answer a bad request with, if any."""
+
+    def __init__(self, message, reply=None):
+        super().__init__(message)
+        self.reply = reply
+
+class Socks5Parser:
+    """
+    Incremental parser for the client side of the SOCKS5 handshake: the
+    greeting, the RFC 1929 username/password sub-negotiation and the
+    request. Bytes go in through feed() in whatever pieces TCP delivers
+    them, complete messages come out of next_event(), so a short read is
+    never mistaken for a whole field and a client that pipelines the
+    handshake is served from one recv. No I/O happens here; both engines
+    drive the same parser.
+    """
+
+    GREETING = "greeting"
+    METHOD = "method" # waiting for select_method()
+    AUTH = "auth"
+    REQUEST = "request"
+    DONE = "done"
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = self.GREETING
+
+    def feed(self, data):
+        self.buffer += data
+
+    def select_method(self, method):
+        # The server's METHOD choice decides what the client sends next
+        self.state = self.AUTH if method == USERNAME_PASSWORD else self.REQUEST
+
+    def remaining(self):
+        """Bytes the client sent after the request, i.e. the start of the tunneled data."""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def next_event(self):
+        """Returns the next complete Greeting/Auth/Request, or None until more bytes arrive."""
+        if self.state == self.GREETING:
+            return self.parse_greeting()
+        if self.state == self.AUTH:
+            return self.parse_auth()
+        if self.state == self.REQUEST:
+            return self.parse_request()
+        return None
+
+    def parse_greeting(self):
+        """
+        +----+----------+----------+
+        |VER | NMETHODS | METHODS  |
+        +----+----------+----------+
+        | 1  |    1     | 1 to 255 |
+        +----+----------+----------+
+        """
+        buffer = self.buffer
+        if len(buffer) < 1:
+            return None
+        if buffer[0] != SOCKS_VERSION:
+            raise ParseError("Unsupported SOCKS version")
+        if len(buffer) < 2 or len(buffer) < 2 + buffer[1]:
+            return None
+        end = 2 + buffer[1]
+        methods = bytes(buffer[2:end])
+        del buffer[:end]
+        self.state = self.METHOD
+        return Greeting(methods)
+
+    def parse_auth(self):
+        """
+        +----+------+----------+------+----------+
+        |VER | ULEN |  UNAME   | PLEN |  PASSWD  |
+        +----+------+----------+------+----------+
+        | 1  |  1   | 1 to 255 |  1   | 1 to 255 |
+        +----+------+----------+------+----------+
+        """
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        uname_end = 2 + buffer[1]
+        if len(buffer) < uname_end + 1:
+            return None
+        end = uname_end + 1 + buffer[uname_end]
+        if len(buffer) < end:
+            return None
+        try:
+            username = buffer[2:uname_end].decode("utf-8")
+            password = buffer[uname_end + 1:end].decode("utf-8")
+        except UnicodeDecodeError:
+            raise ParseError("Username/password is not valid UTF-8")
+        del buffer[:end]
+        self.state = self.REQUEST
+        return Auth(username, password)
+
+    def parse_request(self):
+        """
+        +----+-----+-------+------+----------+----------+
+        |VER | CMD |  RSV  | ATYP | DST.ADDR | DST.PORT |
+        +----+-----+-------+------+----------+----------+
+        | 1  |  1  | X'00' |  1   | Variable |    2     |
+        +----+-----+-------+------+----------+----------+
+        """
+        buffer = self.buffer
+        if len(buffer) < 5:
+            return None
+        version, command, _, address_type = struct.unpack_from("!BBBB", buffer)
+        if version != SOCKS_VERSION:
+            raise ParseError("Unsupported SOCKS version", reply=0x01)
+
+        if address_type == ADDRESS_TYPE_IPV4:
+            end = 4 + 4
+        elif address_type == ADDRESS_TYPE_IPV6:
+            end = 4 + 16
+        elif address_type == ADDRESS_TYPE_DOMAIN:
+            end = 5 + buffer[4]
+        else:
+            raise ParseError(f"Unsupported address type {address_type}", reply=0x08)
+        if len(buffer) < end + 2:
+            return None
+
+        if address_type == ADDRESS_TYPE_IPV4:
+            address = socket.inet_ntoa(buffer[4:end])
+        elif address_type == ADDRESS_TYPE_IPV6:
+            address = socket.inet_ntop(socket.AF_INET6, buffer[4:end])
+        else:
+            try:
+                address = buffer[5:end].decode("utf-8")
+            except UnicodeDecodeError:
+                raise ParseError("Domain name is not valid UTF-8", reply=0x01)
+        port = struct.unpack_from("!H", buffer, end)[0]
+        del buffer[:end + 2]
+        self.state = self.DONE
+        return Request(command, address_type, address, port)
+
+def unmap(host):
+    # A dual-stack socket shows an IPv4 peer as ::ffff:a.b.c.d
+    if host.startswith("::ffff:") and "." in host:
+        return host[len("::ffff:"):]
+    return host
+
+def address_field(host, port):
+    """
+    ATYP, address and port as they appear in requests, replies and UDP
+    headers: an IPv4 or IPv6 address in binary, anything else as a domain.
+    """
+    host = unmap(host)
+    for family, address_type in ((socket.AF_INET, ADDRESS_TYPE_IPV4), (socket.AF_INET6, ADDRESS_TYPE_IPV6)):
+        try:
+            return struct.pack("!B", address_type) + socket.inet_pton(family, host) + struct.pack("!H", port)
+        except OSError:
+            pass
+    name = host.encode("idna")
+    return struct.pack("!BB", ADDRESS_TYPE_DOMAIN, len(name)) + name + struct.pack("!H", port)
+
+def build_reply(reply, bound=None):
+    """
+    +----+-----+-------+------+----------+----------+
+    |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
+    +----+-----+-------+------+----------+----------+
+    `bound` is the socket address for BND.ADDR/BND.PORT, 0.0.0.0:0 if None.
+    """
+    host, port = bound[:2] if bound else ("0.0.0.0", 0)
+    return struct.pack("!BBB", SOCKS_VERSION, reply, 0) + address_field(host, port)
+
+def read_event(sock, parser):
+    """Blocking driver: recv until the parser has the next message. Returns None on EOF."""
+    while True:
+        event = parser.next_event()
+        if event is not None:
+            return event
+        data = sock.recv(READ_SIZE)
+        if not data:
+            return None
+        parser.feed(data)
+
+async def read_event_async(reader, parser):
+    """read_event for asyncio streams."""
+    while True:
+        event = parser.next_event()
+        if event is not None:
+            return event
+        data = await reader.read(READ_SIZE)
+        if not data:
+            return None
+        parser.feed(data)
@@ -1,24 +1,77 @@
 # ref : https://datatracker.ietf.org/doc/html/rfc1928
 # ref : https://datatracker.ietf.org/doc/html/rfc1929
 # ref : https://kuanyuchen.gitbooks.io/python3-tutorial/content/er_jin_zhi_chu_li_fang_shi.html
-import socket
+import os
+import time
+import errno
+import signal
 import select
+import socket
 import struct
 import logging
-import threading
+import argparse
+import asyncio
+
+import acl
+import relay
+import bind_ports
+import buffer_pool
+import upstream
+import shaping
+import admission
+import handoff
+import timer_wheel
+import log_pipeline
+import metrics
+import tracing
+import credentials
+import socks_parser
+import dns_cache
+import happy_eyeballs
+import udp_relay
+import udp_batch
 
 # SOCKS5 constants
 SOCKS_VERSION = 5
 NO_AUTHENTICATION_REQUIRED = 0
 USERNAME_PASSWORD = 2
 COMMAND_CONNECT = 1
+COMMAND_BIND = 2
 COMMAND_UDP_ASSOCIATE = 3
 ADDRESS_TYPE_IPV4 = 1
 ADDRESS_TYPE_DOMAIN = 3
 ADDRESS_TYPE_IPV6 = 4
+COMMAND_NAMES = {1: "connect", 2: "bind", 3: "udp_associate"}
+REPLY_SUCCEEDED = 0
+REPLY_GENERAL_FAILURE = 1
+REPLY_NOT_ALLOWED = 2 # connection not allowed by ruleset
+REPLY_NETWORK_UNREACHABLE = 3
+REPLY_HOST_UNREACHABLE = 4
+REPLY_CONNECTION_REFUSED = 5
+REPLY_TTL_EXPIRED = 6
+REPLY_COMMAND_NOT_SUPPORTED = 7
+REPLY_ADDRESS_TYPE_NOT_SUPPORTED = 8
+# Why a connect failed, told to the client so it can fail fast instead of guessing from a closed socket
+ERRNO_REPLIES = {
+    errno.ECONNREFUSED: REPLY_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REPLY_NETWORK_UNREACHABLE,
+    errno.ENETDOWN: REPLY_NETWORK_UNREACHABLE,
+    errno.EADDRNOTAVAIL: REPLY_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REPLY_HOST_UNREACHABLE,
+    errno.EHOSTDOWN: REPLY_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REPLY_TTL_EXPIRED,
+    errno.EAFNOSUPPORT: REPLY_ADDRESS_TYPE_NOT_SUPPORTED,
+}
 
-# Cofigure logging
-logging.basicConfig(filename="socks_proxy.log", level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
+# Seconds a client gets from accept to a complete request, and a connection may sit without traffic
+HANDSHAKE_TIMEOUT = 10
+IDLE_TIMEOUT = 300
+# Seconds open connections get to finish after SIGTERM (or a listener handoff) before they are closed
+DRAIN_TIMEOUT = 30
+# TCP keepalive on both legs of a tunnel, so a peer that vanished without a FIN is noticed
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
 
 def log_connection(client_address, traget_address):
     logging.info(f"Connection from {client_address} to {traget_address}")
@@ -26,21 +79,14 @@ def log_connection(client_address, traget_address):
 def log_error(client_address, error):
     logging.error(f"Error with client {client_address}: {error}")
 
-def handle_auth(client_socket):
+def handle_auth(client_socket, parser, summary):
+    # Returns the authenticated username, or None
     try:
-        auth_data = client_socket.recv(2)
-        #logging.debug(f"Username/Password auth data: {auth_data}")
-        
-        if len(auth_data) < 2:
-            #logging.error("Username/Password auth data too short")
-            return False
-        
-        version, uname_len = struct.unpack("!BB", auth_data)
-        uname = client_socket.recv(uname_len).decode("utf-8")
-        pass_len = struct.unpack("!B", client_socket.recv(1))[0]
-        password = client_socket.recv(pass_len).decode("utf-8")
-
-        logging.debug(f"Received username: {uname}, password: {password}")
+        auth = socks_parser.read_event(client_socket, parser)
+        if auth is None:
+            return None
+        uname, password = auth
+        summary.set(user=uname) # kept on a failure too, for the log's failed usernames
 
         """
         The server verifies the supplied UNAME and PASSWD, and sends the
@@ -54,32 +100,62 @@ def handle_auth(client_socket):
         `failure' (STATUS value other than X'00') status, it MUST close the
         connection.
         """
-        if uname == "user" and password == "password":
+        if credentials.get_store().verify(uname, password):
             client_socket.sendall(struct.pack("!BB", 1, 0)) # Success
-            return True
+            return uname
         else:
             client_socket.sendall(struct.pack("!BB", 1, 1)) # Failure
-            return False
+            return None
     
     except Exception as e:
         logging.error(f"Error during authentication: {e}")
-        return False
+        return None
     
 def resolve_domain_name(domain):
+    """
+    Returns every A/AAAA record of domain as (family, address) pairs, or
+    None. The lookup runs on the resolver pool, so a slow resolver costs
+    this handler at most dns_cache.RESOLVE_TIMEOUT.
+    """
     try:
-        ip = socket.gethostbyname(domain)
-        logging.debug(f"Resolved {domain} to {ip}")
-        return ip
+        addresses = dns_cache.resolve(domain).result(timeout=dns_cache.RESOLVE_TIMEOUT)
+        logging.debug(f"Resolved {domain} to {', '.join(ip for _, ip in addresses)}")
+        return addresses
     except socket.gaierror as e:
         logging.error(f"DNS resolution error for {domain}: {e}")
         return None
+    except TimeoutError:
+        logging.error(f"DNS resolution timed out for {domain}")
+        return None
 
-def handle_udp_associate(client_socket):
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind(("0.0.0.0", 0)) # port 0 to let the OS choose a random port
-    udp_socket_port = udp_socket.getsockname()[1]
+async def resolve_domain_name_async(domain):
+    try:
+        # shield: a timeout here must not cancel the lookup other handlers may be sharing
+        future = asyncio.wrap_future(dns_cache.resolve(domain))
+        addresses = await asyncio.wait_for(asyncio.shield(future), dns_cache.RESOLVE_TIMEOUT)
+        logging.debug(f"Resolved {domain} to {', '.join(ip for _, ip in addresses)}")
+        return addresses
+    except socket.gaierror as e:
+        logging.error(f"DNS resolution error for {domain}: {e}")
+        return None
+    except TimeoutError:
+        logging.error(f"DNS resolution timed out for {domain}")
+        return None
 
-    logging.debug(f"UDP socket bound to port {udp_socket_port}")
+def open_udp_socket(family):
+    # Same family as the client's TCP connection; an IPv6 one is dual-stack so it can reach IPv4 targets too
+    udp_socket = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_INET6:
+        udp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        udp_socket.bind(("::", 0))
+    else:
+        udp_socket.bind(("0.0.0.0", 0)) # port 0 to let the OS choose a random port
+    return udp_socket
+
+def handle_udp_associate(client_socket, address, port, summary, watchdog, user):
+    udp_socket = open_udp_socket(client_socket.family)
+    udp_socket_port = udp_socket.getsockname()[1]
+    summary.set(udp_port=udp_socket_port)
 
     """
     The server evaluates the request, and returns a reply 
@@ -109,63 +185,209 @@ def handle_udp_associate(client_socket):
     o  BND.ADDR       server bound address
     o  BND.PORT       server bound port in network octet order
     """
-    # Send the UDP associate response to the client
-    client_socket.sendall(struct.pack("!BBBBIH", SOCKS_VERSION, 0, 0, ADDRESS_TYPE_IPV4, 0, udp_socket_port)) # address = 0.0.0.0
+    # Send the UDP associate response to the client: the address it reached us on, and the relay's port
+    client_socket.sendall(socks_parser.build_reply(REPLY_SUCCEEDED, (client_socket.getsockname()[0], udp_socket_port)))
 
-    while True:
-        try:
-            data, addr = udp_socket.recvfrom(4096)
-            #logging.debug(f"Received data from {addr}: {data}")
-            if not data:
-                break
+    association = new_udp_association(client_socket.getpeername(), address, port, shaping.shaper_for(user), user, udp_socket.family)
+    udp_socket.setblocking(False)
+    batch = udp_batch.DatagramBatch(udp_socket)
+    metrics.ACTIVE_UDP_ASSOCIATIONS.inc()
+    try:
+        reason = udp_relay.relay_udp(client_socket, batch, association, watchdog)
+    finally:
+        udp_socket.close()
+        batch.close()
+        metrics.ACTIVE_UDP_ASSOCIATIONS.dec()
+        summary.mark("udp")
+        summary.set(status="ok", udp=association.summary(), udp_batch=batch.summary())
+    summary.set(close_reason=reason)
 
-            # Parse the SOCKS5 UDP header
-            header = struct.unpack_from("!BBH", data[:4])
-            frag = header[0]
-            addr_type = header[1]
-
-            if addr_type == ADDRESS_TYPE_IPV4:
-                dst_addr = socket.inet_ntoa(data[4:8])
-                dst_port = struct.unpack("!H", data[8:10])[0]
-                payload = data[10:]
-            elif addr_type == ADDRESS_TYPE_IPV6:
-                dst_addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
-                dst_port = struct.unpack("!H", data[20:22])[0]
-                payload = data[22:]
-            elif addr_type == ADDRESS_TYPE_DOMAIN:
-                domain_length = data[4]
-                dst_addr = data[5:5+domain_length].decode('utf-8')
-                dst_port = struct.unpack("!H", data[5+domain_length:7+domain_length])[0]
-                payload = data[7+domain_length:]
-            else:
-                print("Unsupported address type")
-                continue
+def new_udp_association(client_address, address, port, shaper, user, family):
+    # The request's DST.ADDR/DST.PORT is where the client will send from; 0.0.0.0 means its TCP address
+    if address in ("0.0.0.0", "::"):
+        address = client_address[0]
+    return udp_relay.UDPAssociation(address, port, shaper=shaper, user=user, family=family)
 
-            # Send the payload to the destination
-            #logging.debug(f"Sending payload to {dst_addr}:{dst_port}")
-            udp_socket.sendto(payload, (dst_addr, dst_port))
+def set_keepalive(sock):
+    if not KEEPALIVE_IDLE:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"): # Linux; elsewhere the system defaults apply
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
 
-            # Receive the response
-            response, response_addr = udp_socket.recvfrom(4096)
-            #logging.debug(f"Received response from {response_addr}: {response}")
+def shutdown_socket(sock):
+    # Called from the timer wheel thread: shutdown (unlike close) wakes the handler blocked on this socket
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # already closed
 
-            # Construct the SOCKS5 UDP response header
-            response_header = struct.pack("!BBH", 0, ADDRESS_TYPE_IPV4, 0) # No fragmentation, IPv4 address, Reserved
-            response_packet = response_header + socket.inet_aton(response_addr[0]) + struct.pack("!H", response_addr[1]) + response
+def shutdown_legs(legs):
+    # Thread mode's watchdog callback: every socket of the connection, as the handler may be blocked sending on any
+    for sock in list(legs):
+        shutdown_socket(sock)
 
-            #logging.debug(f"Sending response packet to {addr}")
-            # Send the response back to the client
-            udp_socket.sendto(response_packet, addr)
-        except socket.timeout:
-            logging.warning("UDP socket timeout")
-            break
-        except Exception as e:
-            logging.error(f"Error handling UDP associate: {e}")
-            break
+def add_leg(legs, sock, watchdog):
+    legs.append(sock)
+    if watchdog.reason:
+        shutdown_socket(sock) # the watchdog fired before it knew about this socket
 
-def handle_client(client_socket):
-    client_address = client_socket.getpeername()
+def finish_connection(summary, watchdog, client_ip):
+    # Shared end of both engines' handlers: release the admission slot and say why the connection closed
+    watchdog.cancel()
+    open_watchdogs.discard(watchdog)
+    admission.connections.release(client_ip)
+    if summary.trace is not None and watchdog.first_activity is not None:
+        summary.trace.event("first_byte", watchdog.first_activity)
+    if watchdog.reason:
+        summary.set(close_reason=watchdog.reason)
+        if watchdog.reason == "handshake_timeout":
+            summary.set(status="handshake_timeout")
+    elif summary.fields["status"] == "error":
+        summary.set(close_reason="error")
+    summary.close()
+
+def check_request(command, address, port, user, summary):
+    # The destination rule for a CONNECT, or for the peer a BIND waits for; UDP datagrams are checked one by one in udp_relay
+    if command == COMMAND_UDP_ASSOCIATE:
+        return acl.DEFAULT_RULE
+    rule = acl.check(address, port, user)
+    if rule is not acl.DEFAULT_RULE:
+        summary.set(rule=rule.text)
+    return rule
+
+def allowed_addresses(addresses, port, user, rule):
+    # A name's addresses that no earlier network rule denies, and the rule that denied the others
+    allowed, denied_by = [], None
+    for family, ip in addresses:
+        denying = acl.address_denied(ip, port, user, rule)
+        if denying is None:
+            allowed.append((family, ip))
+        else:
+            denied_by = denied_by or denying
+    return allowed, denied_by
+
+def denied_reply(summary, rule):
+    summary.set(status="denied", rule=rule.text)
+    return socks_parser.build_reply(REPLY_NOT_ALLOWED)
+
+def error_reply(error):
+    # The REP code for a failed connect: the upstream's own answer, else from the errno
+    if isinstance(error, upstream.UpstreamRefused):
+        return error.reply
+    if isinstance(error, TimeoutError):
+        return REPLY_TTL_EXPIRED
+    return ERRNO_REPLIES.get(getattr(error, "errno", None), REPLY_GENERAL_FAILURE)
+
+def failed_reply(summary, status, reply, error=None):
+    summary.set(status=status, reply=reply)
+    if error is not None:
+        summary.set(error=str(error))
+    return socks_parser.build_reply(reply)
+
+def relay_tunnel(client_socket, remote_socket, parser, user, address, summary, watchdog, legs):
+    # Relay traffic between client and remote server (CONNECT's target or BIND's peer) until either side closes
+    add_leg(legs, remote_socket, watchdog)
+    shaper = shaping.shaper_for(user, address)
+    metrics.ACTIVE_TUNNELS.inc()
+    summary.set(status="ok")
+    try:
+        early_data = parser.remaining() # sent by the client right behind the request
+        if early_data:
+            remote_socket.sendall(early_data)
+            metrics.BYTES_UP.inc(len(early_data))
+        bytes_up, bytes_down, closed_by = relay.relay_tcp(client_socket, remote_socket, watchdog, shaper)
+        summary.set(bytes_up=bytes_up + len(early_data), bytes_down=bytes_down, close_reason=f"{closed_by}_closed")
+    except OSError:
+        if watchdog.reason is None:
+            raise
+        # The watchdog shut the sockets down under a send blocked on a peer that stopped reading
+    finally:
+        client_socket.close()
+        remote_socket.close()
+        metrics.ACTIVE_TUNNELS.dec()
+        summary.mark("relay")
+        if shaper:
+            summary.set(shaped_ms=round(shaper.delayed * 1000, 1))
+
+def bind_peer_allowed(peer, addresses, user):
+    # A BIND accepts only the DST.ADDR the client named; 0.0.0.0 or :: takes any peer the rules allow
+    if any(ip in ("0.0.0.0", "::") for _, ip in addresses):
+        return acl.check(peer[0], peer[1], user).action != "deny"
+    return any(ip == peer[0] for _, ip in addresses)
+
+def refuse_bind_peer(listener, peer):
+    logging.info(f"BIND on port {listener.getsockname()[1]} refused a connection from {peer[0]}:{peer[1]}")
+
+def accept_peer(listener, client_socket, addresses, user, summary):
+    # The peer's connection on a BIND listener; None if the client went away or bind_ports.ACCEPT_TIMEOUT passed
+    deadline = time.monotonic() + bind_ports.ACCEPT_TIMEOUT
+    poller = select.poll()
+    poller.register(listener, select.POLLIN)
+    poller.register(client_socket, select.POLLIN) # EOF, or the watchdog's shutdown
+    while (remaining := deadline - time.monotonic()) > 0:
+        events = poller.poll(remaining * 1000)
+        if any(fd == client_socket.fileno() for fd, _ in events):
+            summary.set(status="bind_cancelled", close_reason="client_closed")
+            return None
+        try:
+            peer_socket, (peer_host, peer_port, *_) = listener.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            continue
+        peer = (socks_parser.unmap(peer_host), peer_port)
+        if bind_peer_allowed(peer, addresses, user):
+            peer_socket.setblocking(True)
+            return peer_socket
+        peer_socket.close()
+        refuse_bind_peer(listener, peer)
+    client_socket.sendall(failed_reply(summary, "bind_timeout", REPLY_TTL_EXPIRED))
+    return None
+
+def handle_bind(client_socket, addresses, parser, user, summary, watchdog, legs):
+    """
+    BIND (RFC 1928 section 4): the first reply tells the client which
+    address and port to pass on to the peer, the second one, sent once the
+    peer has connected, who connected. From there the peer's connection
+    is relayed like a CONNECT tunnel.
+    """
+    try:
+        listener = bind_ports.acquire()
+    except OSError as e:
+        # No pool and the OS gave us no listening socket, e.g. out of ports or descriptors
+        client_socket.sendall(failed_reply(summary, "bind_failed", REPLY_GENERAL_FAILURE, e))
+        return
+    if listener is None:
+        client_socket.sendall(failed_reply(summary, "bind_ports_exhausted", REPLY_GENERAL_FAILURE))
+        return
     try:
+        bind_port = listener.getsockname()[1]
+        summary.set(bind_port=bind_port)
+        # The address the client reached us on is the one its peer can reach too
+        client_socket.sendall(socks_parser.build_reply(REPLY_SUCCEEDED, (client_socket.getsockname()[0], bind_port)))
+        peer_socket = accept_peer(listener, client_socket, addresses, user, summary)
+    finally:
+        bind_ports.release(listener) # the accepted connection is a socket of its own
+    if peer_socket is None:
+        return
+
+    peer = socks_parser.unmap(peer_socket.getpeername()[0]), peer_socket.getpeername()[1]
+    summary.set(remote=peer[0])
+    summary.mark("bind")
+    set_keepalive(peer_socket)
+    client_socket.sendall(socks_parser.build_reply(REPLY_SUCCEEDED, peer))
+    relay_tunnel(client_socket, peer_socket, parser, user, peer[0], summary, watchdog, legs)
+
+def handle_client(client_socket, client_address, watchdog, legs):
+    # Runs on a WorkerPool thread; serve_threaded has admitted the client and started its handshake deadline.
+    # `legs` holds the sockets the watchdog shuts down when it expires; the tunnel adds its remote socket.
+    summary = log_pipeline.ConnectionSummary(client_address)
+    try:
+        if watchdog.reason:
+            return # the deadline passed while the connection waited for a worker
+        set_keepalive(client_socket)
+
         # SOCKS5 handshake
         """
         The client connects to the server, and sends a version
@@ -196,15 +418,15 @@ def handle_client(client_socket):
         o  X'80' to X'FE' RESERVED FOR PRIVATE METHODS
         o  X'FF' NO ACCEPTABLE METHODS
         """
-        greeting = client_socket.recv(262)  # Receive client greeting
-        #logging.debug(f"Client greeting: {greeting}")
-        if len(greeting) < 3 or greeting[0] != SOCKS_VERSION:
-            logging.error("Unsupported SOCKS version")
-            client_socket.close()
+        # One parser for the whole handshake, so a client that sends several messages
+        # in one segment (or one message over several) is read correctly
+        parser = socks_parser.Socks5Parser()
+        greeting = socks_parser.read_event(client_socket, parser)  # Receive client greeting
+        if greeting is None:
             return
-        
-        methods = greeting[2:]
-        logging.debug(f"Client authentication methods: {methods}")
+
+        methods = greeting.methods
+        summary.mark("greeting")
 
         if USERNAME_PASSWORD in methods:
             """
@@ -217,15 +439,20 @@ def handle_client(client_socket):
             which is X'01'.
             """
             client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, USERNAME_PASSWORD))
+            parser.select_method(USERNAME_PASSWORD)
         else:
             client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, 0xFF))
             client_socket.close()
+            summary.set(status="no_acceptable_methods")
             return
 
         # Perform authentication
-        if not handle_auth(client_socket):
+        user = handle_auth(client_socket, parser, summary)
+        if user is None:
             client_socket.close()
+            summary.set(status="auth_failed")
             return
+        summary.mark("auth")
 
         # SOCKS5 connection request
         """
@@ -253,37 +480,59 @@ def handle_client(client_socket):
         o  DST.PORT desired destination port in network octet order
         """
         # SOCKS5 connection request
-        request = client_socket.recv(4)
-        #logging.debug(f"Client request: {request}")
-        _, command, _, address_type = struct.unpack("!BBBB", request)
-        logging.debug(f"Command: {command}, Address type: {address_type}")
-
-        if address_type == ADDRESS_TYPE_IPV4:
-            address = socket.inet_ntoa(client_socket.recv(4))
-            logging.debug(f"Resolved IPv4 address: {address}")
+        try:
+            request = socks_parser.read_event(client_socket, parser)
+        except socks_parser.ParseError as e:
+            if e.reply is not None:
+                client_socket.sendall(socks_parser.build_reply(e.reply))
+            raise
+        if request is None:
+            return
+        command, address_type, address, port = request
+        summary.set(command=COMMAND_NAMES.get(command, command), target=f"{address}:{port}")
+        summary.mark("request")
+        watchdog.idle(IDLE_TIMEOUT) # DNS and connect have their own timeouts
+
+        rule = check_request(command, address, port, user, summary)
+        if rule.action == "deny":
+            client_socket.sendall(denied_reply(summary, rule))
+            return
+
+        # A CONNECT routed to an upstream proxy is passed on by name; the upstream resolves it
+        group = upstream.group_for(rule.upstream) if command == COMMAND_CONNECT else None
+        if group is not None:
+            addresses = None
+            summary.set(upstream=group.name)
+        elif address_type == ADDRESS_TYPE_IPV4:
+            addresses = [(socket.AF_INET, address)]
         elif address_type == ADDRESS_TYPE_IPV6:
-            address = socket.inet_ntop(socket.AF_INET6, client_socket.recv(16))
-            logging.debug(f"Resolved IPv6 address: {address}")
+            addresses = [(socket.AF_INET6, address)]
         elif address_type == ADDRESS_TYPE_DOMAIN:
-            domain_length = struct.unpack("!B", client_socket.recv(1))[0]
-            address = client_socket.recv(domain_length).decode("utf-8")
-            address = resolve_domain_name(address)
-            if not address:
-                log_error(client_address, "DNS resolution failed")
-                client_socket.close()
+            addresses = resolve_domain_name(address)
+            if not addresses:
+                client_socket.sendall(failed_reply(summary, "dns_failed", REPLY_HOST_UNREACHABLE))
                 return
-        port = struct.unpack("!H", client_socket.recv(2))[0]
-
-        logging.debug(f"Connecting to {address}:{port}")
+            addresses, denied_by = allowed_addresses(addresses, port, user, rule)
+            if not addresses:
+                client_socket.sendall(denied_reply(summary, denied_by))
+                return
+            address = addresses[0][1]
+            summary.mark("resolve")
 
         if command == COMMAND_CONNECT:  
             try:
-                remote_socket = socket.socket(socket.AF_INET6 if address_type == ADDRESS_TYPE_IPV6 else socket.AF_INET, socket.SOCK_STREAM)
-                remote_socket.connect((address, port))
+                if group is not None:
+                    remote_socket, proxy = group.connect(address, port)
+                    summary.set(upstream_proxy=proxy.label)
+                else:
+                    # Races the resolved addresses (RFC 8305) so one dead address doesn't stall the tunnel
+                    remote_socket = happy_eyeballs.connect(addresses, port)
             except Exception as e:
-                log_error(client_address, f"Connection error: {str(e)}")
-                client_socket.close()
+                client_socket.sendall(failed_reply(summary, "connect_failed", error_reply(e), e))
                 return
+            summary.set(remote=remote_socket.getpeername()[0])
+            summary.mark("connect")
+            set_keepalive(remote_socket)
             
             # Send successful connection response
             """
@@ -312,47 +561,785 @@ def handle_client(client_socket):
             o  BND.ADDR       server bound address
             o  BND.PORT       server bound port in network octet order
             """
-            client_socket.sendall(struct.pack("!BBBBIH", SOCKS_VERSION, 0, 0, ADDRESS_TYPE_IPV4, 0, 0))
-
-            # Relay traffic between client and remote server
-            sockets = [client_socket, remote_socket]
-            while True:
-                readable, _, _ = select.select(sockets, [], [])
-                if client_socket in readable:
-                    data = client_socket.recv(4096)
-                    if not data:
-                        break
-                    remote_socket.sendall(data)
-                if remote_socket in readable:
-                    data = remote_socket.recv(4096)
-                    if not data:
-                        break
-                    client_socket.sendall(data)
+            client_socket.sendall(socks_parser.build_reply(REPLY_SUCCEEDED, remote_socket.getsockname()))
 
-            client_socket.close()
-            remote_socket.close()
+            relay_tunnel(client_socket, remote_socket, parser, user, address, summary, watchdog, legs)
+
+        elif command == COMMAND_BIND:
+            handle_bind(client_socket, addresses, parser, user, summary, watchdog, legs)
 
-        
         elif command == COMMAND_UDP_ASSOCIATE:
-            logging.debug(f"UDP socket allocation requested by {client_address}")
-            handle_udp_associate(client_socket)
+            handle_udp_associate(client_socket, address, port, summary, watchdog, user)
+
+        else:
+            client_socket.sendall(failed_reply(summary, "unsupported_command", REPLY_COMMAND_NOT_SUPPORTED))
 
 
     except Exception as e:
         log_error(client_address, e)
+        summary.set(status="error", error=str(e))
     finally:
         client_socket.close()
+        finish_connection(summary, watchdog, client_address[0])
+
+########################################################################################
+# asyncio engine: the same handshake and relay as above, run as coroutines on one
+# event loop instead of one thread per client.
+
+async def handle_auth_async(reader, writer, parser, summary):
+    try:
+        auth = await socks_parser.read_event_async(reader, parser)
+        if auth is None:
+            return None
+        uname, password = auth
+        summary.set(user=uname) # kept on a failure too, for the log's failed usernames
+
+        # A recently verified password is answered on the loop; a KDF run goes to a worker thread
+        store = credentials.get_store()
+        valid = store.is_cached(uname, password)
+        if not valid:
+            valid = await asyncio.get_running_loop().run_in_executor(None, store.verify, uname, password)
+
+        if valid:
+            writer.write(struct.pack("!BB", 1, 0)) # Success
+            await writer.drain()
+            return uname
+        else:
+            writer.write(struct.pack("!BB", 1, 1)) # Failure
+            await writer.drain()
+            return None
+
+    except Exception as e:
+        logging.error(f"Error during authentication: {e}")
+        return None
+
+async def handle_udp_associate_async(reader, writer, address, port, summary, watchdog, user):
+    udp_socket = open_udp_socket(writer.get_extra_info("socket").family)
+    udp_socket.setblocking(False)
+    udp_socket_port = udp_socket.getsockname()[1]
+    summary.set(udp_port=udp_socket_port)
+
+    # Send the UDP associate response to the client
+    writer.write(socks_parser.build_reply(REPLY_SUCCEEDED, (writer.get_extra_info("sockname")[0], udp_socket_port)))
+    await writer.drain()
+
+    association = new_udp_association(peer_address(writer), address, port, shaping.shaper_for(user), user, udp_socket.family)
+    batch = udp_batch.DatagramBatch(udp_socket)
+    metrics.ACTIVE_UDP_ASSOCIATIONS.inc()
+    try:
+        reason = await udp_relay.relay_udp_async(reader, batch, association, watchdog)
+    finally:
+        udp_socket.close()
+        batch.close()
+        metrics.ACTIVE_UDP_ASSOCIATIONS.dec()
+        summary.mark("udp") # also when the watchdog cancels us
+        summary.set(status="ok", udp=association.summary(), udp_batch=batch.summary())
+    summary.set(close_reason=reason)
+
+async def relay_stream(reader, writer, moved, direction, watchdog, shaper):
+    # moved[direction] counts the bytes relayed, kept up to date so it survives the task being cancelled.
+    # Both directions of a tunnel share `shaper`; waiting on it only holds up this task.
+    counter = metrics.BYTES_UP if direction == "up" else metrics.BYTES_DOWN
+    try:
+        while True:
+            data = await reader.read(relay.CHUNK_SIZE)
+            if not data:
+                break
+            delay = shaper.delay(len(data)) if shaper else 0
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+            moved[direction] += len(data)
+            counter.inc(len(data))
+            watchdog.touch()
+    except ConnectionError:
+        pass
+
+async def relay_tunnel_async(reader, writer, remote_reader, remote_writer, parser, user, address, summary, watchdog):
+    early_data = parser.remaining() # sent by the client right behind the request
+    if early_data:
+        remote_writer.write(early_data)
+        metrics.BYTES_UP.inc(len(early_data))
+
+    # Relay traffic between client and remote server until either side closes
+    moved = {"up": len(early_data), "down": 0}
+    shaper = shaping.shaper_for(user, address)
+    relays = [
+        asyncio.create_task(relay_stream(reader, remote_writer, moved, "up", watchdog, shaper)),
+        asyncio.create_task(relay_stream(remote_reader, writer, moved, "down", watchdog, shaper)),
+    ]
+    metrics.ACTIVE_TUNNELS.inc()
+    summary.set(status="ok")
+    try:
+        done, _ = await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+        summary.set(close_reason="client_closed" if relays[0] in done else "remote_closed")
+    finally:
+        for relay_task in relays:
+            relay_task.cancel()
+        remote_writer.close()
+        metrics.ACTIVE_TUNNELS.dec()
+        summary.mark("relay")
+        summary.set(bytes_up=moved["up"], bytes_down=moved["down"])
+        if shaper:
+            summary.set(shaped_ms=round(shaper.delayed * 1000, 1))
+
+async def accept_peer_async(listener, reader, writer, addresses, user, summary):
+    # accept_peer on the event loop; any byte or EOF from the client ends the wait, as in thread mode
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + bind_ports.ACCEPT_TIMEOUT
+    client_left = asyncio.create_task(reader.read(1))
+    accepting = None
+    try:
+        while (remaining := deadline - loop.time()) > 0:
+            accepting = asyncio.create_task(loop.sock_accept(listener))
+            done, _ = await asyncio.wait([accepting, client_left], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if accepting not in done:
+                if client_left in done:
+                    summary.set(status="bind_cancelled", close_reason="client_closed")
+                    return None
+                break
+            try:
+                peer_socket, (peer_host, peer_port, *_) = accepting.result()
+            except ConnectionAbortedError:
+                continue
+            peer = (socks_parser.unmap(peer_host), peer_port)
+            if bind_peer_allowed(peer, addresses, user):
+                return peer_socket
+            peer_socket.close()
+            refuse_bind_peer(listener, peer)
+    finally:
+        client_left.cancel()
+        if accepting is not None:
+            accepting.cancel()
+    writer.write(failed_reply(summary, "bind_timeout", REPLY_TTL_EXPIRED))
+    await writer.drain()
+    return None
+
+async def handle_bind_async(reader, writer, addresses, parser, user, summary, watchdog):
+    try:
+        listener = bind_ports.acquire()
+    except OSError as e:
+        writer.write(failed_reply(summary, "bind_failed", REPLY_GENERAL_FAILURE, e))
+        await writer.drain()
+        return
+    if listener is None:
+        writer.write(failed_reply(summary, "bind_ports_exhausted", REPLY_GENERAL_FAILURE))
+        await writer.drain()
+        return
+    try:
+        bind_port = listener.getsockname()[1]
+        summary.set(bind_port=bind_port)
+        writer.write(socks_parser.build_reply(REPLY_SUCCEEDED, (writer.get_extra_info("sockname")[0], bind_port)))
+        await writer.drain()
+        peer_socket = await accept_peer_async(listener, reader, writer, addresses, user, summary)
+    finally:
+        bind_ports.release(listener)
+    if peer_socket is None:
+        return
+
+    peer = socks_parser.unmap(peer_socket.getpeername()[0]), peer_socket.getpeername()[1]
+    summary.set(remote=peer[0])
+    summary.mark("bind")
+    set_keepalive(peer_socket)
+    peer_reader, peer_writer = await asyncio.open_connection(sock=peer_socket)
+    writer.write(socks_parser.build_reply(REPLY_SUCCEEDED, peer))
+    await writer.drain()
+    await relay_tunnel_async(reader, writer, peer_reader, peer_writer, parser, user, peer[0], summary, watchdog)
+
+def peer_address(writer):
+    host, port = writer.get_extra_info("peername")[:2]
+    return socks_parser.unmap(host), port
+
+async def handle_client_async(reader, writer):
+    client_address = peer_address(writer)
+    rejected = admission.connections.admit(client_address[0])
+    if rejected:
+        writer.close()
+        reject(client_address, rejected)
+        return
+    if handshakes_in_progress >= admission.MAX_PENDING:
+        admission.connections.release(client_address[0])
+        admission.connections.rejected["pending_full"] += 1
+        writer.close()
+        reject(client_address, "pending_full")
+        return
+
+    summary = log_pipeline.ConnectionSummary(client_address)
+    task = asyncio.current_task()
+    watchdog = timer_wheel.Watchdog(lambda reason: task.cancel())
+    watchdog.handshake(HANDSHAKE_TIMEOUT)
+    open_watchdogs.add(watchdog)
+    in_handshake = True
+    handshake_started()
+    try:
+        set_keepalive(writer.get_extra_info("socket"))
+
+        # SOCKS5 handshake, see handle_client for the message layouts
+        parser = socks_parser.Socks5Parser()
+        greeting = await socks_parser.read_event_async(reader, parser)  # Receive client greeting
+        if greeting is None:
+            return
+
+        methods = greeting.methods
+        summary.mark("greeting")
+
+        if USERNAME_PASSWORD in methods:
+            writer.write(struct.pack("!BB", SOCKS_VERSION, USERNAME_PASSWORD))
+            await writer.drain()
+            parser.select_method(USERNAME_PASSWORD)
+        else:
+            writer.write(struct.pack("!BB", SOCKS_VERSION, 0xFF))
+            await writer.drain()
+            summary.set(status="no_acceptable_methods")
+            return
+
+        # Perform authentication
+        user = await handle_auth_async(reader, writer, parser, summary)
+        if user is None:
+            summary.set(status="auth_failed")
+            return
+        summary.mark("auth")
+
+        # SOCKS5 connection request
+        try:
+            request = await socks_parser.read_event_async(reader, parser)
+        except socks_parser.ParseError as e:
+            if e.reply is not None:
+                writer.write(socks_parser.build_reply(e.reply))
+                await writer.drain()
+            raise
+        if request is None:
+            return
+        command, address_type, address, port = request
+        summary.set(command=COMMAND_NAMES.get(command, command), target=f"{address}:{port}")
+        summary.mark("request")
+        watchdog.idle(IDLE_TIMEOUT) # DNS and connect have their own timeouts
+        in_handshake = False
+        handshake_finished()
+
+        rule = check_request(command, address, port, user, summary)
+        if rule.action == "deny":
+            writer.write(denied_reply(summary, rule))
+            await writer.drain()
+            return
+
+        # A CONNECT routed to an upstream proxy is passed on by name; the upstream resolves it
+        group = upstream.group_for(rule.upstream) if command == COMMAND_CONNECT else None
+        if group is not None:
+            addresses = None
+            summary.set(upstream=group.name)
+        elif address_type == ADDRESS_TYPE_IPV4:
+            addresses = [(socket.AF_INET, address)]
+        elif address_type == ADDRESS_TYPE_IPV6:
+            addresses = [(socket.AF_INET6, address)]
+        elif address_type == ADDRESS_TYPE_DOMAIN:
+            addresses = await resolve_domain_name_async(address)
+            if not addresses:
+                writer.write(failed_reply(summary, "dns_failed", REPLY_HOST_UNREACHABLE))
+                await writer.drain()
+                return
+            addresses, denied_by = allowed_addresses(addresses, port, user, rule)
+            if not addresses:
+                writer.write(denied_reply(summary, denied_by))
+                await writer.drain()
+                return
+            address = addresses[0][1]
+            summary.mark("resolve")
+
+        if command == COMMAND_CONNECT:
+            try:
+                if group is not None:
+                    remote_socket, proxy = await group.connect_async(address, port)
+                    summary.set(upstream_proxy=proxy.label)
+                else:
+                    remote_socket = await happy_eyeballs.connect_async(addresses, port)
+                remote_reader, remote_writer = await asyncio.open_connection(sock=remote_socket)
+            except Exception as e:
+                writer.write(failed_reply(summary, "connect_failed", error_reply(e), e))
+                await writer.drain()
+                return
+            summary.set(remote=remote_socket.getpeername()[0])
+            summary.mark("connect")
+            set_keepalive(remote_socket)
+
+            # Send successful connection response
+            writer.write(socks_parser.build_reply(REPLY_SUCCEEDED, remote_socket.getsockname()))
+            await writer.drain()
+
+            await relay_tunnel_async(reader, writer, remote_reader, remote_writer, parser, user, address, summary, watchdog)
+
+        elif command == COMMAND_BIND:
+            await handle_bind_async(reader, writer, addresses, parser, user, summary, watchdog)
+
+        elif command == COMMAND_UDP_ASSOCIATE:
+            await handle_udp_associate_async(reader, writer, address, port, summary, watchdog, user)
+
+        else:
+            writer.write(failed_reply(summary, "unsupported_command", REPLY_COMMAND_NOT_SUPPORTED))
+            await writer.drain()
+
+    except asyncio.CancelledError:
+        if watchdog.reason is None:
+            raise # not our deadline: the server is shutting down
+    except Exception as e:
+        log_error(client_address, e)
+        summary.set(status="error", error=str(e))
+    finally:
+        if in_handshake:
+            handshake_finished()
+        writer.close()
+        finish_connection(summary, watchdog, client_address[0])
+
+# Connections between accept and a complete request in asyncio mode, held to admission.MAX_PENDING
+handshakes_in_progress = 0
+
+def handshake_started():
+    global handshakes_in_progress
+    handshakes_in_progress += 1
+
+def handshake_finished():
+    global handshakes_in_progress
+    handshakes_in_progress -= 1
+
+async def serve_async(server_socket):
+    wheel_task = asyncio.create_task(timer_wheel.wheel.run_async())
+    server = await asyncio.start_server(handle_client_async, sock=server_socket)
+    print(f"SOCKS5 proxy server listening on port {server_socket.getsockname()[1]} (asyncio)")
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await stop.wait()
+
+    server.close() # stops accepting; connections already open are left alone
+    logging.info(f"Draining {admission.connections.total} connections")
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while admission.connections.total and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    close_remaining()
+    deadline = time.monotonic() + 1
+    while admission.connections.total and time.monotonic() < deadline:
+        await asyncio.sleep(0.01) # let the cancelled handlers write their summaries
+
+########################################################################################
+
+def create_listener(host, port, reuse_port=False):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    if family == socket.AF_INET6 and not socket.has_ipv6:
+        logging.warning(f"No IPv6 on this host, listening on 0.0.0.0 instead of {host}")
+        family, host = socket.AF_INET, "0.0.0.0"
+    server_socket = socket.socket(family, socket.SOCK_STREAM)
+    if host == "::":
+        # Dual-stack: IPv4 clients arrive on the same socket as ::ffff:a.b.c.d
+        server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # asyncio.start_server does the same
+    if reuse_port:
+        # Every worker binds its own socket to the same port and the kernel spreads new connections across them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(admission.BACKLOG) # the old listen(5) dropped SYNs under any burst
+    return server_socket
+
+# The watchdog of every admitted connection, so a drain that runs out of time can close them all
+open_watchdogs = set()
+draining = False
+
+def start_draining(signum, frame):
+    # SIGTERM in thread mode; the wakeup fd makes the accept loop's poll() return and see the flag
+    global draining
+    draining = True
+
+def close_remaining():
+    remaining = list(open_watchdogs)
+    if remaining:
+        logging.warning(f"Drain deadline passed, closing {len(remaining)} connections")
+    for watchdog in remaining:
+        watchdog.expire("shutdown")
+
+def drain():
+    """Wait up to DRAIN_TIMEOUT for the open connections to finish, then close the rest."""
+    logging.info(f"Draining {admission.connections.total} connections")
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while admission.connections.total and time.monotonic() < deadline:
+        time.sleep(0.1)
+    close_remaining()
+    deadline = time.monotonic() + 1
+    while admission.connections.total and time.monotonic() < deadline:
+        time.sleep(0.01) # let the handlers write their summaries
+
+def reject(client_address, reason):
+    # A connection turned away by admission control still gets its JSON line (and metrics status)
+    summary = log_pipeline.ConnectionSummary(client_address)
+    summary.set(status="rejected", close_reason=reason)
+    summary.close()
+
+worker_pool = None
+
+def serve_threaded(server_socket):
+    """
+    Accept loop for thread mode. Each client is admitted against the
+    connection limits, gets its handshake deadline on the timer wheel and
+    waits in the worker pool's bounded queue; anything over a limit is
+    closed right away instead of getting a thread. The listener is polled
+    together with a signal wakeup pipe, so SIGTERM ends the loop between
+    two accepts and the process drains.
+    """
+    global worker_pool
+    worker_pool = admission.WorkerPool(handle_client)
+    timer_wheel.start_thread()
+    print(f"SOCKS5 proxy server listening on port {server_socket.getsockname()[1]}")
+
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGTERM, start_draining)
+    server_socket.setblocking(False) # accept until the queue is empty on each wakeup
+    poller = select.poll()
+    poller.register(server_socket, select.POLLIN)
+    poller.register(wakeup_read, select.POLLIN)
+
+    while not draining:
+        poller.poll()
+        try:
+            os.read(wakeup_read, 64)
+        except BlockingIOError:
+            pass
+        while not draining:
+            try:
+                client_socket, (client_host, client_port, *_)  = server_socket.accept()
+            except BlockingIOError:
+                break
+            client_socket.setblocking(True)
+            client_address = (socks_parser.unmap(client_host), client_port)
+            rejected = admission.connections.admit(client_address[0])
+            if rejected:
+                client_socket.close()
+                reject(client_address, rejected)
+                continue
+
+            legs = [client_socket]
+            watchdog = timer_wheel.Watchdog(lambda reason, legs=legs: shutdown_legs(legs))
+            watchdog.handshake(HANDSHAKE_TIMEOUT)
+            open_watchdogs.add(watchdog)
+            if not worker_pool.submit(client_socket, client_address, watchdog, legs):
+                watchdog.cancel()
+                open_watchdogs.discard(watchdog)
+                admission.connections.release(client_address[0])
+                admission.connections.rejected["pending_full"] += 1
+                client_socket.close()
+                reject(client_address, "pending_full")
+
+    server_socket.close() # a handed-over listener stays open in the new process
+    drain()
+
+def reload_credentials(signum, frame):
+    # SIGHUP: credentials and destination rules
+    credentials.get_store().reload()
+    acl.reload()
+
+def dump_traces(signum, frame):
+    # SIGUSR1: write the traced connections to --trace-dir
+    tracing.dump_on_signal()
+
+def toggle_profiler(signum, frame):
+    # SIGUSR2: start the sampling profiler, or stop it and write its collapsed stacks to --trace-dir
+    tracing.profile_on_signal()
+
+def component_stats():
+    # Metrics collector for numbers the DNS cache, credential store, log pipeline and admission control already keep
+    dns = dns_cache.cache.stats()
+    users = credentials.get_store().stats()
+    admitted = admission.connections.stats()
+    timers = timer_wheel.wheel.stats()
+    upstreams = upstream.stats()
+    buffers = buffer_pool.stats()
+    binds = bind_ports.stats()
+    collected = [
+        ("socks_dns_cache_entries", "gauge", "Hostnames in the DNS cache", [({}, dns["size"])]),
+        ("socks_dns_cache_lookups_total", "counter", "DNS cache lookups by outcome",
+         [({"result": result}, dns[result]) for result in ("hits", "negative_hits", "misses", "shared")]),
+        ("socks_dns_cache_evictions_total", "counter", "DNS cache entries evicted", [({}, dns["evictions"])]),
+        ("socks_credential_users", "gauge", "Users in the credential store", [({}, users["users"])]),
+        ("socks_credential_checks_total", "counter", "Password checks by outcome",
+         [({"result": "cache_hit"}, users["cache_hits"]), ({"result": "kdf"}, users["verifications"]),
+          ({"result": "failed"}, users["failures"])]),
+        ("socks_log_records_dropped_total", "counter", "Log records dropped because the log queue was full",
+         [({}, log_pipeline.dropped())]),
+        ("socks_admitted_client_ips", "gauge", "Client IPs with an admitted connection", [({}, admitted["client_ips"])]),
+        ("socks_rejected_connections_total", "counter", "Connections refused by admission control by reason",
+         [({"reason": reason}, admitted[reason]) for reason in ("limit_total", "limit_per_ip", "pending_full")]),
+        ("socks_timers", "gauge", "Timers on the timer wheel, including cancelled ones not yet swept", [({}, timers["timers"])]),
+        ("socks_timers_fired_total", "counter", "Timer wheel callbacks run", [({}, timers["fired"])]),
+        ("socks_acl_rules", "gauge", "Destination rules in effect", [({}, acl.stats()["rules"])]),
+        ("socks_upstream_healthy", "gauge", "Whether an upstream proxy passes its health checks",
+         [({"upstream": label}, proxy["healthy"]) for label, proxy in upstreams.items()]),
+        ("socks_upstream_pooled_connections", "gauge", "Idle authenticated connections to an upstream proxy",
+         [({"upstream": label}, proxy["pooled"]) for label, proxy in upstreams.items()]),
+        ("socks_upstream_connections_total", "counter", "Upstream connections by how they were obtained",
+         [({"upstream": label, "result": result}, proxy[result]) for label, proxy in upstreams.items()
+          for result in ("pool_hits", "opened", "failures")]),
+        ("socks_shaping_buckets", "gauge", "Per-user and per-destination token buckets", [({}, shaping.stats()["shared_buckets"])]),
+        ("socks_buffer_pool_bytes", "gauge", "Relay buffer memory held by the pool", [({}, buffers["allocated"])]),
+        ("socks_buffer_pool_in_use_bytes", "gauge", "Pooled relay buffer memory lent out, by buffer size",
+         [({"size": str(size)}, in_use) for size, in_use in buffers["in_use"].items()]),
+        ("socks_buffer_pool_overflow_total", "counter", "Relay buffers allocated outside the pool because it was full",
+         [({}, buffers["overflow"])]),
+        ("socks_bind_ports", "gauge", "Pre-bound BIND ports by state",
+         [({"state": "leased"}, binds["leased"]), ({"state": "free"}, binds["ports"] - binds["leased"])]),
+        ("socks_bind_port_requests_total", "counter", "BIND port requests by outcome",
+         [({"result": "acquired"}, binds["acquired"]), ({"result": "exhausted"}, binds["exhausted"])]),
+        ("socks_bind_stale_connections_total", "counter", "Connections dropped that reached a BIND port while it was not lent out",
+         [({}, binds["stale"])]),
+    ]
+    if worker_pool is not None:
+        pool = worker_pool.stats()
+        collected.append(("socks_worker_threads", "gauge", "Worker pool threads by state",
+                          [({"state": "busy"}, pool["workers"] - pool["idle_workers"]), ({"state": "idle"}, pool["idle_workers"])]))
+        collected.append(("socks_pending_connections", "gauge", "Accepted connections waiting for a worker", [({}, pool["pending"])]))
+    else:
+        collected.append(("socks_pending_connections", "gauge", "Connections still in the SOCKS handshake", [({}, handshakes_in_progress)]))
+    return collected
+
+metrics.registry.add_collector(component_stats)
+
+def open_listener(args, reuse_port=False):
+    # The listener of the process serving --handoff-socket and the control connection to it, else a new listener
+    if args.handoff_socket:
+        taken = handoff.take_over(args.handoff_socket)
+        if taken is not None:
+            logging.info(f"Took over the listener on port {taken[0].getsockname()[1]} through {args.handoff_socket}")
+            return taken
+    return create_listener(args.host, args.port, reuse_port), None
+
+def start_handoff(args, server_socket, control):
+    # Let the old process go, then wait to hand the listener on to the next one
+    if control is not None:
+        handoff.ready(control)
+    if args.handoff_socket:
+        handoff.HandoffServer(args.handoff_socket, server_socket, lambda: os.kill(os.getpid(), signal.SIGTERM)).start()
+
+def serve(args, reuse_port=False, worker_index=0, server_socket=None):
+    signal.signal(signal.SIGHUP, reload_credentials)
+    signal.signal(signal.SIGUSR1, dump_traces)
+    signal.signal(signal.SIGUSR2, toggle_profiler)
+    if args.prefork:
+        log_pipeline.use_worker_files(worker_index)
+    upstream.start()
+    bind_ports.start(worker_index, args.workers if args.prefork else 1)
+    if args.metrics_port is not None:
+        # Each prefork worker has its own registry, so each gets its own port
+        metrics.serve(args.metrics_host, args.metrics_port + worker_index)
+    if args.admin_socket:
+        tracing.serve_admin(f"{args.admin_socket}.{worker_index}" if args.prefork else args.admin_socket)
+    if server_socket is None:
+        server_socket, control = open_listener(args, reuse_port)
+        start_handoff(args, server_socket, control)
+    if args.mode == "asyncio":
+        asyncio.run(serve_async(server_socket))
+    else:
+        serve_threaded(server_socket)
+
+def exit_worker(signum, frame):
+    raise SystemExit(0)
+
+def serve_prefork(args):
+    """
+    Pre-fork mode: a supervisor process forks --workers processes, each of
+    which binds the port with SO_REUSEPORT and runs the normal accept loop.
+    Workers that die are restarted; SIGTERM/SIGINT makes all of them drain
+    and SIGHUP, SIGUSR1 and SIGUSR2 are passed on to every worker. With
+    --handoff-socket the supervisor opens (or takes over) one listener and
+    the workers inherit it, so the whole group can hand it to the next one.
+    """
+    workers = {} # pid -> (start time, worker index)
+    stopping = False
+    server_socket = None
+    if args.handoff_socket:
+        server_socket, control = open_listener(args)
+
+    def spawn_worker(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, exit_worker) # unwinds through the finally below, so queued log records are written
+            signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C reaches the whole process group; the supervisor's SIGTERM drains us
+            exit_code = 0
+            try:
+                serve(args, reuse_port=True, worker_index=index, server_socket=server_socket)
+            except SystemExit:
+                pass
+            except BaseException as e:
+                logging.error(f"Worker {os.getpid()} failed: {e}")
+                exit_code = 1
+            finally:
+                log_pipeline.stop() # os._exit skips atexit
+                os._exit(exit_code)
+        workers[pid] = (time.monotonic(), index)
+        logging.info(f"Started worker {pid}")
+
+    def forward_to_workers(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        if server_socket is not None:
+            server_socket.close() # so that once the workers close theirs new clients are refused, not queued
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGHUP, forward_to_workers)
+    signal.signal(signal.SIGUSR1, forward_to_workers)
+    signal.signal(signal.SIGUSR2, forward_to_workers)
+
+    for index in range(args.workers):
+        spawn_worker(index)
+    if server_socket is not None:
+        start_handoff(args, server_socket, control) # the supervisor keeps its copy open to pass on
+    print(f"SOCKS5 proxy server listening on port {args.port} with {args.workers} workers")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        started, index = worker
+
+        logging.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < 1:
+            time.sleep(1) # don't spin if workers die right at startup (e.g. the port is taken)
+        if not stopping:
+            spawn_worker(index)
 
 def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(("0.0.0.0", 1080))
-    server_socket.listen(5)
-    print("SOCKS5 proxy server listening on port 1080")
-
-    while True:
-        client_socket, client_address  = server_socket.accept()
-        logging.debug(f"Accepted connection from {client_address}")
-        threading.Thread(target=handle_client, args=(client_socket,)).start()
+    parser = argparse.ArgumentParser(description="SOCKS5 proxy server")
+    parser.add_argument("--mode", choices=["thread", "asyncio"], default="thread",
+                        help="thread: one thread per client (default), asyncio: all clients on one event loop")
+    parser.add_argument("--host", default="::", help="Address to listen on; the default :: takes IPv4 and IPv6 clients")
+    parser.add_argument("--port", type=int, default=1080, help="Port to listen on")
+    parser.add_argument("--relay", choices=["auto", "copy"], default="auto",
+                        help="CONNECT relay in thread mode. auto: splice on Linux, copy: recv_into/sendall loop")
+    parser.add_argument("--log-file", default="socks_proxy.log", help="Log file, rotated by size (--prefork: worker N writes NAME.N.log)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--connection-log", default="socks_proxy.jsonl",
+                        help="File for the one-line JSON summary of each connection, '' to turn it off (--prefork: NAME.N.jsonl)")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 1024 * 1024, help="Rotate a log file once it reaches this size")
+    parser.add_argument("--log-backups", type=int, default=5, help="Rotated log files to keep")
+    parser.add_argument("--log-queue-size", type=int, default=10000,
+                        help="Records buffered for the background log writer; 0 writes synchronously on the calling thread")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port (prefork worker N uses port + N); off by default")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address for --metrics-port")
+    parser.add_argument("--trace-buffer", type=int, default=0, metavar="N",
+                        help="Keep the phase spans of the last N connections for SIGUSR1 or the admin socket to dump (default: off)")
+    parser.add_argument("--trace-dir", default=".", help="Directory for trace dumps (SIGUSR1) and profiles (SIGUSR2)")
+    parser.add_argument("--profile-hz", type=float, default=99, help="Stack samples per second while the profiler runs")
+    parser.add_argument("--admin-socket", metavar="PATH",
+                        help="Unix socket taking tracing and profiler commands, see tracing.py (--prefork: PATH.N for worker N)")
+    parser.add_argument("--credentials",
+                        help="Credential file written by credentials.py, reloaded on change or SIGHUP (default: user/password)")
+    parser.add_argument("--rules",
+                        help="Destination rule file (see acl.py), reloaded on change or SIGHUP; without one every destination is allowed")
+    parser.add_argument("--upstream", action="append", default=[], metavar="NAME=URL[,URL...]",
+                        help="Upstream proxies (socks5://[user:pass@]host:port or http://...) that CONNECTs can be routed "
+                             "through; the URLs of one NAME are tried in order. Repeat for more names")
+    parser.add_argument("--default-route", default="direct",
+                        help="Upstream NAME for CONNECTs no route=NAME rule matches (default: connect directly)")
+    parser.add_argument("--upstream-pool-size", type=int, default=4,
+                        help="Connections kept open and authenticated to each upstream proxy")
+    parser.add_argument("--upstream-health-interval", type=float, default=10, help="Seconds between upstream health checks")
+    parser.add_argument("--dns-cache-size", type=int, default=1024, help="Max cached hostnames, 0 disables the cache")
+    parser.add_argument("--dns-ttl", type=float, default=300, help="Seconds to keep a resolved hostname")
+    parser.add_argument("--dns-negative-ttl", type=float, default=10, help="Seconds to keep an NXDOMAIN answer")
+    parser.add_argument("--dns-threads", type=int, default=8, help="Size of the resolver thread pool")
+    parser.add_argument("--dns-timeout", type=float, default=5, help="Seconds a request waits for its DNS answer")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="Seconds to establish the outbound connection")
+    parser.add_argument("--udp-idle-timeout", type=float, default=60,
+                        help="Seconds an idle UDP ASSOCIATE destination mapping is kept")
+    parser.add_argument("--udp-batch-size", type=int, default=32, help="Datagrams drained per wakeup in the UDP relay")
+    parser.add_argument("--bind-ports", type=bind_ports.parse_range, metavar="LOW-HIGH",
+                        help="Ports for BIND requests, bound once at startup and reused (default: an OS-chosen port per request)")
+    parser.add_argument("--bind-timeout", type=float, default=60,
+                        help="Seconds a BIND waits for the incoming connection")
+    parser.add_argument("--buffer-pool-mb", type=int, default=64,
+                        help="MiB of relay buffers kept for reuse; past it buffers are allocated per connection")
+    parser.add_argument("--max-relay-chunk-kb", type=int, default=256,
+                        help="Largest chunk the copy relay grows to on bulk transfers, in KiB")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen() backlog of the server socket")
+    parser.add_argument("--max-workers", type=int, default=4096, help="Max handler threads in thread mode")
+    parser.add_argument("--max-pending", type=int, default=512,
+                        help="Accepted connections waiting for a worker (thread mode) or in the handshake (asyncio); more are shed")
+    parser.add_argument("--max-tunnels", type=int, default=4096, help="Max open client connections, 0 for no limit")
+    parser.add_argument("--max-tunnels-per-ip", type=int, default=1024, help="Max open client connections per client IP, 0 for no limit")
+    parser.add_argument("--handshake-timeout", type=float, default=10,
+                        help="Seconds from accept until the SOCKS request must be complete, 0 for none")
+    parser.add_argument("--idle-timeout", type=float, default=300,
+                        help="Seconds a tunnel or UDP association may go without traffic, 0 for none")
+    parser.add_argument("--keepalive-idle", type=int, default=60,
+                        help="Seconds before TCP keepalive probes start on client and remote sockets, 0 disables keepalive")
+    parser.add_argument("--keepalive-interval", type=int, default=10, help="Seconds between keepalive probes")
+    parser.add_argument("--keepalive-count", type=int, default=5, help="Unanswered probes before the connection is dropped")
+    parser.add_argument("--rate-limit", type=shaping.parse_rate, default=0,
+                        help="Bandwidth of the whole proxy in bytes/s, e.g. 50M (both directions together, 0 for no limit)")
+    parser.add_argument("--user-rate-limit", type=shaping.parse_rate, default=0, help="Bandwidth of each user")
+    parser.add_argument("--destination-rate-limit", type=shaping.parse_rate, default=0,
+                        help="Bandwidth of CONNECT tunnels to each destination host")
+    parser.add_argument("--connection-rate-limit", type=shaping.parse_rate, default=0, help="Bandwidth of each connection")
+    parser.add_argument("--rate-burst", type=float, default=1, help="Seconds of traffic a bandwidth limit lets through at once")
+    parser.add_argument("--prefork", action="store_true",
+                        help="Run --workers processes sharing the port through SO_REUSEPORT under a supervisor")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes in --prefork mode (default: CPU count)")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="Seconds open connections get to finish after SIGTERM before they are closed")
+    parser.add_argument("--handoff-socket", metavar="PATH",
+                        help="Unix socket for restarts: a new process started with the same PATH takes over the "
+                             "listener from the running one, which then drains")
+    args = parser.parse_args()
+    global HANDSHAKE_TIMEOUT, IDLE_TIMEOUT, KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_COUNT, DRAIN_TIMEOUT
+
+    log_pipeline.configure(args.log_file, args.log_level, args.connection_log or None,
+                           args.log_max_bytes, args.log_backups, args.log_queue_size)
+    relay.RELAY_MODE = args.relay
+    relay.MAX_CHUNK_SIZE = args.max_relay_chunk_kb * 1024
+    buffer_pool.configure(args.buffer_pool_mb * 1024 * 1024)
+    credentials.configure(args.credentials)
+    try:
+        upstream.configure(args.upstream, args.default_route, args.upstream_pool_size, args.upstream_health_interval)
+    except ValueError as e:
+        parser.error(str(e))
+    acl.configure(args.rules, upstream.groups)
+    dns_cache.configure(args.dns_cache_size, args.dns_ttl, args.dns_negative_ttl, args.dns_threads, args.dns_timeout)
+    happy_eyeballs.CONNECT_TIMEOUT = args.connect_timeout
+    udp_relay.IDLE_TIMEOUT = args.udp_idle_timeout
+    udp_batch.BATCH_SIZE = args.udp_batch_size
+    bind_ports.configure(args.bind_ports, args.bind_timeout)
+    tracing.configure(args.trace_buffer, args.profile_hz, args.trace_dir)
+    shaping.configure(args.rate_limit, args.user_rate_limit, args.destination_rate_limit,
+                      args.connection_rate_limit, args.rate_burst)
+    admission.configure(args.backlog, args.max_workers, args.max_pending, args.max_tunnels, args.max_tunnels_per_ip)
+    HANDSHAKE_TIMEOUT = args.handshake_timeout
+    IDLE_TIMEOUT = args.idle_timeout
+    KEEPALIVE_IDLE = args.keepalive_idle
+    KEEPALIVE_INTERVAL = args.keepalive_interval
+    KEEPALIVE_COUNT = args.keepalive_count
+    DRAIN_TIMEOUT = args.drain_timeout
+
+    if args.prefork:
+        serve_prefork(args)
+    else:
+        serve(args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
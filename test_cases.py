@@ -1,217 +1,427 @@
 import os
-import subprocess
-import socket
-import sys
-import struct
+import json
 import time
+import shlex
+import socket
+import platform
 import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import benchmark
 
-SOCKS_VERSION = 5
-COMMAND_UDP_ASSOCIATE = 3
-USERNAME_PASSWORD = 2
-ADDRESS_TYPE_IPV4 = 1
-
-def run_command(command, description):
-    print(f"Running: {description}", flush=True)
-    result = subprocess.run(command, shell=True, capture_output=True, text=True) 
-    print(result.stdout, flush=True)
-    if result.stderr:
-        print(result.stderr, flush=True)
+SCENARIOS = ["handshake", "http", "throughput", "udp", "checks"]
 
 ########################################################################################
-# Test Case 1: Basic HTTP Request
-def basic_http_request():
-    run_command(
-        "curl -U user:password --socks5 localhost:1080 http://example.com",
-        "Basic HTTP Request"
-    )
-    
-########################################################################################
-# Test Case 2: Basic HTTPS Request
-def basic_https_request():
-    run_command(
-        "curl -U user:password --socks5 localhost:1080 https://example.com",
-        "Basic HTTPS Request"
-    )
-    
-########################################################################################
-# Test Case 3: Large File Download
-def large_file_download():
-    run_command(
-        "curl -U user:password --socks5 localhost:1080 -O http://ipv4.download.thinkbroadband.com/100MB.zip",
-        "Large File Download"
-    )
-    
+# Load driver: N client threads run one scenario step in a loop until the deadline, and
+# every step's latency is kept so percentiles come from real samples.
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * p // 100)) # ceil
+    return ordered[int(rank) - 1]
+
+def latency_stats(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    return {
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+def run_clients(clients, duration, step, setup=None):
+    """
+    Runs `clients` threads that call step(state) until `duration` seconds
+    have passed, after an optional per-client setup() whose return value is
+    the state. step returns a sample (its latency, or any value); an OSError
+    counts as an error. Returns (samples, errors, first error, elapsed).
+    """
+    samples = [[] for _ in range(clients)]
+    errors = [0] * clients
+    first_error = []
+    timing = {}
+    barrier = threading.Barrier(clients, action=lambda: timing.setdefault("deadline", time.perf_counter() + duration))
+
+    def client(index):
+        state = None
+        try:
+            state = setup() if setup else None
+        except OSError as e:
+            errors[index] += 1
+            first_error.append(str(e))
+        barrier.wait()
+        if setup and state is None:
+            return
+        try:
+            while time.perf_counter() < timing["deadline"]:
+                try:
+                    samples[index].append(step(state))
+                except OSError as e:
+                    errors[index] += 1
+                    first_error.append(str(e))
+        finally:
+            if hasattr(state, "close"):
+                state.close()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - (timing["deadline"] - duration)
+    merged = [sample for client_samples in samples for sample in client_samples]
+    return merged, sum(errors), first_error[0] if first_error else None, elapsed
+
+def start_http_server(body_size, host="127.0.0.1"):
+    body = b"x" * body_size
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+def closed_port(host="127.0.0.1"):
+    # A port nothing listens on, for the connection-refused check
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
 ########################################################################################
-# Test Case 4: HTTP POST Request
-def http_post_request():
-    run_command(
-        "curl -U user:password --socks5 localhost:1080 -d 'param1=value1&param2=value2' -X POST http://httpbin.org/post",
-        "HTTP POST Request"
-    )
-    
+# Scenario: handshake
+# Each client does greeting + auth + CONNECT to the echo target, then closes, as fast as it can.
+def handshake_scenario(args, proxy, targets):
+    def step(_):
+        start = time.perf_counter()
+        benchmark.socks5_connect(proxy, "127.0.0.1", targets["echo"]).close()
+        return time.perf_counter() - start
+
+    samples, errors, first_error, elapsed = run_clients(args.clients, args.duration, step)
+    return {
+        "handshakes": len(samples),
+        "handshakes_per_s": round(len(samples) / elapsed, 1),
+        "connect_latency": latency_stats(samples),
+        "errors": errors,
+        "first_error": first_error,
+    }
+
 ########################################################################################
-# Test Case 5: Concurrent Connections Test using ab
-def concurrent_connections_test():
-    run_command(
-        "proxychains ab -n 100 -c 10 http://example.com/",
-        "Concurrent Connections Test using Apache Benchmark (ab)"
-    )
-    
+# Scenario: http
+# Each client opens a tunnel per request and fetches --http-size bytes from the local HTTP
+# server, the way curl through the proxy used to fetch example.com.
+def http_scenario(args, proxy, targets):
+    request = f"GET / HTTP/1.0\r\nHost: 127.0.0.1:{targets['http']}\r\n\r\n".encode()
+
+    def step(_):
+        start = time.perf_counter()
+        sock = benchmark.socks5_connect(proxy, "127.0.0.1", targets["http"])
+        try:
+            sock.sendall(request)
+            response = bytearray()
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+        finally:
+            sock.close()
+        if not response.startswith(b"HTTP/1.0 200") or not response.endswith(b"x" * min(args.http_size, 16)):
+            raise ConnectionError(f"Bad HTTP response ({len(response)} bytes)")
+        return time.perf_counter() - start
+
+    samples, errors, first_error, elapsed = run_clients(args.clients, args.duration, step)
+    return {
+        "requests": len(samples),
+        "requests_per_s": round(len(samples) / elapsed, 1),
+        "response_bytes": args.http_size,
+        "latency": latency_stats(samples),
+        "errors": errors,
+        "first_error": first_error,
+    }
+
 ########################################################################################
-# Test Case 6: DNS Resolution Test
-def dns_resolution_test():
-    run_command(
-        "proxychains nslookup example.com",
-        "DNS Resolution Test"
-    )
-    
+# Scenario: throughput
+# Every client downloads --size-mb from the bulk target at the same time.
+def throughput_scenario(args, proxy, targets):
+    total_bytes = args.size_mb * 1024 * 1024
+    results = [None] * args.clients
+    barrier = threading.Barrier(args.clients)
+
+    def client(index):
+        try:
+            sock = benchmark.socks5_connect(proxy, "127.0.0.1", targets["bulk"])
+        except OSError as e:
+            barrier.wait()
+            results[index] = e
+            return
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            received = benchmark.drain(sock)
+        except OSError as e:
+            results[index] = e
+            return
+        finally:
+            sock.close()
+        results[index] = (received, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    transfers = [result for result in results if isinstance(result, tuple)]
+    received = sum(nbytes for nbytes, _ in transfers)
+    failed = [result for result in results if not isinstance(result, tuple)]
+    short = sum(1 for nbytes, _ in transfers if nbytes != total_bytes)
+    return {
+        "clients": args.clients,
+        "mb_per_client": args.size_mb,
+        "total_mb": round(received / 1024 / 1024, 1),
+        "aggregate_mb_per_s": round(received / 1024 / 1024 / elapsed, 1),
+        "per_client_mb_per_s": rate_stats([nbytes / 1024 / 1024 / seconds for nbytes, seconds in transfers]),
+        "short_transfers": short,
+        "errors": len(failed),
+        "first_error": str(failed[0]) if failed else None,
+    }
+
+def rate_stats(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {"min": round(ordered[0], 1), "p50": round(percentile(ordered, 50), 1), "max": round(ordered[-1], 1)}
+
 ########################################################################################
-# Test Case 7: DNS over UDP
-def dns_over_udp():
-    def dns_query_udp(proxy_host, proxy_port, target_domain):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        
-        # DNS query packet
-        transaction_id = b'\xaa\xbb'  # Arbitrary transaction ID
-        flags = b'\x01\x00'           # Standard query
-        questions = b'\x00\x01'       # One question
-        answer_rrs = b'\x00\x00'      # No answers
-        authority_rrs = b'\x00\x00'   # No authority records
-        additional_rrs = b'\x00\x00'  # No additional records
-        
-        # Query section
-        query = b''.join(bytes([len(part)]) + part.encode('utf-8') for part in target_domain.split('.'))
-        query += b'\x00'  # End of query section
-        query_type = b'\x00\x01'  # Type A query
-        query_class = b'\x00\x01'  # Class IN
-        
-        # DNS packet
-        packet = transaction_id + flags + questions + answer_rrs + authority_rrs + additional_rrs + query + query_type + query_class
-        
-        # Send the DNS query to the Google DNS server (8.8.8.8) on port 53
-        sock.sendto(packet, ('8.8.8.8', 53))
-        
-        # Receive the DNS response
-        data, _ = sock.recvfrom(512)  # Buffer size is 512 bytes
-        print("DNS Response:", data, flush=True)
-
-    print("Running: DNS over UDP", flush=True)
-    dns_query_udp('127.0.0.1', 1080, 'example.com')
-
-    
+# Scenario: udp
+# Each client holds one UDP ASSOCIATE and bounces --window datagrams at a time off the
+# local UDP echo target through the relay.
+def udp_scenario(args, proxy, targets):
+    datagram = benchmark.udp_request_header("127.0.0.1", targets["udp"]) + b"x" * args.payload
+
+    class Association:
+        def __init__(self):
+            self.control, self.relay_address = benchmark.socks5_udp_associate(proxy)
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.settimeout(1)
+
+        def close(self):
+            self.udp_socket.close()
+            self.control.close()
+
+    def step(association):
+        # One window: returns (sent, received, round trip of the whole window)
+        start = time.perf_counter()
+        for _ in range(args.window):
+            association.udp_socket.sendto(datagram, association.relay_address)
+        received = 0
+        for _ in range(args.window):
+            try:
+                association.udp_socket.recvfrom(65535)
+                received += 1
+            except socket.timeout:
+                break
+        return args.window, received, time.perf_counter() - start
+
+    samples, errors, first_error, elapsed = run_clients(args.clients, args.duration, step, setup=Association)
+    sent = sum(s for s, _, _ in samples)
+    received = sum(r for _, r, _ in samples)
+    return {
+        "associations": args.clients,
+        "sent": sent,
+        "received": received,
+        "loss_percent": round(100 * (sent - received) / sent, 3) if sent else None,
+        "pps": round(received / elapsed, 1),
+        "window_rtt": latency_stats([rtt for _, _, rtt in samples]),
+        "errors": errors,
+        "first_error": first_error,
+    }
+
 ########################################################################################
-# Test Case 8: UDP traffic testing
-def udp_traffic_test():
-    def send_udp_associate_request(proxy_host, proxy_port, username, password):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((proxy_host, proxy_port))
-        
-        client_socket.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, USERNAME_PASSWORD))
-        auth_response = client_socket.recv(2)
-
-        client_socket.sendall(struct.pack("!BB", 1, len(username)) + username.encode() + struct.pack("!B", len(password)) + password.encode())
-        auth_status = client_socket.recv(2)
-
-        if auth_status[1] != 0:  # Authentication failed
-            client_socket.close()
-            return
+# Scenario: checks
+# Functional checks that used to need the internet (wrong password, unreachable host,
+# DNS), each reported as passed or not.
+def checks_scenario(args, proxy, targets):
+    def expect_failure(connect):
+        try:
+            connect().close()
+        except (OSError, ConnectionError) as e:
+            return True, str(e)
+        return False, "proxy accepted the request"
+
+    def echo_through(host):
+        sock = benchmark.socks5_connect(proxy, host, targets["echo"])
+        try:
+            sock.sendall(b"ping")
+            return benchmark.recv_exact(sock, 4) == b"ping", "echo round trip"
+        finally:
+            sock.close()
 
-        # Send UDP ASSOCIATE request
-        request = struct.pack("!BBBBIH", SOCKS_VERSION, COMMAND_UDP_ASSOCIATE, 0, ADDRESS_TYPE_IPV4, 0, 0)
-        client_socket.sendall(request)
-        
-        # Receive UDP ASSOCIATE response
-        response = client_socket.recv(10)
-        bnd_port = struct.unpack("!H", response[8:10])[0]
-        
-        client_socket.close()
-        
-        # Send UDP packet
+    def udp_echo():
+        control, relay_address = benchmark.socks5_udp_associate(proxy)
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.sendto(b'Hello, this is a test message', ('127.0.0.1', 12345))
-        
+        udp_socket.settimeout(2)
         try:
-            data, server = udp_socket.recvfrom(4096)
-            print(f"Received response from {server}: {data.decode('utf-8')}", flush=True)
-        except socket.timeout:
-            print("Request timed out", flush=True)
+            header = benchmark.udp_request_header("127.0.0.1", targets["udp"])
+            udp_socket.sendto(header + b"ping", relay_address)
+            data, _ = udp_socket.recvfrom(65535)
+            return data == header + b"ping", "datagram relayed and answered"
         finally:
             udp_socket.close()
+            control.close()
 
-    send_udp_associate_request('127.0.0.1', 1080, 'user', 'password')
+    checks = {
+        "connect_ipv4": lambda: echo_through("127.0.0.1"),
+        "connect_domain": lambda: echo_through("localhost"),
+        "udp_associate": udp_echo,
+        "wrong_password": lambda: expect_failure(lambda: benchmark.socks5_connect(proxy, "127.0.0.1", targets["echo"], password="wrong")),
+        "connection_refused": lambda: expect_failure(lambda: benchmark.socks5_connect(proxy, "127.0.0.1", closed_port())),
+        "unresolvable_domain": lambda: expect_failure(lambda: benchmark.socks5_connect(proxy, "unreachable.invalid", 80)),
+    }
+    results = {}
+    for name, check in checks.items():
+        start = time.perf_counter()
+        try:
+            passed, detail = check()
+        except (OSError, ConnectionError) as e:
+            passed, detail = False, str(e)
+        results[name] = {"passed": passed, "detail": detail, "ms": round((time.perf_counter() - start) * 1000, 1)}
+    results["passed"] = sum(1 for result in results.values() if result["passed"])
+    results["failed"] = len(checks) - results["passed"]
+    return results
 
-    
-########################################################################################
-# Test Case 9: Invalid Authentication
-def invalid_authentication():
-    run_command(
-        "curl -U wronguser:wrongpassword --socks5 localhost:1080 http://example.com",
-        "Invalid Authentication Test"
-    )
-    
-########################################################################################
-# Test Case 10: Unreachable Destination
-def unreachable_destination():
-    run_command(
-        "curl -U user:password --socks5 localhost:1080 http://unreachable.example.com",
-        "Unreachable Destination Test"
-    )
-    
-########################################################################################
-# Test Case 11: httperf
-def httperf_test():
-    run_command(
-        "proxychains httperf --server=93.184.215.14 --port=80 --uri=/ --rate=10 --num-conns=100",
-        "HTTP Performance Test using httperf"
-    )
-    
-########################################################################################
-# Test Case 12: siege
-def siege_test():
-    run_command(
-        "proxychains siege -c 10 -r 10 http://example.com",
-        "Load Testing using siege"
-    )
-    
-########################################################################################
-# Test Case 13: iperf3
-# Start iperf3 server in another terminal or machine: iperf3 -s -p 5201
-def iperf3_test():
-    run_command(
-        "proxychains iperf3 -c localhost -u -b 1M -p 5201",
-        "Bandwidth Test using iperf3"
-    )
-    
 ########################################################################################
 
+def summary_line(scenario, result):
+    if scenario == "handshake":
+        latency = result["connect_latency"]
+        return f"{result['handshakes_per_s']:.0f} handshakes/s, connect p50 {latency.get('p50_ms')} ms p99 {latency.get('p99_ms')} ms, {result['errors']} errors"
+    if scenario == "http":
+        latency = result["latency"]
+        return f"{result['requests_per_s']:.0f} requests/s, p50 {latency.get('p50_ms')} ms p99 {latency.get('p99_ms')} ms, {result['errors']} errors"
+    if scenario == "throughput":
+        return f"{result['aggregate_mb_per_s']} MB/s over {result['clients']} clients, {result['short_transfers']} short, {result['errors']} errors"
+    if scenario == "udp":
+        return f"{result['pps']:.0f} pps, {result['loss_percent']}% loss, {result['errors']} errors"
+    failed = [name for name, check in result.items() if isinstance(check, dict) and not check["passed"]]
+    return f"{result['passed']} passed" + (f", failed: {', '.join(failed)}" if failed else "")
+
+def numeric_fields(result, prefix=""):
+    # Flattens a result into {"connect_latency.p99_ms": value, ...} for the baseline comparison
+    fields = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            fields.update(numeric_fields(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            fields[f"{prefix}{key}"] = value
+    return fields
+
+def compare_with_baseline(report, baseline):
+    print(f"\nChanges against the baseline from {baseline.get('timestamp')}:", flush=True)
+    for mode, scenarios in report["results"].items():
+        for scenario, result in scenarios.items():
+            old = numeric_fields(baseline.get("results", {}).get(mode, {}).get(scenario, {}))
+            for field, value in numeric_fields(result).items():
+                if field in old and old[field]:
+                    change = 100 * (value - old[field]) / old[field]
+                    print(f"  {mode:<8} {scenario:<10} {field:<28} {old[field]:>12} -> {value:<12} {change:+.1f}%", flush=True)
+
 def main():
-    parser = argparse.ArgumentParser(description="Run specific test cases")
-    parser.add_argument("test_case", type=int, help="Test case number to run (1-13)")
+    parser = argparse.ArgumentParser(description="Offline load test of the proxy against local targets, with JSON results")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"Scenarios to run, any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--modes", nargs="+", default=["thread", "asyncio"], help="Proxy serving modes to test")
+    parser.add_argument("--proxy-args", default="", help="Extra socks_proxy.py arguments, e.g. \"--relay copy\"")
+    parser.add_argument("--port", type=int, default=11080, help="Port for the proxy under test")
+    parser.add_argument("--clients", type=int, default=20, help="Concurrent SOCKS5 clients per scenario")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds each timed scenario runs")
+    parser.add_argument("--http-size", type=int, default=16384, help="Bytes in each HTTP response")
+    parser.add_argument("--size-mb", type=int, default=20, help="Megabytes each client downloads in the throughput scenario")
+    parser.add_argument("--window", type=int, default=16, help="Datagrams in flight per UDP association")
+    parser.add_argument("--payload", type=int, default=64, help="UDP payload size in bytes")
+    parser.add_argument("--json", help="Write the results to this file ('-' for stdout)")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
     args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    args.scenarios = args.scenarios or SCENARIOS
+
+    benchmark.raise_fd_limit()
+    targets = {
+        "echo": benchmark.start_echo_server(),
+        "http": start_http_server(args.http_size),
+        "bulk": benchmark.start_bulk_server(args.size_mb * 1024 * 1024),
+        "udp": benchmark.start_udp_echo_server(),
+    }
+    scenarios = {
+        "handshake": handshake_scenario,
+        "http": http_scenario,
+        "throughput": throughput_scenario,
+        "udp": udp_scenario,
+        "checks": checks_scenario,
+    }
 
-    test_cases = {
-        1: basic_http_request,
-        2: basic_https_request,
-        3: large_file_download,
-        4: http_post_request,
-        5: concurrent_connections_test,
-        6: dns_resolution_test,
-        7: dns_over_udp,
-        8: udp_traffic_test,
-        9: invalid_authentication,
-        10: unreachable_destination,
-        11: httperf_test,
-        12: siege_test,
-        13: iperf3_test
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+        "results": {},
     }
+    proxy = ("127.0.0.1", args.port)
+    for mode in args.modes:
+        process = benchmark.start_proxy(args.port, "--mode", mode, *shlex.split(args.proxy_args))
+        report["results"][mode] = {}
+        try:
+            for scenario in args.scenarios:
+                result = scenarios[scenario](args, proxy, targets)
+                report["results"][mode][scenario] = result
+                print(f"{mode:<8} {scenario:<10} {summary_line(scenario, result)}", flush=True)
+        finally:
+            benchmark.stop_proxy(process)
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2), flush=True)
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}", flush=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_with_baseline(report, json.load(f))
 
-    test_case = test_cases.get(args.test_case)
-    if test_case:
-        test_case()
-    else:
-        print("Invalid test case number. Please provide a number between 1 and 13.", flush=True)
+    failed_checks = sum(scenarios.get("checks", {}).get("failed", 0) for scenarios in report["results"].values())
+    if failed_checks:
+        raise SystemExit(f"{failed_checks} checks failed")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,163 @@
+# ref : http://www.cs.columbia.edu/~nahum/w6998/papers/sosp87-timing-wheels.pdf
+import math
+import time
+import asyncio
+import logging
+import threading
+
+# Wheel resolution and size: 512 slots of 0.1 s cover 51.2 s per turn, longer timers wait out extra turns
+TICK = 0.1
+SLOTS = 512
+
+class Timer:
+    __slots__ = ("callback", "rounds", "cancelled")
+
+    def __init__(self, callback, rounds):
+        self.callback = callback
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        # Left in its slot and dropped when the wheel next passes it, so cancelling is O(1)
+        self.cancelled = True
+
+class TimerWheel:
+    """
+    Hashed timing wheel (Varghese & Lauck, scheme 6) shared by every
+    connection: schedule() and cancel() are O(1), and each tick only looks
+    at the timers in one slot, so tens of thousands of deadlines cost no
+    more per tick than a handful. Deadlines are rounded up to the next
+    tick. Callbacks run on whatever drives advance(): the wheel thread in
+    thread mode, the event loop in asyncio mode.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.started = time.monotonic()
+        self.ticks_done = 0
+        self.lock = threading.Lock()
+        self.fired = 0
+
+    def schedule(self, delay, callback):
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            # The slot at `position` is swept within the current tick, so counting from there a
+            # timer never fires early, at worst one tick late
+            timer = Timer(callback, ticks // len(self.slots))
+            self.slots[(self.position + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self, now=None):
+        """Fire every timer whose tick has passed."""
+        now = time.monotonic() if now is None else now
+        due = int((now - self.started) / self.tick)
+        while self.ticks_done < due:
+            expired = []
+            with self.lock:
+                remaining = []
+                for timer in self.slots[self.position]:
+                    if timer.cancelled:
+                        continue
+                    if timer.rounds:
+                        timer.rounds -= 1
+                        remaining.append(timer)
+                    else:
+                        expired.append(timer)
+                self.slots[self.position] = remaining
+                self.position = (self.position + 1) % len(self.slots)
+                self.ticks_done += 1
+            for timer in expired:
+                if timer.cancelled:
+                    continue
+                self.fired += 1
+                try:
+                    timer.callback()
+                except Exception as e:
+                    logging.error(f"Timer callback failed: {e}")
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+    async def run_async(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+    def stats(self):
+        with self.lock:
+            return {"timers": sum(len(slot) for slot in self.slots), "fired": self.fired}
+
+wheel = TimerWheel()
+wheel_thread = None
+
+def start_thread():
+    """Drive the shared wheel from a daemon thread (thread mode; asyncio mode runs wheel.run_async() instead)."""
+    global wheel_thread
+    if wheel_thread is None or not wheel_thread.is_alive():
+        wheel_thread = threading.Thread(target=wheel.run, name="timer-wheel", daemon=True)
+        wheel_thread.start()
+
+class Watchdog:
+    """
+    The one timer a connection has on the wheel at any moment: first the
+    handshake deadline, then the idle timeout. Activity only stores a
+    timestamp (touch()); when the idle timer comes due it re-arms itself
+    for the time that is left if the connection was used meanwhile, so a
+    busy tunnel costs no wheel operations per chunk. on_expire(reason)
+    is called once a deadline really passes, and `reason` keeps why.
+    """
+
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self.timer = None
+        self.kind = None
+        self.timeout = 0
+        self.last_activity = time.monotonic()
+        self.first_activity = None # when the relay first moved data, for the connection's trace
+        self.reason = None
+
+    def handshake(self, timeout):
+        # A fixed deadline: trickling bytes in doesn't extend it
+        self.arm("handshake_timeout", timeout)
+
+    def idle(self, timeout):
+        self.arm("idle_timeout", timeout)
+
+    def arm(self, kind, timeout):
+        self.cancel()
+        if not timeout:
+            return
+        self.kind = kind
+        self.timeout = timeout
+        self.last_activity = time.monotonic()
+        self.timer = wheel.schedule(timeout, self.fire)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+        if self.first_activity is None:
+            self.first_activity = self.last_activity
+
+    def fire(self):
+        if self.kind == "idle_timeout":
+            remaining = self.last_activity + self.timeout - time.monotonic()
+            if remaining > 0:
+                self.timer = wheel.schedule(remaining, self.fire)
+                return
+        self.timer = None
+        self.reason = self.kind
+        self.on_expire(self.kind)
+
+    def expire(self, reason):
+        # Ends the connection now rather than at a deadline, e.g. when a shutdown drain runs out of time
+        self.cancel()
+        self.reason = reason
+        self.on_expire(reason)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,274 @@
+# ref : https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU (Trace Event Format)
+# ref : https://github.com/brendangregg/FlameGraph#2-fold-stacks
+import os
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import itertools
+import threading
+from collections import Counter, deque
+
+# Finished connections whose spans are kept for a dump; 0 turns tracing off
+BUFFER_SIZE = 0
+# Stack samples per second while the profiler runs; not a round number, so it doesn't beat with periodic work
+PROFILE_HZ = 99
+# Where the SIGUSR1 trace dumps and SIGUSR2 profiles are written
+DUMP_DIR = "."
+
+class Trace:
+    """The spans of one connection: (name, start, end) in time.monotonic() seconds, start == end for a point in time."""
+
+    __slots__ = ("id", "spans", "fields")
+
+    def __init__(self, id, fields):
+        self.id = id
+        self.spans = []
+        self.fields = fields # the connection's ConnectionSummary fields, read at dump time
+
+    def span(self, name, start, end):
+        self.spans.append((name, start, end))
+
+    def event(self, name, at=None):
+        at = time.monotonic() if at is None else at
+        self.spans.append((name, at, at))
+
+class TraceBuffer:
+    """
+    The spans of the last `size` connections, oldest dropped first, and of
+    the ones still open. Recording a span is a list append on the
+    connection's own Trace; the lock is only taken when a connection opens
+    or closes and when the buffer is dumped.
+    """
+
+    def __init__(self, size):
+        self.finished = deque(maxlen=size)
+        self.open = {} # id -> Trace
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self, fields):
+        trace = Trace(next(self.ids), fields)
+        with self.lock:
+            self.open[trace.id] = trace
+        return trace
+
+    def finish(self, trace):
+        trace.event("close")
+        with self.lock:
+            self.open.pop(trace.id, None)
+            self.finished.append(trace)
+
+    def dump(self):
+        """Every trace as Trace Event Format JSON (chrome://tracing, Perfetto): one row per connection."""
+        with self.lock:
+            traces = [(trace, False) for trace in self.finished] + [(trace, True) for trace in self.open.values()]
+        pid = os.getpid()
+        now = round(time.monotonic() * 1e6)
+        events = []
+        for trace, still_open in traces:
+            fields = dict(trace.fields, open=still_open)
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": trace.id,
+                           "args": {"name": f"{fields.get('client')} {fields.get('command', '')} {fields.get('target', '')}".strip()}})
+            for name, start, end in list(trace.spans):
+                event = {"name": name, "pid": pid, "tid": trace.id, "ts": round(start * 1e6)}
+                if end > start:
+                    event.update(ph="X", dur=round((end - start) * 1e6))
+                else:
+                    event.update(ph="i", s="t")
+                if name == "close":
+                    event["args"] = fields
+                events.append(event)
+            if still_open:
+                events.append({"name": "open", "ph": "i", "s": "t", "pid": pid, "tid": trace.id, "ts": now, "args": fields})
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms",
+                           "otherData": {"clock": "monotonic", "open": sum(still_open for _, still_open in traces)}}, default=str)
+
+def thread_group(name):
+    # worker-17 and resolver_3 are one root each in the flame graph, not one per thread
+    return re.sub(r"[-_]\d+$", "", name)
+
+class Profiler:
+    """
+    A wall-clock sampling profiler: a thread takes the stack of every
+    other thread with sys._current_frames() PROFILE_HZ times a second and
+    counts each distinct stack. Nothing is hooked into the code being
+    profiled, so it can be switched on and off at runtime, and threads
+    waiting in poll() or on the worker queue show up as such. folded()
+    gives the collapsed-stack lines flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = threading.Event()
+        self.counts = Counter()
+        self.samples = 0
+        self.hz = PROFILE_HZ
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, hz=None):
+        """Starts a new profile; False if one is already running."""
+        if self.running:
+            return False
+        self.hz = hz or PROFILE_HZ
+        self.counts = Counter()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stops the profile and returns it in collapsed-stack format."""
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        return self.folded()
+
+    def run(self):
+        me = threading.get_ident()
+        interval = 1 / self.hz
+        next_sample = time.monotonic()
+        while not self.stopping.wait(max(0, next_sample - time.monotonic())):
+            next_sample += interval
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_group(names.get(ident, "thread")))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+buffer = None
+profiler = Profiler()
+
+def configure(buffer_size=None, profile_hz=None, dump_dir=None):
+    global BUFFER_SIZE, PROFILE_HZ, DUMP_DIR, buffer
+    if buffer_size is not None:
+        BUFFER_SIZE = buffer_size
+    if profile_hz is not None:
+        PROFILE_HZ = profile_hz
+    if dump_dir is not None:
+        DUMP_DIR = dump_dir
+    buffer = TraceBuffer(BUFFER_SIZE) if BUFFER_SIZE else None
+
+def start(fields):
+    """A Trace for a new connection, None while tracing is off."""
+    return buffer.start(fields) if buffer is not None else None
+
+def finish(trace):
+    if buffer is not None:
+        buffer.finish(trace)
+
+def dump_traces():
+    if buffer is None:
+        return json.dumps({"traceEvents": [], "otherData": {"error": "tracing is off, see --trace-buffer"}})
+    return buffer.dump()
+
+def toggle_profiler(hz=None):
+    """Starts the profiler, or stops it and returns the profile."""
+    if profiler.start(hz):
+        return None
+    return profiler.stop()
+
+def write_dump(kind, content):
+    path = os.path.join(DUMP_DIR, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{'json' if kind == 'trace' else 'folded'}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    logging.info(f"Wrote {path}")
+
+def dump_on_signal():
+    # SIGUSR1; the file is written off the signal handler so the accept loop isn't held up
+    threading.Thread(target=lambda: write_dump("trace", dump_traces()), name="trace-dump", daemon=True).start()
+
+def profile_on_signal():
+    # SIGUSR2: the first one starts the profiler, the next one writes what it sampled
+    def toggle():
+        profile = toggle_profiler()
+        if profile is None:
+            logging.info(f"Profiler started at {profiler.hz} Hz")
+        else:
+            write_dump("profile", profile)
+    threading.Thread(target=toggle, name="profile-toggle", daemon=True).start()
+
+def handle_command(line):
+    """
+    An admin socket command and its answer:
+    traces                  Trace Event Format JSON of the buffered connections
+    profile start [HZ]      start the sampling profiler
+    profile stop            stop it and return collapsed stacks
+    profile status          whether it runs and how many samples it took
+    """
+    words = line.split()
+    if words == ["traces"]:
+        return dump_traces()
+    if words[:2] == ["profile", "start"] and len(words) <= 3:
+        hz = float(words[2]) if len(words) == 3 else None
+        if not profiler.start(hz):
+            return "profiler already running\n"
+        return f"profiler started at {profiler.hz} Hz\n"
+    if words == ["profile", "stop"]:
+        return profiler.stop()
+    if words == ["profile", "status"]:
+        return f"{'running' if profiler.running else 'stopped'} at {profiler.hz} Hz, {profiler.samples} samples\n"
+    return f"unknown command {line.strip()!r}; try: traces | profile start [HZ] | profile stop | profile status\n"
+
+class AdminServer:
+    """One command per connection on a Unix socket, answered and closed: `python3 tracing.py PATH traces`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+
+    def start(self):
+        try:
+            os.unlink(self.path) # left by a process that did not exit cleanly
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600) # dumps show clients, users and destinations
+        self.sock.listen(4)
+        threading.Thread(target=self.run, name="admin", daemon=True).start()
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    line = conn.makefile("r", encoding="utf-8").readline()
+                    conn.sendall(handle_command(line).encode("utf-8"))
+                except (OSError, ValueError) as e:
+                    logging.error(f"Admin command failed: {e}")
+
+def serve_admin(path):
+    AdminServer(path).start()
+    logging.info(f"Admin socket listening on {path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a command to a running proxy's --admin-socket")
+    parser.add_argument("path", help="Admin socket path")
+    parser.add_argument("command", nargs="+", help="traces | profile start [HZ] | profile stop | profile status")
+    args = parser.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.path)
+        sock.sendall((" ".join(args.command) + "\n").encode("utf-8"))
+        while chunk := sock.recv(65536):
+            sys.stdout.buffer.write(chunk)
@@ -0,0 +1,112 @@
+import socket
+
+import buffer_pool
+
+# Datagrams drained per wakeup
+BATCH_SIZE = 32
+# Size of each preallocated receive buffer, same as the old recvfrom(4096); longer datagrams are dropped as truncated
+BUFFER_SIZE = 4096
+
+class DatagramBatch:
+    """
+    Batched I/O on a non-blocking UDP socket. Python has no recvmmsg/sendmmsg,
+    so receive() drains every ready datagram (up to batch_size) with
+    recvmsg_into into buffers taken from buffer_pool once, and sendto() only
+    queues; flush() sends the queue in one pass. A datagram queued with a
+    header goes out with sendmsg, which gathers header and payload in the
+    kernel, so neither is copied into a new bytes object. The views
+    returned by receive() (and anything queued from them) are only valid
+    until the next receive(), so callers flush before receiving again.
+    close() gives the buffers back to the pool.
+    """
+
+    def __init__(self, sock, batch_size=None, buffer_size=None):
+        self.sock = sock
+        self.batch_size = batch_size or BATCH_SIZE
+        self.buffer_size = buffer_size or BUFFER_SIZE
+        self.buffers = [buffer_pool.acquire(self.buffer_size) for _ in range(self.batch_size)]
+        self.outgoing = []
+        # Stats
+        self.batches = 0
+        self.received = 0
+        self.largest_batch = 0
+        self.full_batches = 0
+        self.truncated = 0
+        self.receive_errors = 0
+        self.flushes = 0
+        self.sent = 0
+        self.send_dropped = 0
+
+    def receive(self):
+        """Returns [(data, addr)] for every datagram ready right now, up to batch_size."""
+        received = []
+        attempts = 0
+        while len(received) < self.batch_size and attempts < 2 * self.batch_size:
+            attempts += 1
+            buffer = self.buffers[len(received)]
+            try:
+                nbytes, _, flags, addr = self.sock.recvmsg_into([buffer])
+            except BlockingIOError:
+                break
+            except OSError:
+                # ICMP error queued by an earlier send, e.g. port unreachable
+                self.receive_errors += 1
+                continue
+            if flags & socket.MSG_TRUNC:
+                self.truncated += 1
+                continue
+            received.append((buffer[:nbytes], addr))
+
+        if received:
+            self.batches += 1
+            self.received += len(received)
+            self.largest_batch = max(self.largest_batch, len(received))
+            if len(received) == self.batch_size:
+                self.full_batches += 1
+        return received
+
+    def sendto(self, data, addr, header=None):
+        self.outgoing.append((data, addr, header))
+
+    def flush(self):
+        if not self.outgoing:
+            return
+        self.flushes += 1
+        for data, addr, header in self.outgoing:
+            try:
+                if header:
+                    self.sock.sendmsg([header, data], (), 0, addr)
+                else:
+                    self.sock.sendto(data, addr)
+                self.sent += 1
+            except OSError:
+                # Send buffer full (or an ICMP error surfacing): UDP is allowed to lose it
+                self.send_dropped += 1
+        self.outgoing.clear()
+
+    def close(self):
+        self.outgoing.clear()
+        for buffer in self.buffers:
+            buffer_pool.release(buffer)
+        self.buffers = []
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "received": self.received,
+            "average_batch": self.received / self.batches if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "full_batches": self.full_batches,
+            "truncated": self.truncated,
+            "receive_errors": self.receive_errors,
+            "flushes": self.flushes,
+            "sent": self.sent,
+            "send_dropped": self.send_dropped,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"{stats['received']} datagrams in {stats['batches']} batches "
+                f"(avg {stats['average_batch']:.1f}, max {stats['largest_batch']}, {stats['full_batches']} full), "
+                f"{stats['sent']} sent in {stats['flushes']} flushes, "
+                f"{stats['truncated']} truncated, {stats['send_dropped']} send drops")
@@ -0,0 +1,313 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc1928#section-7
+import time
+import socket
+import select
+import struct
+import asyncio
+import logging
+import functools
+
+import acl
+import dns_cache
+import metrics
+import socks_parser
+
+ADDRESS_TYPE_IPV4 = 1
+ADDRESS_TYPE_DOMAIN = 3
+ADDRESS_TYPE_IPV6 = 4
+
+# Seconds a (dst_addr, dst_port) mapping survives without traffic in either direction
+IDLE_TIMEOUT = 60
+# How often idle mappings are swept, also the longest the relay sleeps
+SWEEP_INTERVAL = 1
+# How long relay_udp sleeps at most while datagrams wait for their domain to resolve
+RESOLVE_POLL_INTERVAL = 0.01
+
+def parse_udp_datagram(data):
+    """
+    Each UDP datagram carries a UDP request header with it:
+    +----+------+------+----------+----------+----------+
+    |RSV | FRAG | ATYP | DST.ADDR | DST.PORT |   DATA   |
+    +----+------+------+----------+----------+----------+
+    | 2  |  1   |  1   | Variable |    2     | Variable |
+    +----+------+------+----------+----------+----------+
+    Returns (addr_type, dst_addr, dst_port, payload), or None for a datagram
+    we drop: unsupported ATYP, or a fragment (FRAG != X'00'), which an
+    implementation that doesn't do reassembly MUST drop.
+    """
+    # Parse the SOCKS5 UDP header
+    _, frag, addr_type = struct.unpack_from("!HBB", data)
+    if frag != 0:
+        return None
+
+    if addr_type == ADDRESS_TYPE_IPV4:
+        dst_addr = socket.inet_ntoa(data[4:8])
+        dst_port = struct.unpack("!H", data[8:10])[0]
+        payload = data[10:]
+    elif addr_type == ADDRESS_TYPE_IPV6:
+        dst_addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
+        dst_port = struct.unpack("!H", data[20:22])[0]
+        payload = data[22:]
+    elif addr_type == ADDRESS_TYPE_DOMAIN:
+        domain_length = data[4]
+        dst_addr = bytes(data[5:5+domain_length]).decode('utf-8')
+        dst_port = struct.unpack("!H", data[5+domain_length:7+domain_length])[0]
+        payload = data[7+domain_length:]
+    else:
+        return None
+    return addr_type, dst_addr, dst_port, payload
+
+def reply_header(source_ip, source_port):
+    # The SOCKS5 UDP header in front of a reply: reserved, no fragmentation, the source's IPv4 or IPv6 address.
+    # Built once per NAT mapping and sent together with each reply by DatagramBatch, never concatenated to it.
+    return struct.pack("!HB", 0, 0) + socks_parser.address_field(source_ip, source_port)
+
+class UDPAssociation:
+    """
+    NAT state of one UDP ASSOCIATE. Datagrams from the client are sent on to
+    their destination and remembered as (dst_addr, dst_port) -> client
+    address; datagrams from a remembered destination go back to that
+    client. Anything else is dropped.
+    """
+
+    def __init__(self, client_ip, client_port=0, idle_timeout=None, shaper=None, user=None, family=socket.AF_INET):
+        # RFC 1928: DST.ADDR/DST.PORT of the request name the client's source; zero means "not known yet"
+        self.client_ip = socks_parser.unmap(client_ip)
+        self.client_port = client_port
+        self.idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.shaper = shaper # datagrams over the bandwidth limit are dropped, not delayed
+        self.user = user # for the destination rules, checked per datagram
+        self.family = family # of the relay socket; an AF_INET6 one is dual-stack
+        self.nat = {} # (dst_addr, dst_port) -> [client_addr, last_seen, reply header]
+        self.datagrams_out = 0
+        self.datagrams_in = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def is_client(self, addr):
+        return socks_parser.unmap(addr[0]) == self.client_ip and (not self.client_port or addr[1] == self.client_port)
+
+    def sockaddr(self, ip, port):
+        # Where sendto() goes: on a dual-stack socket an IPv4 destination is written as ::ffff:a.b.c.d
+        if self.family == socket.AF_INET6 and "." in ip:
+            return ("::ffff:" + ip, port)
+        return (ip, port)
+
+    def outbound(self, destination, client_addr):
+        entry = self.nat.get(destination)
+        if entry is None:
+            self.nat[destination] = [client_addr, time.monotonic(), reply_header(*destination)]
+        else:
+            entry[0] = client_addr
+            entry[1] = time.monotonic()
+        self.datagrams_out += 1
+        metrics.UDP_OUT.inc()
+
+    def inbound(self, source):
+        # Returns the NAT entry (client address, last seen, reply header) a datagram from `source` belongs to, or None
+        entry = self.nat.get((socks_parser.unmap(source[0]), source[1]))
+        if entry is None:
+            return None
+        entry[1] = time.monotonic()
+        self.datagrams_in += 1
+        metrics.UDP_IN.inc()
+        return entry
+
+    def drop(self):
+        self.dropped += 1
+        metrics.UDP_DROPPED.inc()
+
+    def expire(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for destination in [d for d, (_, last_seen, _) in self.nat.items() if last_seen < deadline]:
+            del self.nat[destination]
+            self.expired += 1
+
+    def summary(self):
+        return f"{self.datagrams_out} out, {self.datagrams_in} in, {self.dropped} dropped, {self.expired} mappings expired"
+
+class ResolutionPending(Exception):
+    """Raised by handle_datagram(block=False) when a domain destination isn't resolved yet."""
+
+    def __init__(self, future, dst_port, payload, rule):
+        super().__init__(dst_port)
+        self.future = future
+        self.dst_port = dst_port
+        self.payload = payload
+        self.rule = rule
+
+def pick_address(addresses, family):
+    # The first resolved address the relay socket can send to: any on a dual-stack socket, else IPv4 only
+    for address_family, address in addresses:
+        if family == socket.AF_INET6 or address_family == socket.AF_INET:
+            return address
+    return None
+
+def send_outbound(sender, association, client_addr, dst_ip, dst_port, payload, rule=acl.DEFAULT_RULE):
+    # `rule` is what the destination as named matched; a name's address is checked against the network rules before it
+    if dst_ip is None or acl.address_denied(dst_ip, dst_port, association.user, rule):
+        association.drop()
+        return
+    association.outbound((dst_ip, dst_port), client_addr)
+    sender.sendto(payload, association.sockaddr(dst_ip, dst_port))
+
+def handle_datagram(sender, association, data, addr, block=True):
+    """
+    Relay one datagram received on the association's socket, in whichever
+    direction it goes. `sender` is the association's udp_batch.DatagramBatch.
+    """
+    if association.shaper and not association.shaper.allow(len(data)):
+        association.drop()
+        return
+
+    entry = association.inbound(addr)
+    if entry is not None:
+        sender.sendto(data, entry[0], entry[2])
+        return
+
+    if not association.is_client(addr):
+        association.drop()
+        return
+
+    datagram = parse_udp_datagram(data)
+    if datagram is None:
+        association.drop()
+        return
+    addr_type, dst_addr, dst_port, payload = datagram
+    rule = acl.check(dst_addr, dst_port, association.user)
+    if rule.action == "deny":
+        association.drop()
+        return
+
+    if addr_type == ADDRESS_TYPE_DOMAIN:
+        future = dns_cache.resolve(dst_addr)
+        if not block and not future.done():
+            raise ResolutionPending(future, dst_port, bytes(payload), rule) # payload is a view into a reused buffer
+        dst_addr = pick_address(future.result(timeout=dns_cache.RESOLVE_TIMEOUT), association.family)
+    elif addr_type == ADDRESS_TYPE_IPV6 and association.family != socket.AF_INET6:
+        dst_addr = None
+    send_outbound(sender, association, addr, dst_addr, dst_port, payload, rule)
+
+def relay_udp(client_socket, batch, association, watchdog=None):
+    """
+    Relay datagrams until the controlling TCP connection closes: RFC 1928
+    ends a UDP association together with the TCP connection it came from.
+    Each wakeup drains every ready datagram through `batch` and flushes the
+    replies together, and touches `watchdog` (the idle timeout), if given.
+    A datagram whose domain isn't resolved yet waits in a list, checked on
+    every wakeup, so one slow lookup doesn't hold up the others.
+    Returns the reason the association ended.
+    """
+    poller = select.poll() # select can't watch descriptors above 1024
+    poller.register(batch.sock, select.POLLIN)
+    poller.register(client_socket, select.POLLIN)
+    next_sweep = time.monotonic() + SWEEP_INTERVAL
+    pending = [] # (ResolutionPending, client address, give-up time)
+
+    while True:
+        timeout = RESOLVE_POLL_INTERVAL if pending else SWEEP_INTERVAL
+        readable = {fd for fd, _ in poller.poll(timeout * 1000)}
+        if client_socket.fileno() in readable:
+            try:
+                if not client_socket.recv(4096):
+                    return "client_closed"
+            except OSError as e:
+                return f"client_error: {e}"
+
+        if batch.sock.fileno() in readable:
+            if watchdog:
+                watchdog.touch()
+            for data, addr in batch.receive():
+                try:
+                    handle_datagram(batch, association, data, addr, block=False)
+                except ResolutionPending as waiting:
+                    pending.append((waiting, addr, time.monotonic() + dns_cache.RESOLVE_TIMEOUT))
+                except Exception as e:
+                    # e.g. a malformed header
+                    association.drop()
+                    logging.debug(f"UDP relay dropped a datagram: {e}")
+
+        if pending:
+            pending = finish_resolved(pending, batch, association)
+        batch.flush()
+
+        if time.monotonic() >= next_sweep:
+            association.expire()
+            next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+def finish_resolved(pending, batch, association):
+    # Sends the datagrams of relay_udp whose lookup has finished, drops those that failed or took too long; returns the rest
+    now = time.monotonic()
+    still_pending = []
+    for waiting, addr, give_up in pending:
+        if not waiting.future.done():
+            if now < give_up:
+                still_pending.append((waiting, addr, give_up))
+            else:
+                association.drop()
+                logging.debug("UDP relay dropped a datagram: lookup timed out")
+            continue
+        try:
+            dst_ip = pick_address(waiting.future.result(), association.family)
+            send_outbound(batch, association, addr, dst_ip, waiting.dst_port, waiting.payload, waiting.rule)
+        except Exception as e:
+            association.drop()
+            logging.debug(f"UDP relay dropped a datagram: {e}")
+    return still_pending
+
+class UDPRelayReader:
+    """
+    relay_udp for the asyncio engine: the socket is drained from a loop
+    reader callback, so there is no task (or transport call) per datagram.
+    """
+
+    def __init__(self, loop, batch, association, watchdog=None):
+        self.loop = loop
+        self.batch = batch
+        self.association = association
+        self.watchdog = watchdog
+        self.closed = False
+
+    def on_readable(self):
+        if self.watchdog:
+            self.watchdog.touch()
+        for data, addr in self.batch.receive():
+            try:
+                handle_datagram(self.batch, self.association, data, addr, block=False)
+            except ResolutionPending as pending:
+                # Finish this datagram once the resolver pool answers, without blocking the loop
+                pending.future.add_done_callback(functools.partial(self.loop.call_soon_threadsafe, self.resolved, pending, addr))
+            except Exception as e:
+                self.association.drop()
+                logging.debug(f"UDP relay dropped a datagram: {e}")
+        self.batch.flush()
+
+    def resolved(self, pending, addr, future):
+        if self.closed:
+            return
+        try:
+            dst_ip = pick_address(future.result(), self.association.family)
+            send_outbound(self.batch, self.association, addr, dst_ip, pending.dst_port, pending.payload, pending.rule)
+        except Exception as e:
+            self.association.drop()
+            logging.debug(f"UDP relay dropped a datagram: {e}")
+        self.batch.flush()
+
+async def relay_udp_async(reader, batch, association, watchdog=None):
+    loop = asyncio.get_running_loop()
+    relay = UDPRelayReader(loop, batch, association, watchdog)
+    loop.add_reader(batch.sock.fileno(), relay.on_readable)
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(4096), SWEEP_INTERVAL)
+            except TimeoutError:
+                association.expire()
+                continue
+            if not data:
+                return "client_closed"
+    except ConnectionError as e:
+        return f"client_error: {e}"
+    finally:
+        relay.closed = True
+        loop.remove_reader(batch.sock.fileno())
@@ -1,13 +1,39 @@
+import time
 import socket
+import select
+import argparse
 
-def udp_server(host, port):
+from udp_batch import DatagramBatch
+
+RESPONSE = b"Hi this is the response from UDP server"
+
+def udp_server(host, port, batch_size=None, quiet=False, stats_interval=0):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     server_socket.bind((host, port))
+    server_socket.setblocking(False)
+    batch = DatagramBatch(server_socket, batch_size)
     print(f"UDP server listening on {host}:{port}")
-    
+
+    next_stats = time.monotonic() + stats_interval
     while True:
-        data, addr = server_socket.recvfrom(4096)
-        print(f"Received message from {addr}: {data.decode('utf-8')}")
-        server_socket.sendto(b"Hi this is the response from UDP server", addr)
+        select.select([server_socket], [], [], stats_interval or None)
+        for data, addr in batch.receive():
+            if not quiet:
+                print(f"Received message from {addr}: {bytes(data).decode('utf-8', errors='replace')}")
+            batch.sendto(RESPONSE, addr)
+        batch.flush()
+
+        if stats_interval and time.monotonic() >= next_stats:
+            print(f"Batch stats: {batch.summary()}", flush=True)
+            next_stats = time.monotonic() + stats_interval
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP server that answers every datagram")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--batch-size", type=int, default=32, help="Datagrams drained per wakeup")
+    parser.add_argument("--quiet", action="store_true", help="Don't print every datagram")
+    parser.add_argument("--stats-interval", type=float, default=0, help="Print batch stats every N seconds (0: never)")
+    args = parser.parse_args()
 
-udp_server('0.0.0.0', 12345)
\ No newline at end of file
+    udp_server(args.host, args.port, args.batch_size, args.quiet, args.stats_interval)
@@ -0,0 +1,322 @@
+# ref : https://datatracker.ietf.org/doc/html/rfc1928
+# ref : https://datatracker.ietf.org/doc/html/rfc9110#section-9.3.6
+import time
+import base64
+import select
+import socket
+import struct
+import asyncio
+import logging
+import threading
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import happy_eyeballs
+import socks_parser
+
+# Authenticated connections kept open to each upstream proxy, ready for a CONNECT
+POOL_SIZE = 4
+# Pooled connections older than this are replaced, before the upstream's own idle timeout closes them
+POOL_MAX_AGE = 30
+# Seconds between health checks of each upstream
+HEALTH_INTERVAL = 10
+# Threads doing upstream handshakes for the asyncio engine
+THREADS = 8
+
+SOCKS_VERSION = 5
+NO_AUTHENTICATION_REQUIRED = 0
+USERNAME_PASSWORD = 2
+COMMAND_CONNECT = 1
+ADDRESS_TYPE_IPV4 = 1
+ADDRESS_TYPE_IPV6 = 4
+
+# REP codes we pass back for an HTTP upstream's refusal; anything else is "host unreachable"
+HTTP_STATUS_REPLIES = {"403": 2, "407": 2, "504": 6}
+
+class UpstreamRefused(Exception):
+    """The upstream proxy works but refused this request (REP != 0, HTTP status != 2xx); no failover."""
+
+    def __init__(self, message, reply):
+        super().__init__(message)
+        self.reply = reply # the REP code to send our client
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("upstream closed the connection")
+        data += chunk
+    return data
+
+def is_stale(sock):
+    # An idle pooled connection should have nothing to read; readable means the upstream closed it
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+class Proxy:
+    """
+    One upstream proxy, socks5://[user:password@]host:port or
+    http://[user:password@]host:port (HTTP CONNECT), with its pool of
+    connections that have already done the TCP and authentication round
+    trips.
+    """
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("socks5", "http") or not parts.hostname:
+            raise ValueError(f"Upstream {url} is not socks5://host:port or http://host:port")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (1080 if parts.scheme == "socks5" else 8080)
+        self.username = urllib.parse.unquote(parts.username) if parts.username else None
+        self.password = urllib.parse.unquote(parts.password or "")
+        self.label = f"{self.scheme}://{self.host}:{self.port}"
+        self.healthy = True
+        self.next_check = 0
+        self.pool = deque() # (socket, opened at)
+        self.lock = threading.Lock()
+        self.pool_hits = 0
+        self.opened = 0
+        self.failures = 0
+
+    def open(self):
+        """A new connection to the proxy, authenticated and ready for a request."""
+        sock = socket.create_connection((self.host, self.port), timeout=happy_eyeballs.CONNECT_TIMEOUT)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.scheme == "socks5":
+                self.socks5_login(sock)
+        except BaseException:
+            sock.close()
+            raise
+        with self.lock:
+            self.opened += 1
+        return sock
+
+    def socks5_login(self, sock):
+        methods = [NO_AUTHENTICATION_REQUIRED, USERNAME_PASSWORD] if self.username else [NO_AUTHENTICATION_REQUIRED]
+        sock.sendall(struct.pack("!BB", SOCKS_VERSION, len(methods)) + bytes(methods))
+        _, method = recv_exact(sock, 2)
+        if method == USERNAME_PASSWORD and self.username:
+            username, password = self.username.encode("utf-8"), self.password.encode("utf-8")
+            sock.sendall(struct.pack("!BB", 1, len(username)) + username + struct.pack("!B", len(password)) + password)
+            _, status = recv_exact(sock, 2)
+            if status != 0:
+                raise ConnectionError(f"{self.label} rejected our username/password")
+        elif method != NO_AUTHENTICATION_REQUIRED:
+            raise ConnectionError(f"{self.label} accepts none of our authentication methods")
+
+    def take(self):
+        """A connection ready for a request, from the pool when one is there. Returns (socket, pooled)."""
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.pool:
+                    break
+                sock, opened_at = self.pool.popleft()
+            if now - opened_at < POOL_MAX_AGE and not is_stale(sock):
+                with self.lock:
+                    self.pool_hits += 1
+                maintainer.wake()
+                return sock, True
+            sock.close()
+        maintainer.wake()
+        return self.open(), False
+
+    def request(self, sock, host, port):
+        """Ask the proxy on `sock` for a tunnel to host:port."""
+        sock.settimeout(happy_eyeballs.CONNECT_TIMEOUT)
+        if self.scheme == "socks5":
+            sock.sendall(struct.pack("!BBB", SOCKS_VERSION, COMMAND_CONNECT, 0) + socks_parser.address_field(host, port))
+            _, reply, _, address_type = recv_exact(sock, 4)
+            if address_type == ADDRESS_TYPE_IPV4:
+                recv_exact(sock, 4 + 2)
+            elif address_type == ADDRESS_TYPE_IPV6:
+                recv_exact(sock, 16 + 2)
+            else:
+                recv_exact(sock, recv_exact(sock, 1)[0] + 2)
+            if reply != 0:
+                raise UpstreamRefused(f"{self.label} replied REP {reply:#04x}", reply)
+        else:
+            target = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+            lines = [f"CONNECT {target} HTTP/1.1", f"Host: {target}"]
+            if self.username:
+                token = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8")).decode("ascii")
+                lines.append(f"Proxy-Authorization: Basic {token}")
+            sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            # Peek so that nothing the target sends right after the headers is consumed here
+            header = b""
+            while b"\r\n\r\n" not in header:
+                header = sock.recv(65536, socket.MSG_PEEK)
+                if not header or len(header) >= 65536:
+                    raise ConnectionError(f"{self.label} sent no complete CONNECT response")
+                if b"\r\n\r\n" not in header:
+                    time.sleep(0.001) # rest of the header still in flight
+            recv_exact(sock, header.index(b"\r\n\r\n") + 4)
+            status_line = header.split(b"\r\n", 1)[0].decode("latin-1")
+            status = status_line.split()
+            if len(status) < 2 or not status[1].startswith("2"):
+                raise UpstreamRefused(f"{self.label} answered {status_line}", HTTP_STATUS_REPLIES.get(status[1] if len(status) > 1 else "", 4))
+        sock.settimeout(None)
+
+    def failed(self, error):
+        with self.lock:
+            self.failures += 1
+            was_healthy, self.healthy = self.healthy, False
+            stale, self.pool = self.pool, deque()
+        for sock, _ in stale:
+            sock.close()
+        if was_healthy:
+            logging.warning(f"Upstream {self.label} marked down: {error}")
+
+    def recovered(self):
+        with self.lock:
+            was_healthy, self.healthy = self.healthy, True
+        if not was_healthy:
+            logging.info(f"Upstream {self.label} is back up")
+            maintainer.wake() # refill the pool
+
+    def check(self):
+        # Health check and pool top-up in one: a connection that opens is both proof and stock
+        try:
+            sock = self.open()
+        except OSError as e:
+            self.failed(e)
+            return
+        self.recovered()
+        now = time.monotonic()
+        with self.lock:
+            self.pool.append((sock, now))
+            # Oldest first: drop what has aged out, and the oldest if the check overfilled the pool
+            expired = []
+            while self.pool and (len(self.pool) > POOL_SIZE or now - self.pool[0][1] >= POOL_MAX_AGE):
+                expired.append(self.pool.popleft())
+        for old, _ in expired:
+            old.close()
+
+    def wants_connection(self):
+        with self.lock:
+            return self.healthy and len(self.pool) < POOL_SIZE
+
+    def stats(self):
+        with self.lock:
+            return {"healthy": int(self.healthy), "pooled": len(self.pool), "pool_hits": self.pool_hits,
+                    "opened": self.opened, "failures": self.failures}
+
+class Group:
+    """
+    A named, ordered list of upstream proxies that route=NAME rules (or
+    --default-route) send CONNECTs to. The first healthy one is used and
+    the next ones take over when it fails; if all are marked down they are
+    still tried, in order.
+    """
+
+    def __init__(self, name, proxies):
+        self.name = name
+        self.proxies = proxies
+
+    def connect(self, host, port):
+        """A blocking socket tunnelled to host:port through one of the proxies, and that proxy."""
+        last_error = None
+        for proxy in sorted(self.proxies, key=lambda proxy: not proxy.healthy):
+            try:
+                sock, pooled = proxy.take()
+                try:
+                    proxy.request(sock, host, port)
+                except UpstreamRefused:
+                    sock.close()
+                    raise
+                except OSError:
+                    sock.close()
+                    if not pooled:
+                        raise
+                    # The pooled connection died since it was checked; one fresh try before blaming the proxy
+                    sock = proxy.open()
+                    try:
+                        proxy.request(sock, host, port)
+                    except BaseException:
+                        sock.close()
+                        raise
+                if not proxy.healthy:
+                    proxy.recovered()
+                return sock, proxy
+            except UpstreamRefused:
+                raise
+            except OSError as e:
+                proxy.failed(e)
+                last_error = e
+        raise ConnectionError(f"No upstream in {self.name} reachable: {last_error}")
+
+    async def connect_async(self, host, port):
+        return await asyncio.get_running_loop().run_in_executor(executor, self.connect, host, port)
+
+class Maintainer:
+    """The thread that health-checks the upstreams and keeps their pools full."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.thread = None
+
+    def wake(self):
+        self.event.set()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="upstream-pool", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        proxies = [proxy for group in groups.values() for proxy in group.proxies]
+        while True:
+            now = time.monotonic()
+            for proxy in proxies:
+                if now >= proxy.next_check:
+                    proxy.next_check = now + HEALTH_INTERVAL
+                    proxy.check()
+                while proxy.wants_connection():
+                    proxy.check()
+            self.event.wait(HEALTH_INTERVAL / 2)
+            self.event.clear()
+
+maintainer = Maintainer()
+executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="upstream")
+groups = {} # name -> Group
+default_group = None
+
+def parse_upstream(text):
+    """NAME=URL[,URL...] from --upstream."""
+    name, sep, urls = text.partition("=")
+    if not sep or not name or name == "direct":
+        raise ValueError(f"Upstream {text} is not NAME=URL[,URL...]")
+    return Group(name, [Proxy(url) for url in urls.split(",")])
+
+def configure(upstreams, default_route="direct", pool_size=None, health_interval=None):
+    global POOL_SIZE, HEALTH_INTERVAL, default_group
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if health_interval is not None:
+        HEALTH_INTERVAL = health_interval
+    groups.clear()
+    for text in upstreams:
+        group = parse_upstream(text)
+        groups[group.name] = group
+    if default_route != "direct" and default_route not in groups:
+        raise ValueError(f"--default-route {default_route} is not a configured upstream")
+    default_group = groups.get(default_route)
+
+def start():
+    # After fork: each prefork worker keeps its own pools
+    if groups:
+        maintainer.start()
+
+def group_for(route):
+    """The Group a CONNECT goes through: `route` is a rule's route=NAME, None when the rule had none."""
+    if route is None:
+        return default_group
+    return groups.get(route)
+
+def stats():
+    return {proxy.label: proxy.stats() for group in groups.values() for proxy in group.proxies}